@@ -35,7 +35,10 @@ def create_app():
     app.process_manager = ProcessManager()
     
     # 注册路由
-    from flask import request
+    import time
+    from flask import request, g
+    from app.utils import metrics, tracing
+    from app.core import trace_store
     from app.utils.response import api_response
     from app.routes import task_routes, log_routes, system_routes, auth_routes
     app.register_blueprint(auth_routes.bp)
@@ -43,6 +46,41 @@ def create_app():
     app.register_blueprint(log_routes.bp)
     app.register_blueprint(system_routes.bp)
 
+    http_latency = metrics.histogram('http_request_duration_seconds', 'HTTP 请求处理耗时',
+                                     labels=('method', 'route', 'status'))
+
+    # 请求耗时按路由模板统计（/api/tasks/db/<int:task_id>），避免按实际路径产生无界的标签
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+        if Config.TRACE_ENABLED:
+            # 请求内提交的运行（tracing.bind_run）以本次请求为追踪的根 span
+            g.trace = (tracing.Tracer(max_spans=Config.TRACE_MAX_SPANS), tracing.new_id(), time.time())
+            g.trace_token = tracing.attach(g.trace[0], g.trace[1])
+
+    @app.after_request
+    def record_request_latency(response):
+        started = g.get('request_started')
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            http_latency.labels(method=request.method, route=route, status=str(response.status_code)) \
+                .observe(time.perf_counter() - started)
+        g.response_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def finish_request_trace(exc):
+        if 'trace' not in g:
+            return
+        tracing.detach(g.trace_token)
+        tracer, span_id, started = g.trace
+        if tracer.run_id is None:
+            return
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        tracer.record('http', started, time.time(), None,
+                      {'method': request.method, 'route': route, 'status': g.get('response_status')}, span_id)
+        trace_store.export(tracer.run_id, tracer.drain())
+
     # 全局鉴权：对 /api/* 接口进行 token 校验，白名单可包含无需鉴权的接口
     @app.before_request
     def global_auth_check():
@@ -53,10 +91,15 @@ def create_app():
 
         # 白名单，不需要鉴权的接口
         whitelist = ['/api/auth/login', '/api/system/health']
+        if Config.METRICS_PUBLIC:
+            whitelist.append('/api/system/metrics')
         if path in whitelist:
             return None
 
         auth = request.headers.get('Authorization', '')
+        # EventSource 无法设置请求头，实时日志流允许通过 ?token= 传递
+        if not auth and path.endswith('/stream'):
+            auth = request.args.get('token', '')
         if not auth:
             return api_response(None, 'Unauthorized', 401)
 
@@ -66,8 +109,11 @@ def create_app():
         else:
             token = auth.strip()
         from app.utils.auth import verify_token
-        if not verify_token(token):
+        payload = verify_token(token)
+        if not payload:
             return api_response(None, 'Invalid or expired token', 401)
+        # 记录解码后的身份，后续处理函数通过 current_username() 读取，无需再次解码
+        g.token_payload = payload
     
     # 前端路由 - SPA支持
     @app.route('/', defaults={'path': ''})
@@ -84,5 +130,8 @@ def create_app():
             return ("Frontend build not found", 404)
         return app.send_static_file('index.html')
     
+    # 队列深度、日志速率等仪表由后台线程采样，抓取指标时不做阻塞采样
+    metrics.start_collector(Config.METRICS_COLLECT_INTERVAL)
+
     logger.info("应用初始化完成")
     return app
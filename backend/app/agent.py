@@ -0,0 +1,253 @@
+"""Runner agent：从数据库运行队列领取编排任务并在本机执行（配合 API 节点的 RUN_MODE=queue）。
+
+每个 agent 最多同时执行 concurrency 个运行，按租约定期续约；日志边执行边以压缩块写入数据库，
+状态与上下文经 db_writer 落库，API 节点据此提供查询与实时日志。
+收到 SIGTERM / SIGINT 后不再领取新运行，等待已领取的运行结束后退出；
+超过 --drain-timeout 仍未结束时终止脚本进程后退出，被强制终止时同样如此：
+这些运行的租约会过期，由其他 agent（或重启后的本 agent）重新领取执行。
+续约时发现租约已被回收（失联超过 RUNNER_LEASE_SECONDS）的运行立即中止：终止其脚本进程、
+丢弃尚未落库的写入，之后的状态 / 日志写入也只在本 agent 仍持有租约时落库（见 db_writer.guard）。
+
+--scheduler 时同时在本进程运行定时触发线程（生产部署中由唯一的专用 runner 进程承担，见 app.serve）。
+运行相关的指标（脚本耗时、派发延迟、预热进程池、日志吞吐、写入队列等）只存在于 agent 进程内，
+在 --metrics-port（默认 RUNNER_METRICS_PORT）上以 /metrics 输出，API 节点的 /api/system/metrics?process=runner 代理该端口。
+
+agent 与 API 节点需使用同一个数据库（TASK_DB_PATH），并能在 TASKS_DIR 下找到相同的脚本。
+
+用法（在 backend 目录下）：
+  python -m app.agent --name runner-1 --concurrency 4 [--scheduler]
+"""
+import os
+import sys
+import time
+import signal
+import argparse
+import threading
+from datetime import datetime
+from app.core.config import Config
+from app.core import run_queue
+from app.core.db_writer import db_writer
+from app.utils import proc_limits, metrics
+from app.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class RunnerAgent:
+    """领取 -> 执行 -> 续约的 agent 主循环"""
+
+    def __init__(self, name=None, concurrency=None, scheduler=False, exit_with_parent=False, metrics_port=None):
+        # 延迟导入：先让命令行参数 / 环境变量生效，再初始化数据库与执行器
+        from app.models.db import init_db
+        from app.services.task_service import TaskService
+        init_db()
+        if Config.RUN_STORAGE != 'db':
+            logger.warning(f"runner agent 需要把日志写入数据库，忽略 RUN_STORAGE={Config.RUN_STORAGE}")
+            Config.RUN_STORAGE = 'db'
+        self.name = name or run_queue.node_name()
+        self.concurrency = max(1, concurrency or Config.MAX_TASK_WORKERS)
+        self.service = TaskService(max_workers=self.concurrency, ship_logs=True)
+        self.held = set()  # 本 agent 已领取、尚未结束的运行
+        self.scheduler = None
+        # 由 app.serve 拉起时，master 被强制终止后不能留下一个无人管理的 runner
+        self.parent = os.getppid() if exit_with_parent else None
+        if scheduler:
+            from app.core.task_scheduler import TaskScheduler
+            from app.utils.process_lock import ProcessLock
+            self.scheduler = TaskScheduler(self.service, ProcessLock())
+        self.metrics_port = Config.RUNNER_METRICS_PORT if metrics_port is None else metrics_port
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.wakeup = threading.Event()
+
+    def run(self, drain_timeout=None):
+        logger.info(f"runner agent {self.name} 启动: concurrency={self.concurrency}")
+        heartbeat = threading.Thread(target=self._heartbeat_loop, name='agent-heartbeat')
+        heartbeat.daemon = True
+        heartbeat.start()
+        if self.metrics_port:
+            if metrics.serve(Config.RUNNER_METRICS_BIND, self.metrics_port) is not None:
+                logger.info(f"runner 指标: http://{Config.RUNNER_METRICS_BIND}:{self.metrics_port}/metrics")
+            metrics.start_collector(Config.METRICS_COLLECT_INTERVAL)
+        if self.scheduler is not None:
+            self.scheduler.start()
+
+        next_reap = 0.0
+        while not self.stopping.is_set():
+            if self.parent is not None and os.getppid() != self.parent:
+                logger.error(f"父进程 {self.parent} 已退出，runner agent {self.name} 停止")
+                self.stop()
+                break
+            if time.monotonic() >= next_reap:
+                next_reap = time.monotonic() + max(1.0, Config.RUNNER_LEASE_SECONDS / 2)
+                try:
+                    run_queue.requeue_expired()
+                except Exception as e:
+                    logger.error(f"回收过期租约失败: {e}")
+            with self.lock:
+                free = self.concurrency - len(self.held)
+            claimed = []
+            if free > 0:
+                try:
+                    claimed = run_queue.claim(self.name, free)
+                except Exception as e:
+                    logger.error(f"领取运行失败: {e}")
+            for item in claimed:
+                self._start(item)
+            # 队列已空或已满载：等待轮询间隔，有运行结束时提前醒来
+            self.wakeup.wait(Config.RUNNER_POLL_INTERVAL)
+            self.wakeup.clear()
+
+        self._drain(drain_timeout)
+
+    def _start(self, item):
+        run_id = item['run_id']
+        plan = item['plan']
+        if not plan:
+            # 旧版本写入、没有执行计划的运行：按任务当前编排执行
+            plan = self._plan_from_task(item['task_id'])
+            if plan is None:
+                db_writer.update_run(run_id, status='failed', finished_at=datetime.utcnow())
+                return
+        with self.lock:
+            stale = run_id in self.held
+        if stale and not self._wait_stale(run_id):
+            return
+        with self.lock:
+            self.held.add(run_id)
+        db_writer.guard(run_id, self.name)
+        logger.info(f"{self.name} 领取运行 {run_id}（第 {item['attempts']} 次尝试）")
+        try:
+            self.service.start_run(run_id, plan, item['initial_context'], on_finish=self._on_finish)
+        except Exception as e:
+            logger.error(f"运行 {run_id} 启动失败: {e}")
+            db_writer.update_run(run_id, status='failed', finished_at=datetime.utcnow())
+            db_writer.unguard(run_id)
+            with self.lock:
+                self.held.discard(run_id)
+
+    def _wait_stale(self, run_id):
+        """租约过期后又被本 agent 领取：先中止仍在执行的上一次尝试，结束后才能重新执行；返回是否可以开始"""
+        logger.error(f"运行 {run_id} 的租约过期后被本 agent 重新领取，先中止上一次执行")
+        self.service.abort_run(run_id)
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            with self.lock:
+                if run_id not in self.held:
+                    return True
+            time.sleep(0.1)
+        try:
+            run_queue.release(self.name, {run_id})
+        except Exception as e:
+            logger.error(f"交还运行 {run_id} 失败，租约过期后将重新入队: {e}")
+        return False
+
+    def _plan_from_task(self, task_id):
+        from app.models.db import SessionLocal
+        from app.models.task_models import Task
+        session = SessionLocal()
+        try:
+            task = session.query(Task).filter(Task.id == task_id).first()
+            return self.service.build_plan(task) if task else None
+        except Exception as e:
+            logger.error(f"任务 {task_id} 的执行计划无效: {e}")
+            return None
+        finally:
+            session.close()
+
+    def _on_finish(self, run_id, status):
+        # 状态落库后再停止续约，避免租约过期时运行仍显示为 running 而被重复执行
+        db_writer.flush(timeout=Config.RUNNER_LEASE_SECONDS / 2)
+        db_writer.unguard(run_id)
+        with self.lock:
+            self.held.discard(run_id)
+        self.wakeup.set()
+
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(Config.RUNNER_HEARTBEAT_INTERVAL)
+            with self.lock:
+                run_ids = set(self.held)
+            if not run_ids:
+                continue
+            try:
+                lost = run_queue.heartbeat(self.name, run_ids)
+            except Exception as e:
+                logger.error(f"续约失败: {e}")
+                continue
+            for run_id in lost:
+                # 运行已被重新入队（可能已被其他节点领取并清理了未完成部分）或已标记失败：
+                # 继续执行会与新的执行交错写入，立即中止
+                logger.error(f"运行 {run_id} 的租约已被回收，中止本地执行")
+                self.service.abort_run(run_id)
+
+    def stop(self, *_):
+        if not self.stopping.is_set():
+            logger.info(f"runner agent {self.name} 停止领取新运行，等待已领取的运行结束")
+            if self.scheduler is not None:
+                self.scheduler.shutdown()
+        self.stopping.set()
+        self.wakeup.set()
+
+    def _drain(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.lock:
+                remaining = len(self.held)
+            if not remaining:
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                self._hand_off()
+                break
+            time.sleep(0.2)
+        db_writer.flush(timeout=Config.DB_WRITER_SHUTDOWN_TIMEOUT)
+        logger.info(f"runner agent {self.name} 已退出")
+
+    def _hand_off(self):
+        """drain 超时：终止脚本进程，把仍持有的运行交还队列，由其他 agent 或重启后的 agent 立即重新领取"""
+        with self.lock:
+            abandoned = set(self.held)
+        logger.warning(f"{len(abandoned)} 个运行未在超时前结束，交还队列重新执行: {sorted(abandoned)}")
+        # 脚本进程各自是独立进程组，不会随本进程退出，需要先终止，避免与重新执行的运行重叠
+        killed = proc_limits.kill_children()
+        if killed:
+            logger.warning(f"已终止 {killed} 个脚本进程")
+        # 脚本被终止后运行线程很快结束并写入失败状态，等其落库后再交还，避免交还后又被覆盖
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            with self.lock:
+                if not self.held:
+                    break
+            time.sleep(0.1)
+        db_writer.flush(timeout=Config.DB_WRITER_SHUTDOWN_TIMEOUT)
+        try:
+            released = run_queue.release(self.name, abandoned)
+        except Exception as e:
+            logger.error(f"交还运行失败，租约过期后将重新入队: {e}")
+            return
+        if released:
+            logger.warning(f"已交还 {len(released)} 个运行: {released}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--name', help='agent 名称，默认 主机名:pid')
+    parser.add_argument('--concurrency', type=int, default=Config.MAX_TASK_WORKERS, help='同时执行的运行数')
+    parser.add_argument('--drain-timeout', type=float, default=None,
+                        help='停止时等待已领取运行结束的最长秒数，默认一直等待')
+    parser.add_argument('--scheduler', action='store_true', help='同时运行定时触发线程（同一数据库只应有一个）')
+    parser.add_argument('--exit-with-parent', action='store_true', help='父进程退出后停止领取并退出')
+    parser.add_argument('--metrics-port', type=int, default=Config.RUNNER_METRICS_PORT,
+                        help='输出进程内指标的端口，0 为不监听')
+    args = parser.parse_args(argv)
+
+    agent = RunnerAgent(args.name, args.concurrency, scheduler=args.scheduler,
+                        exit_with_parent=args.exit_with_parent, metrics_port=args.metrics_port)
+    signal.signal(signal.SIGTERM, agent.stop)
+    signal.signal(signal.SIGINT, agent.stop)
+    agent.run(args.drain_timeout)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
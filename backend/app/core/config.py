@@ -7,19 +7,124 @@ class Config:
     DEBUG = os.getenv('FLASK_DEBUG', False)
     TESTING = os.getenv('FLASK_TESTING', False)
     SECRET_KEY = os.getenv('SECRET_KEY', 'dev-secret-key-change-in-production')
+    AUTH_TOKEN_CACHE_SIZE = int(os.getenv('AUTH_TOKEN_CACHE_SIZE', '1024'))  # 缓存的已验证 token / 用户数，0 为不缓存
+    AUTH_USER_CACHE_TTL = int(os.getenv('AUTH_USER_CACHE_TTL', '60'))  # 用户信息缓存有效期（秒），其他进程修改用户时的最长延迟
     
     # 任务配置
     TASKS_DIR = os.getenv('TASKS_DIR', '/workspaces/TaskRunService/tasks')
     LOGS_DIR = os.getenv('LOGS_DIR', '/workspaces/TaskRunService/logs')
     MAX_TASK_WORKERS = int(os.getenv('MAX_TASK_WORKERS', '5'))
+    MAX_PENDING_RUNS = int(os.getenv('MAX_PENDING_RUNS', '100'))  # 待执行队列最大长度，超出返回 429
     TASK_TIMEOUT = int(os.getenv('TASK_TIMEOUT', '3600'))  # 1小时
+    TASK_PARALLELISM = int(os.getenv('TASK_PARALLELISM', '4'))  # 单个运行内最多并行执行的脚本数（任务未指定时）
+    TASK_MERGE_POLICY = os.getenv('TASK_MERGE_POLICY', 'order')  # 并行分支上下文冲突策略：order / last / error
+    PAGE_SIZE = int(os.getenv('PAGE_SIZE', '100'))  # 列表接口默认每页条数（运行记录）
+    MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', '1000'))  # 列表接口 limit 上限
+
+    # 脚本结果缓存（按脚本开启，见 Script.cache_ttl）
+    RESULT_CACHE_ENABLED = os.getenv('RESULT_CACHE_ENABLED', '1').lower() in ('1', 'true', 'yes')
+    RESULT_CACHE_DEFAULT_TTL = int(os.getenv('RESULT_CACHE_DEFAULT_TTL', '86400'))  # 脚本只写 cache: true 时的有效期（秒）
+    RESULT_CACHE_MAX_ENTRIES = int(os.getenv('RESULT_CACHE_MAX_ENTRIES', '1000'))
+    RESULT_CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+    RESULT_CACHE_MAX_ENTRY_BYTES = int(os.getenv('RESULT_CACHE_MAX_ENTRY_BYTES', str(8 * 1024 * 1024)))  # 日志超过该大小的执行不缓存
+
+    # 按需剖析（执行时传 profile: cprofile / sampling），采样模式的采样间隔（秒）
+    PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0.005'))
+    PROFILE_TOP_N = int(os.getenv('PROFILE_TOP_N', '20'))  # 热点函数接口默认返回的条数
+
+    # 运行心跳与崩溃恢复：本进程执行中的运行定期写入 heartbeat_at，超时未更新的视为进程已退出
+    RUN_HEARTBEAT_INTERVAL = float(os.getenv('RUN_HEARTBEAT_INTERVAL', '15'))
+    RUN_HEARTBEAT_TIMEOUT = float(os.getenv('RUN_HEARTBEAT_TIMEOUT', '60'))
+    # 孤儿运行标记为 interrupted 后，是否自动从最后一个完成的脚本之后继续执行
+    RUN_RESUME_ON_RECOVERY = os.getenv('RUN_RESUME_ON_RECOVERY', '0').lower() in ('1', 'true', 'yes')
+
+    # 运行模式：local 在 API 进程内执行；queue 只写入数据库队列，由 runner agent（python -m app.agent）领取执行
+    RUN_MODE = os.getenv('RUN_MODE', 'local').lower()
+    RUNNER_LEASE_SECONDS = int(os.getenv('RUNNER_LEASE_SECONDS', '30'))  # 领取租约时长，超时未续约的运行重新入队
+    RUNNER_HEARTBEAT_INTERVAL = float(os.getenv('RUNNER_HEARTBEAT_INTERVAL', '10'))  # agent 续约间隔（秒）
+    RUNNER_POLL_INTERVAL = float(os.getenv('RUNNER_POLL_INTERVAL', '1.0'))  # 队列为空时的轮询间隔（秒）
+    RUNNER_MAX_ATTEMPTS = int(os.getenv('RUNNER_MAX_ATTEMPTS', '3'))  # 租约过期重新入队的次数上限，超出标记失败
+    RUNNER_DRAIN_TIMEOUT = float(os.getenv('RUNNER_DRAIN_TIMEOUT', '300'))  # 生产部署停止时等待执行中运行结束的最长秒数
+    RUNNER_LOG_SHIP_INTERVAL = float(os.getenv('RUNNER_LOG_SHIP_INTERVAL', '2.0'))  # agent 上报日志块的间隔（秒）
+    RUNNER_METRICS_PORT = int(os.getenv('RUNNER_METRICS_PORT', '9101'))  # agent 输出进程内指标的端口，0 为不监听
+    RUNNER_METRICS_BIND = os.getenv('RUNNER_METRICS_BIND', '127.0.0.1')  # 指标端口的监听地址
+
+    # 定时触发配置
+    SCHEDULER_ENABLED = os.getenv('SCHEDULER_ENABLED', '1').lower() in ('1', 'true', 'yes')
+    SCHEDULER_TIMEZONE = os.getenv('SCHEDULER_TIMEZONE', 'UTC')  # cron 表达式的默认时区
+    SCHEDULE_MISFIRE_GRACE = int(os.getenv('SCHEDULE_MISFIRE_GRACE', '60'))  # 晚于计划时间超过该秒数视为错过
+    SCHEDULE_RELOAD_INTERVAL = int(os.getenv('SCHEDULE_RELOAD_INTERVAL', '30'))  # 从数据库同步定时配置的间隔（秒）
+
+    # 预热进程池配置（脚本复用预先 fork 并已导入常用模块的工作进程）
+    WARM_POOL_ENABLED = os.getenv('WARM_POOL_ENABLED', '0').lower() in ('1', 'true', 'yes')
+    WARM_POOL_SIZE = int(os.getenv('WARM_POOL_SIZE', os.getenv('MAX_TASK_WORKERS', '5')))
+    WARM_POOL_PRELOAD = [m.strip() for m in os.getenv('WARM_POOL_PRELOAD', '').split(',') if m.strip()]
+    WARM_POOL_MAX_JOBS = int(os.getenv('WARM_POOL_MAX_JOBS', '100'))  # 执行 N 个任务后回收
+    WARM_POOL_MAX_RSS_MB = int(os.getenv('WARM_POOL_MAX_RSS_MB', '512'))  # 常驻内存超过阈值后回收
+
+    # 脚本资源限制（0 / 空为不限制）：rlimit 在执行脚本的进程内设置，超出时脚本被终止或分配失败
+    SCRIPT_CPU_LIMIT = int(os.getenv('SCRIPT_CPU_LIMIT', '0'))  # 每个脚本的 CPU 时间上限（秒），超出时收到 SIGXCPU
+    SCRIPT_MEMORY_LIMIT_MB = int(os.getenv('SCRIPT_MEMORY_LIMIT_MB', '0'))  # 无 cgroup 时为地址空间上限，有 cgroup 时为 memory.max
+    SCRIPT_NOFILE_LIMIT = int(os.getenv('SCRIPT_NOFILE_LIMIT', '0'))  # 打开文件数上限
+    # cgroup v2（可选）：委派给本服务、已在 cgroup.subtree_control 启用 memory/cpu/pids 的目录
+    SCRIPT_CGROUP_ROOT = os.getenv('SCRIPT_CGROUP_ROOT', '')
+    SCRIPT_CGROUP_CPUS = float(os.getenv('SCRIPT_CGROUP_CPUS', '0'))  # 每个脚本进程树可用的 CPU 核数（cpu.max）
+    SCRIPT_PIDS_LIMIT = int(os.getenv('SCRIPT_PIDS_LIMIT', '0'))  # 每个脚本进程树的进程数上限（pids.max，需 cgroup）
     
+    # 数据库配置
+    TASK_DB_PATH = os.getenv('TASK_DB_PATH', f"sqlite:///{os.path.abspath(os.path.join(os.path.dirname(__file__), '../../db/taskrun.db'))}")
+    DB_ECHO = os.getenv('DB_ECHO', '0').lower() in ('1', 'true', 'yes')  # 打印所有 SQL，仅用于调试
+    DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+    DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '20'))
+    DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', '30'))  # 等待空闲连接的秒数
+    DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))  # 连接最长存活秒数（PostgreSQL）
+    DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', '1').lower() in ('1', 'true', 'yes')
+    SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+    SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+    SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))  # 写锁冲突时的等待时间
+    DB_WRITER_MAX_PENDING = int(os.getenv('DB_WRITER_MAX_PENDING', '10000'))  # 运行状态异步写入的待写上限，超出时阻塞提交方
+    DB_WRITER_BATCH_SIZE = int(os.getenv('DB_WRITER_BATCH_SIZE', '500'))  # 每个事务最多写入的条目数
+    DB_WRITER_FLUSH_INTERVAL = float(os.getenv('DB_WRITER_FLUSH_INTERVAL', '0.2'))  # 攒批间隔（秒）
+    DB_WRITER_MAX_RETRIES = int(os.getenv('DB_WRITER_MAX_RETRIES', '3'))
+    DB_WRITER_SHUTDOWN_TIMEOUT = float(os.getenv('DB_WRITER_SHUTDOWN_TIMEOUT', '30'))  # 退出时等待剩余写入的秒数
+
+    # 运行记录存储：db 为日志压缩分块 + 上下文行写入数据库，运行结束后删除运行目录；files 为保留 LOGS_DIR/run_<id>/ 下的文件
+    RUN_STORAGE = os.getenv('RUN_STORAGE', 'db').lower()
+    RUN_LOG_CHUNK_BYTES = int(os.getenv('RUN_LOG_CHUNK_BYTES', str(256 * 1024)))  # 每个日志块的原始大小上限
+    RUN_LOG_CODEC = os.getenv('RUN_LOG_CODEC', 'zstd').lower()  # zstd（需安装 zstandard，否则回退 gzip）/ gzip / none
+
+    # 运行追踪：各阶段的 span 随运行记录存储（db 为 task_run_spans 表，files 为运行目录下的 trace.jsonl）
+    TRACE_ENABLED = os.getenv('TRACE_ENABLED', '1').lower() in ('1', 'true', 'yes')
+    TRACE_MAX_SPANS = int(os.getenv('TRACE_MAX_SPANS', '10000'))  # 单个运行 / 单个脚本进程记录的 span 上限
+
     # 日志配置
     LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
     LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    LOG_BATCH_MAX_LINES = int(os.getenv('LOG_BATCH_MAX_LINES', '200'))  # 脚本侧日志攒批行数阈值
+    LOG_BATCH_INTERVAL = float(os.getenv('LOG_BATCH_INTERVAL', '0.2'))  # 脚本侧日志攒批时间阈值（秒）
+    LOG_FSYNC_INTERVAL = float(os.getenv('LOG_FSYNC_INTERVAL', '1.0'))  # 脚本日志文件 fsync 间隔（秒）
+    LOG_TAIL_LINES = int(os.getenv('LOG_TAIL_LINES', '1000'))  # 每个脚本在内存中保留的最近日志行数
+    LOG_STREAM_BUFFER_BYTES = int(os.getenv('LOG_STREAM_BUFFER_BYTES', str(1024 * 1024)))  # 每个活跃运行的实时日志扇出缓冲
+    LOG_STREAM_HEARTBEAT = int(os.getenv('LOG_STREAM_HEARTBEAT', '15'))  # 实时日志流空闲心跳间隔（秒）
+    METRICS_COLLECT_INTERVAL = float(os.getenv('METRICS_COLLECT_INTERVAL', '5'))  # 队列深度 / 日志速率等仪表的后台采样间隔（秒）
+    METRICS_PUBLIC = os.getenv('METRICS_PUBLIC', '0').lower() in ('1', 'true', 'yes')  # /api/system/metrics 免鉴权，供 Prometheus 抓取
+    LOG_READ_MAX_BYTES = int(os.getenv('LOG_READ_MAX_BYTES', str(1024 * 1024)))  # 日志接口单次返回的最大字节数
+    APP_LOG_MAX_MB = int(os.getenv('APP_LOG_MAX_MB', '50'))  # app.log 超过该大小时轮转，0 为不轮转
+    APP_LOG_BACKUP_COUNT = int(os.getenv('APP_LOG_BACKUP_COUNT', '5'))  # 保留的 app.log.N 个数
+
+    # LOGS_DIR 保留策略（后台线程，见 app.core.log_retention），数值为 0 时不启用对应策略
+    LOG_RETENTION_ENABLED = os.getenv('LOG_RETENTION_ENABLED', '1').lower() in ('1', 'true', 'yes')
+    LOG_RETENTION_INTERVAL = float(os.getenv('LOG_RETENTION_INTERVAL', '3600'))  # 清理间隔（秒）
+    LOG_ARCHIVE_AFTER_HOURS = float(os.getenv('LOG_ARCHIVE_AFTER_HOURS', '24'))  # 结束超过该时长的运行目录打包进按天归档
+    LOG_RETENTION_DAYS = float(os.getenv('LOG_RETENTION_DAYS', '0'))  # 删除结束超过该天数的运行日志与归档
+    LOG_RETENTION_PER_TASK = int(os.getenv('LOG_RETENTION_PER_TASK', '0'))  # 每个任务只保留最近 N 个运行的日志
+    LOG_RETENTION_MAX_MB = int(os.getenv('LOG_RETENTION_MAX_MB', '0'))  # 运行目录 + 归档 + 旧版日志的总占用上限
+    LOG_RETENTION_IO_MB = float(os.getenv('LOG_RETENTION_IO_MB', '20'))  # 打包 / 合并时的读写速率上限（MB/s）
+    LOG_RETENTION_BATCH = int(os.getenv('LOG_RETENTION_BATCH', '500'))  # 每轮最多打包的运行目录数
     
     # 进程管理配置
-    PROCESS_CHECK_INTERVAL = int(os.getenv('PROCESS_CHECK_INTERVAL', '10'))
+    PROCESS_CHECK_INTERVAL = float(os.getenv('PROCESS_CHECK_INTERVAL', '10'))  # 系统 / 进程资源的后台采样间隔（秒）
+    PROCESS_SAMPLE_HISTORY = int(os.getenv('PROCESS_SAMPLE_HISTORY', '360'))  # 环形缓冲保留的采样点数（默认 1 小时）
     
     @staticmethod
     def init_directories():
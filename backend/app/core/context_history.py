@@ -0,0 +1,126 @@
+"""运行上下文历史的增量编码。
+
+每个脚本结束后只记录相对上一条记录的键级增量 {'set': {...}, 'unset': [...]}（见 context_delta），
+以运行的 initial_context 为起点按写入顺序依次应用，即可还原任意脚本执行后的上下文。
+带完整 context 的条目作为新的起点：旧版本写入的快照、恢复执行后的第一条、以及删除中间条目后紧随其后的一条。
+
+条目格式：{'position', 'script', 'delta' 或 'context', 'created_at'}。
+数据库存储时每个条目为一行 TaskRunContext；files 存储时按行追加到运行目录的 contexts.jsonl。
+"""
+import os
+import json
+from datetime import datetime
+
+CONTEXT_LOG = 'contexts.jsonl'
+
+
+def context_delta(before, after):
+    """脚本对上下文的增量：新增 / 修改的键与被删除的键"""
+    return {
+        'set': {k: v for k, v in after.items() if k not in before or before[k] != v},
+        'unset': sorted(k for k in before if k not in after),
+    }
+
+
+def apply_delta(context, delta):
+    result = dict(context)
+    result.update(delta.get('set') or {})
+    for key in delta.get('unset') or ():
+        result.pop(key, None)
+    return result
+
+
+def dumps(obj):
+    """紧凑的 JSON 序列化（无缩进、无多余空格、不转义非 ASCII 字符）"""
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+
+def make_entry(position, script, before, after, full=False):
+    """脚本执行后的历史条目；full 时记录完整上下文，否则只记录相对 before 的增量"""
+    entry = {'position': position, 'script': script, 'created_at': datetime.utcnow().isoformat()}
+    if full:
+        entry['context'] = after
+    else:
+        entry['delta'] = context_delta(before, after)
+    return entry
+
+
+def materialize(initial, entries):
+    """按顺序产出 (条目, 该条目之后的完整上下文)"""
+    current = dict(initial or {})
+    for entry in entries:
+        if entry.get('context') is not None:
+            current = dict(entry['context'])
+        else:
+            current = apply_delta(current, entry.get('delta') or {})
+        yield entry, current
+
+
+def latest(initial, entries):
+    """最后一个条目之后的上下文，没有条目时返回 None"""
+    result = None
+    for _, result in materialize(initial, entries):
+        pass
+    return result
+
+
+def drop(initial, entries, keep_positions):
+    """只保留 position 在 keep_positions 中的条目。
+
+    被删条目之后保留下来的第一条改写为完整快照，其余保留条目的增量仍相对其前一条有效。
+    返回 (保留的条目, 改写为完整快照的条目)。
+    """
+    kept, rebased = [], []
+    gap = False
+    for entry, snapshot in materialize(initial, entries):
+        if entry.get('position') not in keep_positions:
+            gap = True
+            continue
+        if gap and entry.get('context') is None:
+            entry = {k: v for k, v in entry.items() if k != 'delta'}
+            entry['context'] = snapshot
+            rebased.append(entry)
+        gap = False
+        kept.append(entry)
+    return kept, rebased
+
+
+def log_path(run_dir):
+    return os.path.join(run_dir, CONTEXT_LOG)
+
+
+def append_file(run_dir, entry):
+    with open(log_path(run_dir), 'a', encoding='utf-8') as f:
+        f.write(dumps(entry) + '\n')
+
+
+def parse_lines(lines):
+    """解析 contexts.jsonl 的内容；最后一行写到一半（进程中途退出）时忽略"""
+    entries = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            entries.append(json.loads(line))
+        except ValueError:
+            continue
+    return entries
+
+
+def read_file(run_dir):
+    """运行目录中的历史条目，没有 contexts.jsonl 时返回 None"""
+    try:
+        with open(log_path(run_dir), 'r', encoding='utf-8') as f:
+            return parse_lines(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_file(run_dir, entries):
+    path = log_path(run_dir)
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        for entry in entries:
+            f.write(dumps(entry) + '\n')
+    os.replace(tmp, path)
@@ -0,0 +1,144 @@
+"""编排任务的脚本依赖图（DAG）。
+
+Script.depends_on 为依赖的脚本文件名列表；为 None 时依赖上一个脚本（按 order），
+与原来的顺序执行完全一致；为空列表时是根节点，可以与其他分支并行。
+"""
+
+MERGE_POLICIES = ('order', 'last', 'error')
+
+
+class DagError(ValueError):
+    """依赖声明不合法：引用了不存在 / 重名的脚本，或存在环"""
+
+
+def normalize_scripts(items):
+    """接口传入的脚本列表 -> [(filename, depends_on)]。
+
+    每项可以是文件名字符串（依赖上一个脚本），或 {'filename', 'depends_on'}；
+    depends_on 中可以写文件名或脚本下标，统一转换为文件名。
+    """
+    entries = []
+    for item in items or []:
+        if isinstance(item, dict):
+            filename = item.get('filename') or item.get('name')
+            depends_on = item.get('depends_on')
+        else:
+            filename, depends_on = item, None
+        if not filename or not isinstance(filename, str):
+            raise DagError(f"无效的脚本项: {item}")
+        if depends_on is not None and not isinstance(depends_on, (list, tuple)):
+            raise DagError(f"{filename} 的 depends_on 必须是列表")
+        entries.append((filename, None if depends_on is None else list(depends_on)))
+
+    filenames = [f for f, _ in entries]
+    result = []
+    for filename, depends_on in entries:
+        if depends_on is not None:
+            names = []
+            for dep in depends_on:
+                if isinstance(dep, int) and not isinstance(dep, bool):
+                    if not 0 <= dep < len(filenames):
+                        raise DagError(f"{filename} 依赖的脚本下标越界: {dep}")
+                    dep = filenames[dep]
+                names.append(dep)
+            depends_on = names
+        result.append((filename, depends_on))
+    resolve(result)
+    return result
+
+
+def resolve(scripts):
+    """[(filename, depends_on)] -> 每个节点依赖的下标集合列表，同时校验引用与环"""
+    filenames = [f for f, _ in scripts]
+    index = {}
+    for i, name in enumerate(filenames):
+        index.setdefault(name, []).append(i)
+
+    deps = []
+    for i, (filename, depends_on) in enumerate(scripts):
+        if depends_on is None:
+            deps.append({i - 1} if i > 0 else set())
+            continue
+        node_deps = set()
+        for dep in depends_on:
+            if dep not in index:
+                raise DagError(f"{filename} 依赖的脚本不存在: {dep}")
+            if len(index[dep]) > 1:
+                raise DagError(f"{filename} 依赖的脚本在任务中出现多次，无法确定: {dep}")
+            if index[dep][0] == i:
+                raise DagError(f"{filename} 不能依赖自身")
+            node_deps.add(index[dep][0])
+        deps.append(node_deps)
+
+    topo_order(deps)
+    return deps
+
+
+def topo_order(deps):
+    """Kahn 拓扑排序，同层按下标升序；存在环时抛出 DagError"""
+    remaining = {i: set(d) for i, d in enumerate(deps)}
+    order = []
+    while remaining:
+        ready = sorted(i for i, d in remaining.items() if not d)
+        if not ready:
+            raise DagError(f"脚本依赖存在环: {sorted(remaining)}")
+        for i in ready:
+            order.append(i)
+            del remaining[i]
+        for d in remaining.values():
+            d.difference_update(ready)
+    return order
+
+
+def ancestors(deps):
+    """每个节点的全部祖先下标集合"""
+    result = [set() for _ in deps]
+    for i in topo_order(deps):
+        for d in deps[i]:
+            result[i] |= {d} | result[d]
+    return result
+
+
+_DELETED = object()
+
+
+class ContextMerger:
+    """合并各节点回写的上下文。
+
+    节点启动时拿到当前合并结果的快照，结束后按与快照的差异回写。
+    若某个键最近一次由并发分支（非祖先节点）写入，则视为冲突，按策略处理：
+      order  保留声明顺序（order）靠后的脚本的值，结果与并行度无关
+      last   后完成的节点覆盖
+      error  不写入该键并报告冲突，由调用方将运行标记为失败
+    """
+
+    def __init__(self, initial, policy, deps):
+        if policy not in MERGE_POLICIES:
+            raise DagError(f"未知的上下文合并策略: {policy}")
+        self.context = dict(initial or {})
+        self.policy = policy
+        self.ancestors = ancestors(deps)
+        self.writers = {}  # key -> 最近写入该键的节点下标
+
+    def snapshot(self):
+        return dict(self.context)
+
+    def apply(self, node, before, after):
+        """合并节点的回写，返回冲突的键列表"""
+        changes = {k: v for k, v in after.items() if k not in before or before[k] != v}
+        changes.update({k: _DELETED for k in before if k not in after})
+        conflicts = []
+        for key, value in changes.items():
+            writer = self.writers.get(key)
+            if writer is not None and writer not in self.ancestors[node]:
+                current = self.context.get(key, _DELETED)
+                if current is not value and current != value:
+                    conflicts.append(key)
+                    if self.policy == 'error' or (self.policy == 'order' and writer > node):
+                        continue
+            if value is _DELETED:
+                self.context.pop(key, None)
+            else:
+                self.context[key] = value
+            self.writers[key] = node
+        return conflicts
@@ -0,0 +1,316 @@
+"""运行状态的异步写入器（write-behind）。
+
+运行线程只把状态变更、脚本耗时和上下文更新交给这里，不再自己持有数据库连接；
+写入线程把同一运行 / 同一脚本的多次更新合并成一条，再按批在一个事务中提交；
+整批重试耗尽时逐个运行单独提交，只放弃写入失败的运行。
+待写条目数有上限，超出时提交方阻塞等待（背压）；进程退出前会把剩余的写入全部落库。
+
+runner agent 执行的运行用 guard() 登记持有者：其写入只在 TaskRun 仍由该 agent 持有
+（claimed_by 相同且租约未被回收）时落库，失去租约后用 abandon() 丢弃该运行尚未落库与此后的写入。
+"""
+import time
+import atexit
+import threading
+from sqlalchemy import insert
+from app.core.config import Config
+from app.utils import metrics
+from app.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+WRITER_PENDING = metrics.gauge('db_writer_pending', '等待写入数据库的条目数（合并后）')
+WRITER_COALESCED = metrics.counter('db_writer_coalesced_total', '被合并到已有待写条目中的更新数')
+WRITER_BATCHES = metrics.counter('db_writer_batches_total', '提交的写入批次数', labels=('outcome',))
+WRITER_BATCH_SIZE = metrics.histogram('db_writer_batch_rows', '每批写入的条目数',
+                                      buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+WRITER_COMMIT = metrics.histogram('db_writer_commit_seconds', '每批写入的事务耗时')
+
+
+class DBWriter:
+    """合并 + 攒批的运行状态写入器"""
+
+    def __init__(self, max_pending=None, batch_size=None, interval=None, max_retries=None):
+        self.max_pending = max(1, max_pending or Config.DB_WRITER_MAX_PENDING)
+        self.batch_size = max(1, batch_size or Config.DB_WRITER_BATCH_SIZE)
+        self.interval = Config.DB_WRITER_FLUSH_INTERVAL if interval is None else interval
+        self.max_retries = Config.DB_WRITER_MAX_RETRIES if max_retries is None else max_retries
+        self.cond = threading.Condition()
+        self.runs = {}   # run_id -> {列: 值}
+        self.steps = {}  # (run_id, position) -> {列: 值}
+        self.inserts = []  # [(模型, {列: 值})]，只追加不合并（日志块、上下文快照）
+        self.owners = {}  # run_id -> 持有该运行租约的 agent（见 guard）
+        self.abandoned = set()  # 已失去租约、写入一律丢弃的 run_id
+        self.submitted = 0  # 已接收的更新序号
+        self.written = 0    # 已落库（或放弃）的更新序号
+        self.last_dropped = 0  # 最近一次放弃的批次覆盖到的序号
+        self._flush_requested = False
+        self._closed = False
+        self._thread = None
+        atexit.register(self.shutdown)
+
+    def update_run(self, run_id, **fields):
+        """更新 TaskRun 的列；同一运行尚未落库的多次更新合并为一次"""
+        self._put(self.runs, run_id, fields)
+
+    def update_step(self, run_id, position, **fields):
+        """插入或更新 TaskRunStep（按 run_id + position 定位）"""
+        self._put(self.steps, (run_id, position), fields)
+
+    def insert(self, model, **fields):
+        """追加一行（不与其他写入合并）"""
+        self._put(self.inserts, model, fields)
+
+    def guard(self, run_id, owner):
+        """此后 run_id 的写入只在 TaskRun 仍由 owner 持有（claimed_by 相同且租约未被回收）时落库"""
+        with self.cond:
+            self.owners[run_id] = owner
+            self.abandoned.discard(run_id)
+
+    def unguard(self, run_id):
+        with self.cond:
+            self.owners.pop(run_id, None)
+            self.abandoned.discard(run_id)
+
+    def abandon(self, run_id):
+        """丢弃 run_id 尚未落库的写入，并忽略此后的写入（直到 unguard / guard），返回丢弃的条目数"""
+        with self.cond:
+            self.abandoned.add(run_id)
+            before = self._size()
+            self.runs.pop(run_id, None)
+            for key in [key for key in self.steps if key[0] == run_id]:
+                del self.steps[key]
+            self.inserts = [(model, fields) for model, fields in self.inserts if fields.get('run_id') != run_id]
+            dropped = before - self._size()
+            WRITER_PENDING.set(self._size())
+            # 腾出了空间，唤醒被背压阻塞的提交方
+            self.cond.notify_all()
+        if dropped:
+            logger.warning(f"运行 {run_id} 已失去租约，丢弃 {dropped} 条尚未落库的写入")
+        return dropped
+
+    def mark(self):
+        """当前已接收的序号，配合 flush(since=...) 判断其后的写入是否全部成功"""
+        with self.cond:
+            return self.submitted
+
+    def _put(self, table, key, fields):
+        with self.cond:
+            if self.abandoned and _run_of(table is self.runs, table is self.steps, key, fields) in self.abandoned:
+                return
+            self._ensure_started()
+            while (table is self.inserts or key not in table) and self._size() >= self.max_pending \
+                    and not self._closed:
+                self.cond.wait()
+            if self._closed:
+                # 已关闭（进程退出中）：直接同步写入，保证不丢
+                self._write_with_retry({key: fields} if table is self.runs else {},
+                                       {key: fields} if table is self.steps else {},
+                                       [(key, fields)] if table is self.inserts else [],
+                                       dict(self.owners))
+                return
+            if table is self.inserts:
+                table.append((key, dict(fields)))
+            elif key in table:
+                table[key].update(fields)
+                WRITER_COALESCED.inc()
+            else:
+                table[key] = dict(fields)
+            self.submitted += 1
+            WRITER_PENDING.set(self._size())
+            if self._size() >= self.batch_size:
+                self.cond.notify_all()
+
+    def _size(self):
+        return len(self.runs) + len(self.steps) + len(self.inserts)
+
+    def _ensure_started(self):
+        if self._thread is None and not self._closed:
+            self._thread = threading.Thread(target=self._loop, name='db-writer')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def flush(self, timeout=None, since=None):
+        """等待调用前提交的所有更新落库；返回是否在超时前完成。
+
+        since 为 mark() 的返回值时，若其后有批次因重试耗尽被放弃也返回 False。
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            target = self.submitted
+            if self.written >= target:
+                return since is None or self.last_dropped <= since
+            if self._thread is None or not self._thread.is_alive():
+                return False
+            self._flush_requested = True
+            self.cond.notify_all()
+            while self.written < target:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+            return since is None or self.last_dropped <= since
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                while not self._size() and not self._closed:
+                    self.cond.wait()
+                if not self._size() and self._closed:
+                    return
+                # 等待一个攒批间隔，期间达到批量、请求 flush 或关闭时立即写入
+                deadline = time.monotonic() + self.interval
+                while (self._size() < self.batch_size and not self._flush_requested
+                       and not self._closed):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                runs, self.runs = self.runs, {}
+                steps, self.steps = self.steps, {}
+                inserts, self.inserts = self.inserts, []
+                owners = dict(self.owners)
+                target = self.submitted
+                self._flush_requested = False
+                WRITER_PENDING.set(0)
+                # 腾出了空间，唤醒被背压阻塞的提交方
+                self.cond.notify_all()
+
+            ok = self._write_with_retry(runs, steps, inserts, owners)
+
+            with self.cond:
+                if not ok:
+                    self.last_dropped = target
+                self.written = max(self.written, target)
+                self.cond.notify_all()
+
+    def _write_with_retry(self, runs, steps, inserts=(), owners=None):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self._write(runs, steps, inserts, owners)
+                WRITER_BATCHES.labels(outcome='ok').inc()
+                return True
+            except Exception as e:
+                if attempt >= self.max_retries:
+                    return self._write_per_run(runs, steps, inserts, owners, e)
+                WRITER_BATCHES.labels(outcome='retry').inc()
+                logger.warning(f"运行状态写入失败，重试 {attempt + 1}/{self.max_retries}: {e}")
+                time.sleep(min(2.0, 0.2 * (attempt + 1)))
+
+    def _write_per_run(self, runs, steps, inserts, owners, error):
+        """整批重试耗尽：逐个运行单独提交，避免一条坏数据（如已被删除的运行的日志块）连累同批的其他运行"""
+        groups = {}
+        for run_id, fields in runs.items():
+            groups.setdefault(run_id, ({}, {}, []))[0][run_id] = fields
+        for key, fields in steps.items():
+            groups.setdefault(key[0], ({}, {}, []))[1][key] = fields
+        for model, fields in inserts:
+            groups.setdefault(fields.get('run_id'), ({}, {}, []))[2].append((model, fields))
+        if len(groups) <= 1:
+            WRITER_BATCHES.labels(outcome='dropped').inc()
+            logger.error(f"运行状态写入失败，放弃 {len(runs) + len(steps) + len(inserts)} 条: {error}")
+            return False
+        ok = True
+        for run_id, (group_runs, group_steps, group_inserts) in groups.items():
+            try:
+                self._write(group_runs, group_steps, group_inserts, owners)
+            except Exception as e:
+                ok = False
+                WRITER_BATCHES.labels(outcome='dropped').inc()
+                logger.error(f"运行 {run_id} 的状态写入失败，放弃 "
+                             f"{len(group_runs) + len(group_steps) + len(group_inserts)} 条: {e}")
+        WRITER_BATCHES.labels(outcome='split').inc()
+        return ok
+
+    def _write(self, runs, steps, inserts=(), owners=None):
+        """在一个事务里写入一批合并后的更新；owners 中登记了持有者的运行已失去租约时丢弃其写入"""
+        if not runs and not steps and not inserts:
+            return
+        # 延迟导入，避免模型 / 引擎与本模块的循环依赖
+        from app.models.db import SessionLocal
+        from app.models.task_models import TaskRun, TaskRunStep
+
+        started = time.perf_counter()
+        session = SessionLocal()
+        try:
+            guarded = {run_id: owner for run_id, owner in (owners or {}).items()
+                       if run_id in runs or any(key[0] == run_id for key in steps)
+                       or any(fields.get('run_id') == run_id for _, fields in inserts)}
+            if guarded:
+                held = {row.id for row in session.query(TaskRun.id, TaskRun.claimed_by)
+                        .filter(TaskRun.id.in_(list(guarded)), TaskRun.lease_expires_at.isnot(None))
+                        if row.claimed_by == guarded[row.id]}
+                lost = set(guarded) - held
+                if lost:
+                    logger.warning(f"运行 {sorted(lost)} 已不再由本节点持有，丢弃其写入")
+                    runs = {k: v for k, v in runs.items() if k not in lost}
+                    steps = {k: v for k, v in steps.items() if k[0] not in lost}
+                    inserts = [(m, f) for m, f in inserts if f.get('run_id') not in lost]
+            if steps:
+                run_ids = {run_id for run_id, _ in steps}
+                existing = {
+                    (s.run_id, s.position): s
+                    for s in session.query(TaskRunStep).filter(TaskRunStep.run_id.in_(run_ids))
+                }
+                for (run_id, position), fields in steps.items():
+                    step = existing.get((run_id, position))
+                    if step is None:
+                        session.add(TaskRunStep(run_id=run_id, position=position, **fields))
+                    else:
+                        for k, v in fields.items():
+                            setattr(step, k, v)
+            if inserts:
+                by_model = {}
+                for model, fields in inserts:
+                    by_model.setdefault(model, []).append(fields)
+                for model, rows in by_model.items():
+                    session.execute(insert(model), rows)
+            for run_id, fields in runs.items():
+                query = session.query(TaskRun).filter(TaskRun.id == run_id)
+                if run_id in guarded:
+                    # 与上面的检查在同一事务中，租约在两者之间被回收时状态也不会被覆盖
+                    query = query.filter(TaskRun.claimed_by == guarded[run_id], TaskRun.lease_expires_at.isnot(None))
+                query.update(fields, synchronize_session=False)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        WRITER_COMMIT.observe(time.perf_counter() - started)
+        WRITER_BATCH_SIZE.observe(len(runs) + len(steps) + len(inserts))
+
+    def stats(self):
+        with self.cond:
+            return {
+                'pending': self._size(),
+                'max_pending': self.max_pending,
+                'batch_size': self.batch_size,
+                'interval': self.interval,
+                'submitted': self.submitted,
+                'written': self.written,
+            }
+
+    def shutdown(self, timeout=None):
+        """停止写入线程，退出前把剩余更新全部落库"""
+        with self.cond:
+            if self._closed:
+                return
+            self._closed = True
+            self.cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(Config.DB_WRITER_SHUTDOWN_TIMEOUT if timeout is None else timeout)
+            if thread.is_alive():
+                logger.error("运行状态写入线程未能在超时前退出，部分更新可能丢失")
+
+
+def _run_of(is_run, is_step, key, fields):
+    """写入条目所属的 run_id"""
+    if is_run:
+        return key
+    if is_step:
+        return key[0]
+    return fields.get('run_id')
+
+
+db_writer = DBWriter()
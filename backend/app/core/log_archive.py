@@ -0,0 +1,412 @@
+"""LOGS_DIR 中运行目录的按天归档。
+
+已结束较久的运行目录（run_<id>/ 下的 *.log、contexts.jsonl、剖析结果等）按运行的结束日期（UTC）打包进
+LOGS_DIR/archive/<日期>.<序号>.zip。每次打包写一个新分片：先写临时文件、fsync 后改名，再写入
+RunArchive 索引，最后才删除运行目录，已有分片从不原地修改，进程中途退出不会损坏已有归档
+（没有索引行的分片在下一轮清理时删除，运行目录仍在，会被重新打包）。
+
+zip 成员为 run_<id>/<文件名>，各自 deflate 压缩，按运行读取时只打开索引指向的分片并解压对应成员。
+同一天的多个分片、以及删除 / 恢复运行后留在分片中的无效数据由 compact() 合并重写。
+"""
+import os
+import re
+import json
+import shutil
+import zipfile
+import datetime
+from collections import deque
+from sqlalchemy import func
+from app.core.config import Config
+from app.core.context_history import CONTEXT_LOG, parse_lines
+from app.models.db import SessionLocal
+from app.models.task_models import RunArchive
+from app.utils import profiling
+from app.utils.file_reader import READ_CHUNK, iter_chunks
+from app.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+ARCHIVE_DIR = 'archive'
+PART_RE = re.compile(r'^(\d{4}-\d{2}-\d{2})\.(\d+)\.zip$')
+ZIP_ENTRY_OVERHEAD = 30 + 46  # 每个成员的本地文件头与中央目录项（不含文件名）
+
+
+def archive_dir():
+    return os.path.join(Config.LOGS_DIR, ARCHIVE_DIR)
+
+
+def part_path(name):
+    return os.path.join(archive_dir(), name)
+
+
+def list_parts():
+    """archive/ 下的分片：[(日期, 文件名, 字节数)]，按日期、序号排序"""
+    parts = []
+    try:
+        with os.scandir(archive_dir()) as it:
+            for entry in it:
+                m = PART_RE.match(entry.name)
+                if m and entry.is_file():
+                    parts.append((m.group(1), int(m.group(2)), entry.name, entry.stat().st_size))
+    except FileNotFoundError:
+        return []
+    parts.sort()
+    return [(day, name, size) for day, _, name, size in parts]
+
+
+def part_usage():
+    """索引中每个分片仍有效的 {文件名: (运行数, 占用字节数)}"""
+    session = SessionLocal()
+    try:
+        rows = session.query(RunArchive.archive, func.count(RunArchive.id), func.sum(RunArchive.size)) \
+            .group_by(RunArchive.archive).all()
+        return {name: (count, size or 0) for name, count, size in rows}
+    finally:
+        session.close()
+
+
+def archived_runs():
+    """索引中的全部运行：[(run_id, task_id, 分片文件名)]"""
+    session = SessionLocal()
+    try:
+        return session.query(RunArchive.run_id, RunArchive.task_id, RunArchive.archive).all()
+    finally:
+        session.close()
+
+
+def _new_part_name(day):
+    seqs = [int(m.group(2)) for m in map(PART_RE.match, os.listdir(archive_dir()))
+            if m and m.group(1) == day]
+    return f"{day}.{max(seqs, default=0) + 1}.zip"
+
+
+def _copy(src, dst, throttle=None):
+    while True:
+        data = src.read(READ_CHUNK)
+        if not data:
+            return
+        dst.write(data)
+        if throttle is not None:
+            throttle.consume(len(data))
+
+
+def _write_part(day, members, throttle=None):
+    """members 为 [(arcname, 打开源数据的函数, 原始字节数, 修改时间戳)]；写入新分片，返回 (分片名, {arcname: 在分片中占用的字节数})"""
+    os.makedirs(archive_dir(), exist_ok=True)
+    name = _new_part_name(day)
+    tmp = part_path(name + '.tmp')
+    sizes = {}
+    try:
+        with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for arcname, opener, raw_size, mtime in members:
+                info = zipfile.ZipInfo(arcname, datetime.datetime.fromtimestamp(mtime).timetuple()[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                # 压缩后可能略大于原始大小，接近 2GB 的成员提前启用 zip64
+                with opener() as src, zf.open(info, 'w', force_zip64=raw_size > zipfile.ZIP64_LIMIT // 2) as dst:
+                    _copy(src, dst, throttle)
+                # 计入本地头与中央目录项，使索引中的有效字节数之和接近分片的实际大小
+                sizes[arcname] = info.compress_size + ZIP_ENTRY_OVERHEAD + 2 * len(arcname.encode('utf-8'))
+            zf.fp.flush()
+            os.fsync(zf.fp.fileno())
+        os.replace(tmp, part_path(name))
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    return name, sizes
+
+
+def pack(day, runs, throttle=None):
+    """把同一结束日期的运行目录打包成一个新分片并写入索引，runs 为 [(run_id, task_id, run_dir)]。
+
+    返回已归档的 run_id 列表；运行目录由调用方在此之后删除。
+    """
+    members, entries = [], {}
+    for run_id, task_id, run_dir in runs:
+        files = {}
+        try:
+            with os.scandir(run_dir) as it:
+                for entry in it:
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    st = entry.stat()
+                    files[entry.name] = [st.st_size, st.st_mtime]
+                    members.append((f"run_{run_id}/{entry.name}",
+                                    lambda path=entry.path: open(path, 'rb'), st.st_size, st.st_mtime))
+        except OSError as e:
+            logger.warning(f"读取运行目录 {run_dir} 失败，跳过归档: {e}")
+            continue
+        entries[run_id] = (task_id, files)
+    if not entries:
+        return []
+    name, sizes = _write_part(day, members, throttle)
+    session = SessionLocal()
+    try:
+        # 之前打包过又被恢复 / 重新生成的运行，旧分片中的成员作废
+        session.query(RunArchive).filter(RunArchive.run_id.in_(list(entries))) \
+            .delete(synchronize_session=False)
+        for run_id, (task_id, files) in entries.items():
+            session.add(RunArchive(
+                run_id=run_id, task_id=task_id, archive=name, files=files,
+                size=sum(sizes.get(f"run_{run_id}/{f}", 0) for f in files)))
+        session.commit()
+    except Exception:
+        session.rollback()
+        os.remove(part_path(name))
+        raise
+    finally:
+        session.close()
+    return list(entries)
+
+
+def compact(day, names, throttle=None):
+    """把同一天的若干分片中仍在索引里的成员合并重写为一个新分片，删除旧分片；返回释放的字节数"""
+    session = SessionLocal()
+    try:
+        rows = session.query(RunArchive.run_id, RunArchive.archive, RunArchive.files) \
+            .filter(RunArchive.archive.in_(names)).all()
+    finally:
+        session.close()
+    before = sum(os.path.getsize(part_path(n)) for n in names if os.path.exists(part_path(n)))
+    if rows:
+        zips = {n: zipfile.ZipFile(part_path(n)) for n in {r.archive for r in rows}}
+        try:
+            members = [(f"run_{r.run_id}/{f}",
+                        lambda z=zips[r.archive], a=f"run_{r.run_id}/{f}": z.open(a), size, mtime)
+                       for r in rows for f, (size, mtime) in sorted((r.files or {}).items())]
+            name, sizes = _write_part(day, members, throttle)
+        finally:
+            for z in zips.values():
+                z.close()
+        session = SessionLocal()
+        try:
+            for r in rows:
+                # 合并期间被删除 / 恢复的运行不再更新，其成员成为新分片中的无效数据
+                session.query(RunArchive) \
+                    .filter(RunArchive.run_id == r.run_id, RunArchive.archive == r.archive) \
+                    .update({'archive': name,
+                             'size': sum(sizes.get(f"run_{r.run_id}/{f}", 0) for f in (r.files or {}))},
+                            synchronize_session=False)
+            session.commit()
+        except Exception:
+            session.rollback()
+            os.remove(part_path(name))
+            raise
+        finally:
+            session.close()
+        after = os.path.getsize(part_path(name))
+    else:
+        after = 0
+    for n in names:
+        try:
+            os.remove(part_path(n))
+        except OSError:
+            pass
+    return before - after
+
+
+def delete_part(name):
+    """删除整个分片及其索引行，返回 (运行数, 释放的字节数)"""
+    session = SessionLocal()
+    try:
+        count = session.query(RunArchive).filter(RunArchive.archive == name).delete(synchronize_session=False)
+        session.commit()
+    finally:
+        session.close()
+    try:
+        size = os.path.getsize(part_path(name))
+        os.remove(part_path(name))
+    except OSError:
+        size = 0
+    return count, size
+
+
+def forget(run_ids):
+    """从索引中移除运行（数据留在分片中，合并时回收），返回移除的行数"""
+    if not run_ids:
+        return 0
+    session = SessionLocal()
+    try:
+        count = session.query(RunArchive).filter(RunArchive.run_id.in_(list(run_ids))) \
+            .delete(synchronize_session=False)
+        session.commit()
+        return count
+    finally:
+        session.close()
+
+
+def _lookup(run_id):
+    session = SessionLocal()
+    try:
+        return session.query(RunArchive.archive, RunArchive.files).filter(RunArchive.run_id == run_id).first()
+    finally:
+        session.close()
+
+
+def _open(run_id):
+    """打开运行所在的分片，返回 (ZipFile, files)；未归档时返回 (None, {})"""
+    # 分片可能刚被合并重写、索引已指向新分片，重新查一次索引
+    for _ in range(2):
+        row = _lookup(run_id)
+        if row is None:
+            return None, {}
+        try:
+            return zipfile.ZipFile(part_path(row.archive)), row.files or {}
+        except FileNotFoundError:
+            continue
+    return None, {}
+
+
+def list_logs(run_id):
+    """归档中的脚本日志：{script: (字节数, 修改时间)}，与 run_storage.list_logs 的格式一致"""
+    row = _lookup(run_id)
+    if row is None:
+        return {}
+    return {f[:-4]: (size, datetime.datetime.fromtimestamp(mtime))
+            for f, (size, mtime) in (row.files or {}).items() if f.endswith('.log')}
+
+
+def read_log_range(run_id, script, offset=0, limit=None):
+    """与 file_reader.read_range 相同的语义，只解压到请求范围的末尾"""
+    limit = Config.LOG_READ_MAX_BYTES if limit is None else limit
+    zf, files = _open(run_id)
+    size = (files.get(f"{script}.log") or [0])[0]
+    if offset < 0:
+        offset = max(0, size + offset)
+    offset = min(offset, size)
+    data = b''
+    if zf is not None:
+        with zf, zf.open(f"run_{run_id}/{script}.log") as f:
+            f.seek(offset)
+            data = f.read(max(0, limit))
+    end = offset + len(data)
+    if end < size:
+        cut = data.rfind(b'\n') + 1
+        if cut > 0:
+            data = data[:cut]
+            end = offset + cut
+    return {
+        'content': data.decode('utf-8', errors='replace'),
+        'offset': offset,
+        'next_offset': end,
+        'size': size,
+        'eof': end >= size,
+    }
+
+
+def tail_log(run_id, script, lines=100):
+    """顺序解压并只保留最后 N 行所在的块；返回 (文本, 起始偏移, 总字节数)"""
+    zf, files = _open(run_id)
+    if zf is None:
+        return '', 0, 0
+    size = (files.get(f"{script}.log") or [0])[0]
+    if lines <= 0:
+        zf.close()
+        return '', size, size
+    blocks, newlines = deque(), 0
+    with zf, zf.open(f"run_{run_id}/{script}.log") as f:
+        while True:
+            data = f.read(READ_CHUNK)
+            if not data:
+                break
+            blocks.append(data)
+            newlines += data.count(b'\n')
+            # 去掉第一块后仍多于 N 个换行时，第一块不可能包含最后 N 行
+            while len(blocks) > 1 and newlines - blocks[0].count(b'\n') > lines:
+                newlines -= blocks.popleft().count(b'\n')
+    data = b''.join(blocks)
+    parts = data.split(b'\n')
+    keep = parts[-(lines + 1):] if data.endswith(b'\n') else parts[-lines:]
+    text = b'\n'.join(keep)
+    return text.decode('utf-8', errors='replace'), size - len(text), size
+
+
+def iter_log_range(run_id, script, start, end=None):
+    """逐块产出 (offset, data)，供实时日志流读取已归档的运行"""
+    zf, _ = _open(run_id)
+    if zf is None:
+        return
+    with zf, zf.open(f"run_{run_id}/{script}.log") as f:
+        yield from iter_chunks(f, start, end)
+
+
+def read_jsonl(run_id, name):
+    """归档中运行目录下 JSON Lines 文件的各行对象，没有该文件时返回 None"""
+    zf, files = _open(run_id)
+    if zf is None:
+        return None
+    with zf:
+        if name not in files:
+            return None
+        data = zf.read(f"run_{run_id}/{name}").decode('utf-8', errors='replace')
+    return parse_lines(data.splitlines())
+
+
+def read_context_entries(run_id):
+    """归档中 contexts.jsonl 的上下文历史条目，没有时返回 None"""
+    return read_jsonl(run_id, CONTEXT_LOG)
+
+
+def list_profiles(run_id):
+    """归档中有剖析结果的脚本：{script: (mode, 修改时间)}，与 run_storage.list_profiles 的格式一致"""
+    row = _lookup(run_id)
+    if row is None:
+        return {}
+    files = row.files or {}
+    return {script: (mode, datetime.datetime.fromtimestamp(files[script + profiling.COLLAPSED_SUFFIX][1]))
+            for script, mode in profiling.scripts_with_profiles(files).items()}
+
+
+def read_profile(run_id, script):
+    """归档中该脚本的剖析结果 (mode, pstats 字节, 折叠调用栈字节)，没有时返回 None"""
+    zf, files = _open(run_id)
+    if zf is None:
+        return None
+    pstats_name, collapsed_name = profiling.artifact_paths(script)
+    with zf:
+        if collapsed_name not in files:
+            return None
+        pstats_data = zf.read(f"run_{run_id}/{pstats_name}") if pstats_name in files else None
+        collapsed = zf.read(f"run_{run_id}/{collapsed_name}")
+    return ('cprofile' if pstats_data is not None else 'sampling'), pstats_data, collapsed
+
+
+def list_contexts(run_id):
+    """归档中旧版本的 .context.json 完整快照，格式与 get_run_contexts 读取运行目录时一致"""
+    zf, files = _open(run_id)
+    if zf is None:
+        return []
+    result = []
+    with zf:
+        for fname in sorted(files):
+            if not fname.endswith('.context.json'):
+                continue
+            try:
+                ctx = json.loads(zf.read(f"run_{run_id}/{fname}").decode('utf-8'))
+            except (KeyError, ValueError):
+                continue
+            result.append({
+                'script': fname[:-len('.context.json')],
+                'context': ctx,
+                'created_at': datetime.datetime.fromtimestamp(files[fname][1]).isoformat()
+            })
+    return result
+
+
+def restore(run_id, run_dir):
+    """把已归档的运行解压回运行目录并移出索引（恢复执行前调用），返回是否有归档"""
+    zf, files = _open(run_id)
+    if zf is None:
+        return False
+    os.makedirs(run_dir, exist_ok=True)
+    with zf:
+        for fname, (_, mtime) in files.items():
+            path = os.path.join(run_dir, fname)
+            with zf.open(f"run_{run_id}/{fname}") as src, open(path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, READ_CHUNK)
+            os.utime(path, (mtime, mtime))
+    forget([run_id])
+    logger.info(f"运行 {run_id} 的日志已从归档恢复到 {run_dir}")
+    return True
@@ -0,0 +1,103 @@
+"""运行日志扇出中心：每个活跃运行一个有界环形缓冲，所有查看者共享同一份缓冲按字节偏移读取。
+
+偏移量即脚本日志文件（LOGS_DIR/run_<id>/<script>.log）中的字节位置，
+已滑出环形缓冲的部分直接从磁盘按偏移读取，因此断线后可以用偏移量续传。
+"""
+import os
+import threading
+from collections import deque
+from app.core.config import Config
+
+
+class RunLogStream:
+    """单个运行的日志环形缓冲"""
+
+    def __init__(self, run_id, run_dir, max_bytes=None):
+        self.run_id = run_id
+        self.run_dir = run_dir
+        self.max_bytes = max_bytes or Config.LOG_STREAM_BUFFER_BYTES
+        self.cond = threading.Condition()
+        self.chunks = deque()  # [(seq, script, offset, data)]
+        self.buffered = 0
+        self.seq = 0
+        self.ends = {}    # script -> 已发布的末尾偏移
+        self.floors = {}  # script -> 环形缓冲中该脚本最早的偏移，更早的部分需读磁盘
+        self.closed = False
+        self.status = None
+
+    def publish(self, script, offset, data):
+        """由日志写入器调用：data 为写入文件 offset 处的字节"""
+        with self.cond:
+            self.seq += 1
+            self.chunks.append((self.seq, script, offset, data))
+            self.buffered += len(data)
+            self.floors.setdefault(script, offset)
+            self.ends[script] = offset + len(data)
+            while self.buffered > self.max_bytes and len(self.chunks) > 1:
+                _, old_script, old_offset, old_data = self.chunks.popleft()
+                self.buffered -= len(old_data)
+                self.floors[old_script] = old_offset + len(old_data)
+            self.cond.notify_all()
+
+    def close(self, status=None):
+        with self.cond:
+            self.closed = True
+            self.status = status
+            self.cond.notify_all()
+
+    def snapshot(self, after_seq):
+        """返回 (新块列表, 最新 seq, floors, 是否已关闭)"""
+        with self.cond:
+            new = [c for c in self.chunks if c[0] > after_seq]
+            return new, self.seq, dict(self.floors), self.closed
+
+    def wait(self, after_seq, timeout):
+        with self.cond:
+            if self.seq == after_seq and not self.closed:
+                self.cond.wait(timeout)
+            return self.seq != after_seq or self.closed
+
+
+class LogHub:
+    """活跃运行日志流注册表"""
+
+    def __init__(self):
+        self.streams = {}
+        self.lock = threading.Lock()
+
+    def open_stream(self, run_id, run_dir):
+        with self.lock:
+            stream = self.streams.get(run_id)
+            if stream is None or stream.closed:
+                stream = RunLogStream(run_id, run_dir)
+                self.streams[run_id] = stream
+            return stream
+
+    def get_stream(self, run_id):
+        with self.lock:
+            return self.streams.get(run_id)
+
+    def close_stream(self, run_id, status=None):
+        # 已连接的查看者仍持有该对象，会读完剩余数据后结束；新查看者改读磁盘
+        with self.lock:
+            stream = self.streams.pop(run_id, None)
+        if stream is not None:
+            stream.close(status)
+
+
+log_hub = LogHub()
+
+
+def safe_script_name(script):
+    """校验脚本名，防止通过 script 参数读取运行目录之外的文件"""
+    if not script or os.path.basename(script) != script or script in ('.', '..'):
+        return None
+    return script
+
+
+def list_script_logs(run_dir):
+    """运行目录中已有日志的脚本名"""
+    try:
+        return sorted(f[:-4] for f in os.listdir(run_dir) if f.endswith('.log'))
+    except OSError:
+        return []
@@ -0,0 +1,401 @@
+"""LOGS_DIR 的后台保留与归档：运行目录打包、按策略删除旧日志、合并归档分片。
+
+每一轮清理依次执行：
+1. 按天数（LOG_RETENTION_DAYS）删除过旧的运行目录、归档分片与旧版任务日志（<task_id>_<run_id>.log）
+2. 每个任务只保留最近 LOG_RETENTION_PER_TASK 个运行的日志（运行目录与归档都计入）
+3. 结束超过 LOG_ARCHIVE_AFTER_HOURS 的运行目录按结束日期打包进归档（见 log_archive），每轮最多
+   LOG_RETENTION_BATCH 个，剩余的留给下一轮
+4. 合并已不再有新运行写入的日期的多个分片，重写无效数据过半的分片
+5. LOGS_DIR 总占用超过 LOG_RETENTION_MAX_MB 时，从最旧的归档 / 运行目录 / 旧版日志开始删除
+
+排队、领取、执行中的运行从不处理。清理线程以最低 CPU 优先级（线程级 nice 19）运行，
+读写速率限制在 LOG_RETENTION_IO_MB MB/s 以内；同一 LOGS_DIR 上的多个进程（gunicorn worker）
+通过文件锁保证同一时刻只有一个在清理，距上一轮不足 LOG_RETENTION_INTERVAL 时跳过。
+"""
+import os
+import re
+import time
+import shutil
+import threading
+import datetime
+from collections import defaultdict
+from app.core.config import Config
+from app.core import log_archive
+from app.core.run_queue import ACTIVE_STATUSES
+from app.models.db import SessionLocal
+from app.models.task_models import TaskRun
+from app.utils import metrics
+from app.utils.logger import setup_logger
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = setup_logger(__name__)
+
+ARCHIVED_RUNS = metrics.counter('log_retention_archived_runs_total', '打包进归档的运行目录数')
+DELETED = metrics.counter('log_retention_deleted_total', '按保留策略删除的日志',
+                          labels=('reason', 'kind'))
+COMPACTED = metrics.counter('log_retention_compacted_parts_total', '合并重写的归档分片数')
+DISK_BYTES = metrics.gauge('log_retention_disk_bytes', 'LOGS_DIR 中的日志占用（字节）', labels=('kind',))
+SWEEP_SECONDS = metrics.histogram('log_retention_sweep_seconds', '一轮保留清理的耗时',
+                                  buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600))
+
+RUN_DIR_RE = re.compile(r'^run_(\d+)$')
+LOCK_FILE = '.sweep.lock'
+STAMP_FILE = '.last_sweep'
+COMPACT_MIN_DEAD_BYTES = 64 * 1024  # 无效数据少于该值的分片不重写
+
+
+class Throttle:
+    """把累计读写量限制在 rate 字节/秒以内，rate <= 0 时不限速"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.started = time.monotonic()
+        self.done = 0
+
+    def consume(self, n):
+        if self.rate <= 0:
+            return
+        self.done += n
+        delay = self.done / self.rate - (time.monotonic() - self.started)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _dir_size(path):
+    total = 0
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_file(follow_symlinks=False):
+                    total += entry.stat().st_size
+    except OSError:
+        pass
+    return total
+
+
+def _utc(ts):
+    return datetime.datetime.utcfromtimestamp(ts)
+
+
+def scan_logs_dir():
+    """LOGS_DIR 顶层：({run_id: 运行目录}, [(旧版日志路径, 修改时间, 字节数)])"""
+    run_dirs, legacy = {}, []
+    with os.scandir(Config.LOGS_DIR) as it:
+        for entry in it:
+            m = RUN_DIR_RE.match(entry.name)
+            if m:
+                if entry.is_dir(follow_symlinks=False):
+                    run_dirs[int(m.group(1))] = entry.path
+            elif entry.name.endswith('.log') and entry.name != 'app.log' and entry.is_file():
+                st = entry.stat()
+                legacy.append((entry.path, st.st_mtime, st.st_size))
+    return run_dirs, legacy
+
+
+def _load_runs(run_dirs):
+    """运行目录对应的运行：[{'run_id', 'path', 'task_id', 'status', 'ended', 'size'}]，按结束时间排序。
+
+    数据库中已没有记录的目录按已结束处理，结束时间取目录的修改时间。
+    """
+    ids = sorted(run_dirs)
+    meta = {}
+    session = SessionLocal()
+    try:
+        for i in range(0, len(ids), 500):
+            rows = session.query(TaskRun.id, TaskRun.task_id, TaskRun.status, TaskRun.finished_at) \
+                .filter(TaskRun.id.in_(ids[i:i + 500])).all()
+            meta.update({row.id: row for row in rows})
+    finally:
+        session.close()
+    runs = []
+    for run_id in ids:
+        path = run_dirs[run_id]
+        row = meta.get(run_id)
+        ended = row.finished_at if row is not None else None
+        if ended is None:
+            try:
+                ended = _utc(os.path.getmtime(path))
+            except OSError:
+                continue
+        runs.append({
+            'run_id': run_id,
+            'path': path,
+            'task_id': row.task_id if row is not None else None,
+            'status': row.status if row is not None else None,
+            'ended': ended,
+            'size': _dir_size(path),
+        })
+    runs.sort(key=lambda r: r['ended'])
+    return runs
+
+
+class LogRetention:
+    """后台清理线程，进程内只有一个实例（见 start()）"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last = None  # 本进程最近一轮清理的结果
+        self._thread = None
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._force = False
+
+    def start(self):
+        with self.lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._loop, name='log-retention', daemon=True)
+            self._thread.start()
+        logger.info(f"日志保留清理已启动: interval={Config.LOG_RETENTION_INTERVAL}s, "
+                    f"archive_after={Config.LOG_ARCHIVE_AFTER_HOURS}h, days={Config.LOG_RETENTION_DAYS}, "
+                    f"per_task={Config.LOG_RETENTION_PER_TASK}, max_mb={Config.LOG_RETENTION_MAX_MB}")
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def trigger(self):
+        """立即执行一轮清理（忽略距上一轮的间隔）"""
+        self._force = True
+        self._wakeup.set()
+
+    def _loop(self):
+        try:
+            # Linux 上 nice 值按线程生效，只降低本线程的调度优先级
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+        # 启动后稍等片刻，避开服务启动时的繁忙阶段
+        self._wakeup.wait(min(60.0, Config.LOG_RETENTION_INTERVAL))
+        while not self._stop.is_set():
+            self._wakeup.clear()
+            force, self._force = self._force, False
+            try:
+                self.sweep(force=force)
+            except Exception as e:
+                logger.error(f"日志保留清理失败: {e}")
+            self._wakeup.wait(Config.LOG_RETENTION_INTERVAL)
+
+    def sweep(self, force=False):
+        """执行一轮清理，返回结果 dict；其他进程正在清理或距上一轮不足间隔时返回 None"""
+        adir = log_archive.archive_dir()
+        os.makedirs(adir, exist_ok=True)
+        stamp = os.path.join(adir, STAMP_FILE)
+        with open(os.path.join(adir, LOCK_FILE), 'a') as lock:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return None
+            try:
+                if not force and time.time() - os.path.getmtime(stamp) < Config.LOG_RETENTION_INTERVAL * 0.9:
+                    return None
+            except OSError:
+                pass
+            started = time.monotonic()
+            result = self._sweep()
+            result['duration'] = round(time.monotonic() - started, 3)
+            SWEEP_SECONDS.observe(result['duration'])
+            with open(stamp, 'w') as f:
+                f.write(result['finished_at'])
+        with self.lock:
+            self.last = result
+        if result['archived_runs'] or result['deleted'] or result['compacted_parts']:
+            logger.info(f"日志保留清理完成: 归档 {result['archived_runs']} 个运行，删除 {result['deleted']}，"
+                        f"合并 {result['compacted_parts']} 个分片，释放 {result['freed_bytes']} 字节，"
+                        f"耗时 {result['duration']}s")
+        return result
+
+    def _sweep(self):
+        now = datetime.datetime.utcnow()
+        throttle = Throttle(Config.LOG_RETENTION_IO_MB * 1024 * 1024)
+        result = {'archived_runs': 0, 'deleted': defaultdict(int), 'compacted_parts': 0, 'freed_bytes': 0}
+
+        def _deleted(reason, kind, size, count=1):
+            result['deleted'][f"{reason}:{kind}"] += count
+            result['freed_bytes'] += size
+            DELETED.labels(reason=reason, kind=kind).inc(count)
+
+        def _remove_dir(run, reason):
+            shutil.rmtree(run['path'], ignore_errors=True)
+            run['removed'] = True
+            _deleted(reason, 'run_dir', run['size'])
+
+        run_dirs, legacy = scan_logs_dir()
+        runs = _load_runs(run_dirs)
+        active_bytes = sum(r['size'] for r in runs if r['status'] in ACTIVE_STATUSES)
+        runs = [r for r in runs if r['status'] not in ACTIVE_STATUSES]
+        parts = log_archive.list_parts()
+
+        # 1. 按天数删除
+        if Config.LOG_RETENTION_DAYS > 0:
+            cutoff = now - datetime.timedelta(days=Config.LOG_RETENTION_DAYS)
+            for run in runs:
+                if run['ended'] < cutoff:
+                    _remove_dir(run, 'age')
+            for day, name, size in parts:
+                if day < cutoff.strftime('%Y-%m-%d'):
+                    count, freed = log_archive.delete_part(name)
+                    _deleted('age', 'archive', freed, count)
+            for path, mtime, size in legacy:
+                if _utc(mtime) < cutoff:
+                    try:
+                        os.remove(path)
+                        _deleted('age', 'legacy_log', size)
+                    except OSError:
+                        pass
+            runs = [r for r in runs if not r.get('removed')]
+
+        # 2. 每个任务保留最近 N 个运行（run_id 越大越新）
+        if Config.LOG_RETENTION_PER_TASK > 0:
+            by_task = defaultdict(list)
+            for run in runs:
+                if run['task_id'] is not None:
+                    by_task[run['task_id']].append((run['run_id'], run))
+            for run_id, task_id, _ in log_archive.archived_runs():
+                if task_id is not None:
+                    by_task[task_id].append((run_id, None))
+            forgotten = []
+            for task_id, items in by_task.items():
+                items.sort(key=lambda item: item[0], reverse=True)
+                for run_id, run in items[Config.LOG_RETENTION_PER_TASK:]:
+                    if run is None:
+                        forgotten.append(run_id)
+                    else:
+                        _remove_dir(run, 'per_task')
+            if forgotten:
+                # 归档中的数据在合并分片时回收
+                _deleted('per_task', 'archive', 0, log_archive.forget(forgotten))
+            runs = [r for r in runs if not r.get('removed')]
+
+        # 3. 打包结束较久的运行目录
+        if Config.LOG_ARCHIVE_AFTER_HOURS > 0:
+            cutoff = now - datetime.timedelta(hours=Config.LOG_ARCHIVE_AFTER_HOURS)
+            eligible = [r for r in runs if r['ended'] < cutoff][:max(1, Config.LOG_RETENTION_BATCH)]
+            by_day = defaultdict(list)
+            for run in eligible:
+                by_day[run['ended'].strftime('%Y-%m-%d')].append(run)
+            for day, day_runs in sorted(by_day.items()):
+                if self._stop.is_set():
+                    break
+                packed = set(log_archive.pack(
+                    day, [(r['run_id'], r['task_id'], r['path']) for r in day_runs], throttle))
+                for run in day_runs:
+                    if run['run_id'] in packed:
+                        shutil.rmtree(run['path'], ignore_errors=True)
+                        run['removed'] = True
+                result['archived_runs'] += len(packed)
+                ARCHIVED_RUNS.inc(len(packed))
+            result['pending_archive'] = sum(1 for r in runs if r['ended'] < cutoff and not r.get('removed'))
+            runs = [r for r in runs if not r.get('removed')]
+
+        # 4. 合并分片：没有索引行的分片直接删除；不再有新运行写入的日期合并为一个分片；无效数据过半的重写
+        parts = log_archive.list_parts()
+        usage = log_archive.part_usage()
+        settled = (now - datetime.timedelta(hours=max(0, Config.LOG_ARCHIVE_AFTER_HOURS) + 24)).strftime('%Y-%m-%d')
+        by_day = defaultdict(list)
+        for day, name, size in parts:
+            if name not in usage:
+                try:
+                    os.remove(log_archive.part_path(name))
+                    result['freed_bytes'] += size
+                except OSError:
+                    pass
+                continue
+            by_day[day].append((name, size))
+        for day, items in sorted(by_day.items()):
+            if self._stop.is_set():
+                break
+            live = sum(usage[name][1] for name, _ in items)
+            total = sum(size for _, size in items)
+            if (len(items) > 1 and day < settled) or total - live > max(total // 2, COMPACT_MIN_DEAD_BYTES):
+                result['freed_bytes'] += log_archive.compact(day, [name for name, _ in items], throttle)
+                result['compacted_parts'] += len(items)
+                COMPACTED.inc(len(items))
+
+        # 5. 总占用上限：从最旧的开始删除
+        parts = log_archive.list_parts()
+        legacy = [item for item in legacy if os.path.exists(item[0])]
+        usage_bytes = {
+            'run_dirs': active_bytes + sum(r['size'] for r in runs),
+            'archives': sum(size for _, _, size in parts),
+            'legacy_logs': sum(size for _, _, size in legacy),
+        }
+        limit = Config.LOG_RETENTION_MAX_MB * 1024 * 1024
+        total = sum(usage_bytes.values())
+        if limit > 0 and total > limit:
+            candidates = [(datetime.datetime.strptime(day, '%Y-%m-%d'), 'archive', name, size)
+                          for day, name, size in parts]
+            candidates += [(r['ended'], 'run_dir', r, r['size']) for r in runs]
+            candidates += [(_utc(mtime), 'legacy_log', path, size) for path, mtime, size in legacy]
+            candidates.sort(key=lambda c: c[0])
+            for _, kind, target, size in candidates:
+                if total <= limit:
+                    break
+                if kind == 'archive':
+                    count, size = log_archive.delete_part(target)
+                    _deleted('max_bytes', kind, size, count)
+                elif kind == 'run_dir':
+                    _remove_dir(target, 'max_bytes')
+                else:
+                    try:
+                        os.remove(target)
+                    except OSError:
+                        continue
+                    _deleted('max_bytes', kind, size)
+                usage_bytes[{'archive': 'archives', 'run_dir': 'run_dirs'}.get(kind, 'legacy_logs')] -= size
+                total -= size
+
+        for kind, size in usage_bytes.items():
+            DISK_BYTES.labels(kind=kind).set(size)
+        result['disk'] = usage_bytes
+        result['deleted'] = dict(result['deleted'])
+        result['finished_at'] = datetime.datetime.utcnow().isoformat()
+        return result
+
+    def status(self):
+        with self.lock:
+            last = self.last
+        try:
+            # 多进程部署时可能由其他进程完成了最近一轮
+            with open(os.path.join(log_archive.archive_dir(), STAMP_FILE)) as f:
+                last_sweep_at = f.read().strip() or None
+        except OSError:
+            last_sweep_at = None
+        return {
+            'enabled': self._thread is not None,
+            'interval': Config.LOG_RETENTION_INTERVAL,
+            'policy': {
+                'archive_after_hours': Config.LOG_ARCHIVE_AFTER_HOURS,
+                'days': Config.LOG_RETENTION_DAYS,
+                'per_task': Config.LOG_RETENTION_PER_TASK,
+                'max_mb': Config.LOG_RETENTION_MAX_MB,
+                'io_mb': Config.LOG_RETENTION_IO_MB,
+                'batch': Config.LOG_RETENTION_BATCH,
+            },
+            'last_sweep_at': last_sweep_at,
+            'last_sweep': last,
+        }
+
+
+_retention = LogRetention()
+
+
+def start():
+    _retention.start()
+
+
+def trigger():
+    _retention.trigger()
+
+
+def sweep(force=True):
+    return _retention.sweep(force=force)
+
+
+def status():
+    return _retention.status()
@@ -1,76 +1,223 @@
 import psutil
 import os
+import time
+import threading
+from collections import deque
+from datetime import datetime
+from app.core.config import Config
+from app.utils import metrics
 from app.utils.logger import setup_logger
 
 logger = setup_logger(__name__)
 
+PROCESS_RSS = metrics.gauge('process_resident_memory_bytes', '服务进程的常驻内存')
+PROCESS_CPU = metrics.gauge('process_cpu_percent', '服务进程的 CPU 占用（百分比，相对上一次采样）')
+PROCESS_THREADS = metrics.gauge('process_threads', '服务进程的线程数')
+PROCESS_FDS = metrics.gauge('process_open_fds', '服务进程打开的文件描述符数')
+PROCESS_CHILDREN = metrics.gauge('process_children', '服务进程树中除根进程外的进程数（脚本进程、预热工作进程等）')
+SYSTEM_CPU = metrics.gauge('system_cpu_percent', '系统 CPU 占用（百分比，相对上一次采样）')
+SYSTEM_MEMORY = metrics.gauge('system_memory_percent', '系统内存占用（百分比）')
+SYSTEM_DISK = metrics.gauge('system_disk_percent', '根分区磁盘占用（百分比）')
+
+
 class ProcessManager:
-    """进程管理器 - 监控和管理系统进程"""
-    
-    def __init__(self):
+    """进程管理器 - 后台线程按 PROCESS_CHECK_INTERVAL 采样系统与本进程树的资源占用。
+
+    最近 PROCESS_SAMPLE_HISTORY 个采样点保存在环形缓冲中，接口直接返回最新采样或时间序列，
+    不在请求中做阻塞采样；CPU 占用均为相对上一次采样的值。
+    """
+
+    def __init__(self, interval=None, history=None):
         self.current_process = psutil.Process(os.getpid())
-        logger.info("ProcessManager 初始化完成")
-    
+        # gunicorn 部署时进程树以 master 为根（见 app.serve），包含其他 Web worker 与 runner
+        self.root_process = self.current_process
+        root_pid = os.getenv('SERVICE_ROOT_PID')
+        if root_pid and root_pid.isdigit() and int(root_pid) != self.current_process.pid:
+            try:
+                self.root_process = psutil.Process(int(root_pid))
+            except psutil.Error:
+                pass
+        self.interval = max(0.5, interval or Config.PROCESS_CHECK_INTERVAL)
+        self.samples = deque(maxlen=history or Config.PROCESS_SAMPLE_HISTORY)
+        self.lock = threading.Lock()
+        self._latest = None
+        self._tree = []
+        self._procs = {}  # pid -> psutil.Process，复用对象才能计算两次采样之间的 CPU 占用
+        self._stop = threading.Event()
+        # 预热 CPU 计数并取得首个采样，之后的接口调用总能拿到数据
+        psutil.cpu_percent(interval=None)
+        self.sample()
+        self._thread = threading.Thread(target=self._loop, name='process-sampler', daemon=True)
+        self._thread.start()
+        logger.info(f"ProcessManager 初始化完成: interval={self.interval}s, history={self.samples.maxlen}")
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sample()
+            except Exception as e:
+                logger.warning(f"系统资源采样失败: {e}")
+
+    def stop(self):
+        self._stop.set()
+
+    def _sample_tree(self):
+        """服务进程树：根进程及其全部子孙进程（Web worker、runner、脚本进程、预热工作进程）"""
+        proc = self.root_process
+        try:
+            members = [proc] + proc.children(recursive=True)
+        except psutil.Error:
+            members = [proc]
+        procs, tree = {}, []
+        for member in members:
+            cached = self._procs.get(member.pid)
+            # psutil.Process 的相等比较包含创建时间，pid 被复用时换成新对象
+            p = cached if cached is not None and cached == member else member
+            try:
+                with p.oneshot():
+                    memory = p.memory_info()
+                    tree.append({
+                        'pid': p.pid,
+                        'ppid': p.ppid(),
+                        'name': p.name(),
+                        'status': p.status(),
+                        'cmdline': ' '.join(p.cmdline())[:512],
+                        'memory_rss': memory.rss,
+                        'cpu_percent': p.cpu_percent(interval=None),
+                        'num_threads': p.num_threads(),
+                        'create_time': p.create_time(),
+                    })
+                procs[p.pid] = p
+            except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+                continue
+        self._procs = procs
+        return tree
+
+    def sample(self):
+        """采样一次并写入环形缓冲，返回该采样"""
+        now = time.time()
+        memory = psutil.virtual_memory()
+        disk = psutil.disk_usage('/')
+        tree = self._sample_tree()
+        own = next((p for p in tree if p['pid'] == self.current_process.pid), {})
+        proc = self.current_process
+        try:
+            with proc.oneshot():
+                mem = proc.memory_info()
+                process = {
+                    'pid': proc.pid,
+                    'name': proc.name(),
+                    'status': proc.status(),
+                    'memory_info': {
+                        'rss': mem.rss,
+                        'vms': mem.vms
+                    },
+                    'cpu_percent': own.get('cpu_percent', 0.0),
+                    'num_threads': proc.num_threads(),
+                    'num_fds': proc.num_fds() if hasattr(proc, 'num_fds') else None,
+                    'children': max(0, len(tree) - 1),
+                }
+        except psutil.Error as e:
+            logger.warning(f"采样当前进程失败: {e}")
+            process = {}
+        latest = {
+            'timestamp': datetime.utcfromtimestamp(now).isoformat(),
+            'cpu_percent': psutil.cpu_percent(interval=None),
+            'memory': {
+                'total': memory.total,
+                'available': memory.available,
+                'percent': memory.percent,
+                'used': memory.used
+            },
+            'disk': {
+                'total': disk.total,
+                'used': disk.used,
+                'free': disk.free,
+                'percent': disk.percent
+            },
+            'process': process,
+        }
+        point = {
+            'time': round(now, 3),
+            'cpu_percent': latest['cpu_percent'],
+            'memory_percent': memory.percent,
+            'disk_percent': disk.percent,
+            'process_rss': process.get('memory_info', {}).get('rss'),
+            'process_cpu_percent': process.get('cpu_percent'),
+            'process_threads': process.get('num_threads'),
+            'process_children': process.get('children'),
+            'tree_rss': sum(p['memory_rss'] for p in tree),
+        }
+        with self.lock:
+            self._latest = latest
+            self._tree = tree
+            self.samples.append(point)
+        self._export(latest)
+        return latest
+
+    def _export(self, latest):
+        process = latest['process']
+        SYSTEM_CPU.set(latest['cpu_percent'])
+        SYSTEM_MEMORY.set(latest['memory']['percent'])
+        SYSTEM_DISK.set(latest['disk']['percent'])
+        if process:
+            PROCESS_RSS.set(process['memory_info']['rss'])
+            PROCESS_CPU.set(process['cpu_percent'])
+            PROCESS_THREADS.set(process['num_threads'])
+            PROCESS_CHILDREN.set(process['children'])
+            if process['num_fds'] is not None:
+                PROCESS_FDS.set(process['num_fds'])
+
+    def _get_latest(self):
+        with self.lock:
+            latest = self._latest
+        return latest if latest is not None else self.sample()
+
     def get_system_info(self):
-        """获取系统信息"""
+        """获取系统信息（最近一次采样）"""
         try:
-            cpu_percent = psutil.cpu_percent(interval=1)
-            memory = psutil.virtual_memory()
-            disk = psutil.disk_usage('/')
-            
+            latest = self._get_latest()
             return {
-                'cpu_percent': cpu_percent,
-                'memory': {
-                    'total': memory.total,
-                    'available': memory.available,
-                    'percent': memory.percent,
-                    'used': memory.used
-                },
-                'disk': {
-                    'total': disk.total,
-                    'used': disk.used,
-                    'free': disk.free,
-                    'percent': disk.percent
-                }
+                'timestamp': latest['timestamp'],
+                'cpu_percent': latest['cpu_percent'],
+                'memory': latest['memory'],
+                'disk': latest['disk'],
             }
         except Exception as e:
             logger.error(f"获取系统信息失败: {e}")
             return {}
-    
+
     def get_process_info(self):
-        """获取当前进程信息"""
+        """获取当前进程信息（最近一次采样）"""
         try:
-            return {
-                'pid': self.current_process.pid,
-                'name': self.current_process.name(),
-                'status': self.current_process.status(),
-                'memory_info': {
-                    'rss': self.current_process.memory_info().rss,
-                    'vms': self.current_process.memory_info().vms
-                },
-                'cpu_percent': self.current_process.cpu_percent(interval=1),
-                'num_threads': self.current_process.num_threads()
-            }
+            latest = self._get_latest()
+            return dict(latest['process'], timestamp=latest['timestamp'])
         except Exception as e:
             logger.error(f"获取进程信息失败: {e}")
             return {}
-    
+
     def get_all_processes(self):
-        """获取所有Python进程"""
+        """获取本服务的进程树：当前进程及其派生的脚本进程、预热工作进程（最近一次采样）"""
         try:
-            processes = []
-            for proc in psutil.process_iter(['pid', 'name', 'status', 'memory_info']):
-                try:
-                    if 'python' in proc.name().lower():
-                        processes.append({
-                            'pid': proc.info['pid'],
-                            'name': proc.info['name'],
-                            'status': proc.info['status'],
-                            'memory_rss': proc.info['memory_info'].rss if proc.info['memory_info'] else 0
-                        })
-                except (psutil.NoSuchProcess, psutil.AccessDenied):
-                    pass
-            return processes
+            self._get_latest()
+            with self.lock:
+                return list(self._tree)
         except Exception as e:
             logger.error(f"获取进程列表失败: {e}")
             return []
+
+    def get_history(self, seconds=None, limit=None):
+        """环形缓冲中的时间序列，seconds 只返回最近 N 秒，limit 为等间隔抽样后的最大点数"""
+        with self.lock:
+            points = list(self.samples)
+        if seconds:
+            since = time.time() - seconds
+            points = [p for p in points if p['time'] >= since]
+        if limit and limit > 0 and len(points) > limit:
+            step = len(points) / limit
+            points = [points[int(i * step)] for i in range(limit - 1)] + [points[-1]]
+        return {
+            'interval': self.interval,
+            'capacity': self.samples.maxlen,
+            'points': points,
+        }
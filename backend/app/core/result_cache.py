@@ -0,0 +1,237 @@
+"""脚本执行结果缓存（内容寻址，按脚本开启）。
+
+缓存键为以下内容的 SHA-256：脚本文件字节、脚本启动时的输入上下文（规范化 JSON）、
+以及脚本声明的额外输入（TASKS_DIR 下文件 / 目录的内容哈希，或 env:变量名 的值）。
+缓存值为该次执行对上下文的增量与写入的日志；命中时 _run_node 不启动脚本，
+直接回放日志并应用增量。只缓存成功（returncode 为 0）的执行。
+
+条目存放在数据库中，多个进程 / runner agent 共享；过期条目在读取和写入时删除，
+超出条目数或总字节数上限时按最近使用时间淘汰。
+"""
+import os
+import json
+import hashlib
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from app.core.config import Config
+from app.core import run_storage
+from app.models.db import SessionLocal
+from app.models.task_models import ScriptResultCache
+from app.utils import metrics
+from app.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+CACHE_LOOKUPS = metrics.counter('result_cache_lookups_total', '结果缓存查询次数', labels=('outcome',))
+CACHE_STORES = metrics.counter('result_cache_stores_total', '写入结果缓存的条目数')
+CACHE_EVICTIONS = metrics.counter('result_cache_evictions_total', '结果缓存淘汰的条目数', labels=('reason',))
+
+ENV_PREFIX = 'env:'
+
+
+def parse_cache_option(value):
+    """脚本项中的 cache 配置 -> (ttl, inputs)；未开启返回 (None, None)，不合法时抛出 ValueError。
+
+    支持 true / false、有效期秒数，或 {'ttl': 秒, 'inputs': [路径或 env:变量名, ...]}。
+    """
+    if value is None or value is False:
+        return None, None
+    if value is True:
+        return Config.RESULT_CACHE_DEFAULT_TTL, None
+    if isinstance(value, int) and not isinstance(value, bool):
+        if value <= 0:
+            raise ValueError('cache 有效期必须是正整数')
+        return value, None
+    if isinstance(value, dict):
+        ttl = value.get('ttl', Config.RESULT_CACHE_DEFAULT_TTL)
+        inputs = value.get('inputs')
+        if not isinstance(ttl, int) or isinstance(ttl, bool) or ttl <= 0:
+            raise ValueError('cache.ttl 必须是正整数')
+        if inputs is not None and (not isinstance(inputs, list)
+                                   or not all(isinstance(i, str) and i for i in inputs)):
+            raise ValueError('cache.inputs 必须是字符串列表')
+        return ttl, inputs or None
+    raise ValueError(f"无效的 cache 配置: {value}")
+
+
+class ResultCache:
+    """结果缓存的读写与淘汰"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._digests = {}  # path -> ((mtime_ns, size), sha256)，文件未变化时不重复读取
+
+    def _file_digest(self, path):
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        with self.lock:
+            cached = self._digests.get(path)
+        if cached and cached[0] == stamp:
+            return cached[1]
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(block)
+        digest = h.hexdigest()
+        with self.lock:
+            self._digests[path] = (stamp, digest)
+        return digest
+
+    def _input_digest(self, item):
+        if item.startswith(ENV_PREFIX):
+            return f"env:{os.environ.get(item[len(ENV_PREFIX):])}"
+        path = item if os.path.isabs(item) else os.path.join(Config.TASKS_DIR, item)
+        if os.path.isdir(path):
+            parts = []
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    full = os.path.join(root, name)
+                    parts.append(f"{os.path.relpath(full, path)}={self._file_digest(full)}")
+            return 'dir:' + hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+        if os.path.isfile(path):
+            return 'file:' + self._file_digest(path)
+        return 'missing'
+
+    def make_key(self, script_path, context, inputs=None):
+        """计算缓存键；脚本文件不存在或上下文无法序列化时返回 None（不使用缓存）"""
+        try:
+            h = hashlib.sha256()
+            h.update(self._file_digest(script_path).encode('ascii'))
+            h.update(b'\0')
+            h.update(json.dumps(context, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8'))
+            for item in inputs or ():
+                h.update(b'\0')
+                h.update(item.encode('utf-8'))
+                h.update(b'=')
+                h.update(self._input_digest(item).encode('utf-8'))
+            return h.hexdigest()
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"无法计算结果缓存键 {script_path}: {e}")
+            return None
+
+    def get(self, key, force=False):
+        """命中返回 (上下文增量, 日志字节)，否则返回 None；force 为强制重新执行（不读缓存，执行成功后覆盖）"""
+        if force:
+            CACHE_LOOKUPS.labels(outcome='bypass').inc()
+            return None
+        session = SessionLocal()
+        try:
+            entry = session.query(ScriptResultCache).filter(ScriptResultCache.cache_key == key).first()
+            if entry is None:
+                CACHE_LOOKUPS.labels(outcome='miss').inc()
+                return None
+            now = datetime.utcnow()
+            if entry.expires_at is not None and entry.expires_at <= now:
+                session.delete(entry)
+                session.commit()
+                CACHE_LOOKUPS.labels(outcome='expired').inc()
+                CACHE_EVICTIONS.labels(reason='ttl').inc()
+                return None
+            delta = entry.delta or {}
+            logs = run_storage.decompress(entry.log_data, entry.log_codec) if entry.log_data else b''
+            entry.hits = (entry.hits or 0) + 1
+            entry.last_used_at = now
+            session.commit()
+            CACHE_LOOKUPS.labels(outcome='hit').inc()
+            return delta, logs
+        except Exception as e:
+            session.rollback()
+            logger.error(f"读取结果缓存失败: {e}")
+            CACHE_LOOKUPS.labels(outcome='error').inc()
+            return None
+        finally:
+            session.close()
+
+    def put(self, key, script, delta, logs, ttl):
+        """写入一条缓存并按需淘汰；日志超过 RESULT_CACHE_MAX_ENTRY_BYTES 时不缓存"""
+        if len(logs) > Config.RESULT_CACHE_MAX_ENTRY_BYTES:
+            logger.info(f"{script} 的日志 {len(logs)} 字节超过单条缓存上限，不缓存本次结果")
+            return False
+        codec = run_storage.default_codec()
+        now = datetime.utcnow()
+        session = SessionLocal()
+        try:
+            # 强制重新执行或条目已过期时替换旧结果
+            session.query(ScriptResultCache).filter(ScriptResultCache.cache_key == key) \
+                .delete(synchronize_session=False)
+            session.add(ScriptResultCache(
+                cache_key=key,
+                script_filename=script,
+                delta=delta,
+                log_codec=codec,
+                log_data=run_storage.compress(logs, codec),
+                size=len(logs) + len(json.dumps(delta, ensure_ascii=False, default=str).encode('utf-8')),
+                hits=0,
+                created_at=now,
+                expires_at=now + timedelta(seconds=ttl),
+                last_used_at=now,
+            ))
+            session.commit()
+            CACHE_STORES.inc()
+        except IntegrityError:
+            # 并发执行的相同输入已先写入
+            session.rollback()
+            return False
+        except Exception as e:
+            session.rollback()
+            logger.error(f"写入结果缓存失败: {e}")
+            return False
+        finally:
+            session.close()
+        try:
+            self.evict()
+        except Exception as e:
+            logger.error(f"结果缓存淘汰失败: {e}")
+        return True
+
+    def evict(self):
+        """删除过期条目；超出条目数或总字节数上限时从最久未使用的开始删除"""
+        session = SessionLocal()
+        try:
+            expired = session.query(ScriptResultCache) \
+                .filter(ScriptResultCache.expires_at <= datetime.utcnow()) \
+                .delete(synchronize_session=False)
+            if expired:
+                CACHE_EVICTIONS.labels(reason='ttl').inc(expired)
+            count, total = session.query(func.count(ScriptResultCache.id),
+                                         func.coalesce(func.sum(ScriptResultCache.size), 0)).one()
+            victims = []
+            if count > Config.RESULT_CACHE_MAX_ENTRIES or total > Config.RESULT_CACHE_MAX_BYTES:
+                for row in session.query(ScriptResultCache.id, ScriptResultCache.size) \
+                        .order_by(ScriptResultCache.last_used_at, ScriptResultCache.id).yield_per(500):
+                    if count <= Config.RESULT_CACHE_MAX_ENTRIES and total <= Config.RESULT_CACHE_MAX_BYTES:
+                        break
+                    victims.append(row.id)
+                    count -= 1
+                    total -= row.size or 0
+            if victims:
+                session.query(ScriptResultCache).filter(ScriptResultCache.id.in_(victims)) \
+                    .delete(synchronize_session=False)
+                CACHE_EVICTIONS.labels(reason='lru').inc(len(victims))
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def stats(self):
+        session = SessionLocal()
+        try:
+            count, total = session.query(func.count(ScriptResultCache.id),
+                                         func.coalesce(func.sum(ScriptResultCache.size), 0)).one()
+            return {
+                'enabled': Config.RESULT_CACHE_ENABLED,
+                'entries': count,
+                'bytes': int(total),
+                'max_entries': Config.RESULT_CACHE_MAX_ENTRIES,
+                'max_bytes': Config.RESULT_CACHE_MAX_BYTES,
+            }
+        finally:
+            session.close()
+
+
+result_cache = ResultCache()
@@ -0,0 +1,258 @@
+"""数据库中的持久运行队列（RUN_MODE=queue）。
+
+API 节点只写入 status='queued' 的 TaskRun；runner agent 领取后写入 claimed_by 与租约到期时间，
+执行期间定期续约。agent 崩溃或失联导致租约过期的运行由任意 agent 回收并重新入队，
+超过 RUNNER_MAX_ATTEMPTS 次的标记为失败。
+
+领取在 PostgreSQL 上使用 SELECT ... FOR UPDATE SKIP LOCKED，多个 agent 并发领取互不阻塞；
+其他数据库（SQLite）用带条件的 UPDATE 做比较交换，只有把 queued 改成 claimed 的那一个 agent 领取成功。
+本地模式（RUN_MODE=local）提交的运行在写入时就带有 claimed_by，不会被 agent 领取。
+"""
+import os
+import socket
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from app.core.config import Config
+from app.core import run_storage
+from app.models.db import SessionLocal, engine
+from app.models.task_models import TaskRun, TaskRunLog, TaskRunContext, TaskRunStep, TaskRunProfile
+from app.utils import metrics
+from app.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# 仍可能被执行的运行状态
+ACTIVE_STATUSES = ('queued', 'claimed', 'running')
+
+QUEUE_CLAIMS = metrics.counter('run_queue_claims_total', 'agent 领取的运行数')
+QUEUE_REQUEUED = metrics.counter('run_queue_requeued_total', '租约过期后重新入队的运行数', labels=('outcome',))
+QUEUE_LEASE_LOST = metrics.counter('run_queue_lease_lost_total', '续约时发现已失去租约的运行数')
+
+
+def node_name():
+    """当前进程的节点标识：主机名:pid"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def pending_count(session=None):
+    """等待 agent 领取的运行数"""
+    own = session is None
+    session = session or SessionLocal()
+    try:
+        return session.query(func.count(TaskRun.id)) \
+            .filter(TaskRun.status == 'queued', TaskRun.claimed_by.is_(None)).scalar() or 0
+    finally:
+        if own:
+            session.close()
+
+
+def position(run_id):
+    """运行在队列中的位置（1 开始），已被领取返回 0，不存在返回 None"""
+    session = SessionLocal()
+    try:
+        run = session.query(TaskRun.status, TaskRun.claimed_by).filter(TaskRun.id == run_id).first()
+        if run is None:
+            return None
+        if run.status != 'queued' or run.claimed_by is not None:
+            return 0
+        return session.query(func.count(TaskRun.id)) \
+            .filter(TaskRun.status == 'queued', TaskRun.claimed_by.is_(None), TaskRun.id <= run_id).scalar()
+    finally:
+        session.close()
+
+
+def _claim_fields(agent, now):
+    return {
+        'status': 'claimed',
+        'claimed_by': agent,
+        'lease_expires_at': now + timedelta(seconds=Config.RUNNER_LEASE_SECONDS),
+        'heartbeat_at': now,
+        'attempts': func.coalesce(TaskRun.attempts, 0) + 1,
+    }
+
+
+def claim(agent, limit=1):
+    """领取最多 limit 个运行，返回 [{'run_id', 'task_id', 'plan', 'initial_context', 'attempts'}]"""
+    if limit <= 0:
+        return []
+    session = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        if engine.dialect.name == 'postgresql':
+            ids = [row.id for row in session.query(TaskRun.id)
+                   .filter(TaskRun.status == 'queued', TaskRun.claimed_by.is_(None))
+                   .order_by(TaskRun.id).limit(limit).with_for_update(skip_locked=True)]
+            if ids:
+                session.query(TaskRun).filter(TaskRun.id.in_(ids)) \
+                    .update(_claim_fields(agent, now), synchronize_session=False)
+            session.commit()
+        else:
+            ids = []
+            candidates = [row.id for row in session.query(TaskRun.id)
+                          .filter(TaskRun.status == 'queued', TaskRun.claimed_by.is_(None))
+                          .order_by(TaskRun.id).limit(limit * 2)]
+            for run_id in candidates:
+                if len(ids) >= limit:
+                    break
+                updated = session.query(TaskRun) \
+                    .filter(TaskRun.id == run_id, TaskRun.status == 'queued', TaskRun.claimed_by.is_(None)) \
+                    .update(_claim_fields(agent, now), synchronize_session=False)
+                session.commit()
+                if updated:
+                    ids.append(run_id)
+        if not ids:
+            return []
+
+        rows = session.query(TaskRun.id, TaskRun.task_id, TaskRun.plan, TaskRun.initial_context,
+                             TaskRun.attempts).filter(TaskRun.id.in_(ids)).order_by(TaskRun.id).all()
+        retried = [row for row in rows if (row.attempts or 0) > 1]
+        if retried:
+            # 重新入队的运行清掉上一次尝试中未完成部分留下的日志块、上下文与脚本状态
+            for row in retried:
+                reset_partial(session, row.id, row.plan)
+            session.commit()
+        QUEUE_CLAIMS.inc(len(rows))
+        return [{
+            'run_id': row.id,
+            'task_id': row.task_id,
+            'plan': row.plan,
+            'initial_context': row.initial_context or {},
+            'attempts': row.attempts,
+        } for row in rows]
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def reset_partial(session, run_id, plan):
+    """删除运行中未完成脚本的日志块、上下文、剖析结果与脚本状态（不提交）。
+
+    plan 含 resume 时保留其中已完成的脚本，其余全部删除，重新执行时日志偏移从 0 开始。
+    """
+    resume = (plan or {}).get('resume') or {}
+    completed = set(resume.get('completed') or ())
+    scripts = (plan or {}).get('scripts') or []
+    kept = {scripts[i] for i in completed if i < len(scripts)}
+    if completed:
+        run_storage.drop_contexts(session, run_id, completed)
+    else:
+        session.query(TaskRunContext).filter(TaskRunContext.run_id == run_id).delete(synchronize_session=False)
+    for model in (TaskRunStep, TaskRunProfile):
+        query = session.query(model).filter(model.run_id == run_id)
+        if completed:
+            query = query.filter(model.position.notin_(completed))
+        query.delete(synchronize_session=False)
+    query = session.query(TaskRunLog).filter(TaskRunLog.run_id == run_id)
+    if kept:
+        query = query.filter(TaskRunLog.script_filename.notin_(kept))
+    query.delete(synchronize_session=False)
+    return [name for name in set(scripts) if name not in kept]
+
+
+def heartbeat(agent, run_ids):
+    """为 agent 持有的运行续约，返回已失去租约（被回收或被其他节点领取）的 run_id 集合。
+
+    requeue_expired 标记失败的运行保留 claimed_by 但清空了租约，同样视为失去租约，不会被续约复活。
+    """
+    run_ids = set(run_ids)
+    if not run_ids:
+        return set()
+    session = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        owned = (TaskRun.id.in_(run_ids), TaskRun.claimed_by == agent, TaskRun.lease_expires_at.isnot(None))
+        session.query(TaskRun) \
+            .filter(*owned) \
+            .update({'heartbeat_at': now,
+                     'lease_expires_at': now + timedelta(seconds=Config.RUNNER_LEASE_SECONDS)},
+                    synchronize_session=False)
+        session.commit()
+        held = {row.id for row in session.query(TaskRun.id).filter(*owned)}
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    lost = run_ids - held
+    if lost:
+        QUEUE_LEASE_LOST.inc(len(lost))
+    return lost
+
+
+def release(agent, run_ids):
+    """agent 主动交还持有的运行（停止时未能执行完）：未超过重试次数的立即重新入队，返回交还的 run_id 列表。
+
+    与租约过期一样计入 attempts，下一次领取时清理本次未完成部分留下的数据（见 reset_partial）。
+    """
+    run_ids = set(run_ids)
+    if not run_ids:
+        return []
+    session = SessionLocal()
+    try:
+        held = (TaskRun.id.in_(run_ids), TaskRun.claimed_by == agent,
+                func.coalesce(TaskRun.attempts, 0) < Config.RUNNER_MAX_ATTEMPTS)
+        released = [row.id for row in session.query(TaskRun.id).filter(*held)]
+        if released:
+            session.query(TaskRun).filter(TaskRun.id.in_(released), TaskRun.claimed_by == agent) \
+                .update({'status': 'queued', 'claimed_by': None, 'lease_expires_at': None, 'finished_at': None},
+                        synchronize_session=False)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    if released:
+        QUEUE_REQUEUED.labels(outcome='released').inc(len(released))
+    return sorted(released)
+
+
+def requeue_expired():
+    """回收租约已过期的运行：未超过重试次数的重新入队，否则标记失败；返回 (重新入队数, 失败数)"""
+    session = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        expired = (TaskRun.status.in_(('claimed', 'running')), TaskRun.lease_expires_at < now)
+        requeued = session.query(TaskRun) \
+            .filter(*expired, func.coalesce(TaskRun.attempts, 0) < Config.RUNNER_MAX_ATTEMPTS) \
+            .update({'status': 'queued', 'claimed_by': None, 'lease_expires_at': None},
+                    synchronize_session=False)
+        failed = session.query(TaskRun) \
+            .filter(*expired, func.coalesce(TaskRun.attempts, 0) >= Config.RUNNER_MAX_ATTEMPTS) \
+            .update({'status': 'failed', 'finished_at': now, 'lease_expires_at': None},
+                    synchronize_session=False)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    if requeued:
+        QUEUE_REQUEUED.labels(outcome='requeued').inc(requeued)
+        logger.warning(f"{requeued} 个运行的租约已过期，重新入队")
+    if failed:
+        QUEUE_REQUEUED.labels(outcome='failed').inc(failed)
+        logger.error(f"{failed} 个运行租约过期且已达重试上限 {Config.RUNNER_MAX_ATTEMPTS}，标记失败")
+    return requeued, failed
+
+
+def stats():
+    """队列积压与各 agent 当前持有的运行数"""
+    session = SessionLocal()
+    try:
+        agents = session.query(TaskRun.claimed_by, func.count(TaskRun.id), func.max(TaskRun.heartbeat_at)) \
+            .filter(TaskRun.status.in_(('claimed', 'running')), TaskRun.lease_expires_at.isnot(None)) \
+            .group_by(TaskRun.claimed_by).all()
+        return {
+            'mode': Config.RUN_MODE,
+            'queued': pending_count(session),
+            'agents': [{
+                'agent': name,
+                'runs': count,
+                'heartbeat_at': last.isoformat() if last else None,
+            } for name, count, last in agents],
+        }
+    finally:
+        session.close()
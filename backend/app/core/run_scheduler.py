@@ -0,0 +1,122 @@
+import threading
+import atexit
+from collections import deque
+from app.core.config import Config
+from app.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class QueueFullError(Exception):
+    """待执行队列已满，调用方应返回 429 让客户端稍后重试"""
+
+    def __init__(self, queue_depth, max_pending):
+        self.queue_depth = queue_depth
+        self.max_pending = max_pending
+        # 若被接收，该运行将处于的队列位置
+        self.queue_position = queue_depth + 1
+        super().__init__(f"待执行队列已满 ({queue_depth}/{max_pending})，请稍后重试")
+
+
+class RunScheduler:
+    """运行调度器 - 固定数量的工作线程执行编排任务，超出部分进入有界 FIFO 队列"""
+
+    def __init__(self, max_workers=None, max_pending=None):
+        self.max_workers = max(1, max_workers or Config.MAX_TASK_WORKERS)
+        self.max_pending = Config.MAX_PENDING_RUNS if max_pending is None else max_pending
+        self.pending = deque()  # [(run_id, fn, args)]
+        self.running = set()
+        self.cond = threading.Condition()
+        self._shutdown = False
+        self._workers = []
+        atexit.register(self.shutdown)
+        logger.info(f"RunScheduler 初始化完成: workers={self.max_workers}, max_pending={self.max_pending}")
+
+    def _start_workers(self):
+        """首次提交时才启动工作线程：RUN_MODE=queue 的 Web worker 从不在本进程执行运行。调用方需持有 self.cond"""
+        if self._workers:
+            return
+        for i in range(self.max_workers):
+            th = threading.Thread(target=self._worker_loop, name=f"run-worker-{i}")
+            th.daemon = True
+            th.start()
+            self._workers.append(th)
+
+    def _idle_workers(self):
+        return self.max_workers - len(self.running)
+
+    def _waiting(self):
+        """真正需要排队等待（没有空闲线程可立即领取）的运行数"""
+        return max(0, len(self.pending) - self._idle_workers())
+
+    def _is_full(self):
+        # 没有空闲线程可立即领取，且等待数已达上限
+        return len(self.pending) >= self._idle_workers() and self._waiting() >= self.max_pending
+
+    def is_full(self):
+        with self.cond:
+            return self._is_full()
+
+    def submit(self, run_id, fn, *args):
+        """提交运行，返回排队位置（0 表示将立即执行）；队列已满时抛出 QueueFullError"""
+        with self.cond:
+            if self._shutdown:
+                raise RuntimeError('调度器已关闭')
+            if self._is_full():
+                raise QueueFullError(self._waiting(), self.max_pending)
+            self._start_workers()
+            self.pending.append((run_id, fn, args))
+            position = self._waiting()
+            self.cond.notify()
+            return position
+
+    def position(self, run_id):
+        """返回运行在等待队列中的位置：0 表示执行中/即将执行，None 表示未知"""
+        with self.cond:
+            if run_id in self.running:
+                return 0
+            idle = self._idle_workers()
+            for idx, item in enumerate(self.pending):
+                if item[0] == run_id:
+                    return max(0, idx + 1 - idle)
+            return None
+
+    def stats(self):
+        with self.cond:
+            return {
+                'max_workers': self.max_workers,
+                'running': len(self.running),
+                'pending': self._waiting(),
+                'max_pending': self.max_pending,
+            }
+
+    def _worker_loop(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self._shutdown:
+                    self.cond.wait()
+                if self._shutdown:
+                    return
+                run_id, fn, args = self.pending.popleft()
+                self.running.add(run_id)
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.error(f"运行执行异常: run_id={run_id}, {e}")
+            finally:
+                with self.cond:
+                    self.running.discard(run_id)
+                    self.cond.notify_all()
+
+    def shutdown(self, wait=True, timeout=None):
+        """停止领取新运行；wait=True 时等待执行中的运行结束。返回仍在队列中的 run_id 列表"""
+        with self.cond:
+            if self._shutdown and not wait:
+                return [item[0] for item in self.pending]
+            self._shutdown = True
+            self.cond.notify_all()
+        if wait:
+            for th in self._workers:
+                th.join(timeout)
+        with self.cond:
+            return [item[0] for item in self.pending]
@@ -0,0 +1,354 @@
+"""运行日志 / 上下文的数据库存储。
+
+每个脚本的日志在脚本结束时按行边界切成若干块，压缩后作为 TaskRunLog 行保存，
+byte_offset / raw_size 记录该块在原始日志中的字节范围，读取时只解压与请求范围重叠的块；
+每个脚本执行后的上下文以相对上一条的增量保存为一行 TaskRunContext（见 context_history）。
+按需剖析的脚本性能数据（pstats 与折叠调用栈）压缩后保存为 TaskRunProfile 行（见 profiling）。
+
+偏移量与运行期间的日志文件完全一致，因此实时日志流的游标在运行结束后仍然有效。
+"""
+import gzip
+import threading
+from sqlalchemy import func
+from app.core.config import Config
+from app.models.db import SessionLocal
+from app.models.task_models import TaskRun, TaskRunLog, TaskRunContext, TaskRunProfile
+from app.core import context_history
+from app.utils import profiling
+from app.utils.file_reader import read_file_range
+from app.utils.logger import setup_logger
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = setup_logger(__name__)
+
+if Config.RUN_LOG_CODEC == 'zstd' and zstandard is None:
+    logger.warning("未安装 zstandard，运行日志改用 gzip 压缩")
+
+
+def default_codec():
+    if Config.RUN_LOG_CODEC == 'zstd':
+        return 'zstd' if zstandard is not None else 'gzip'
+    return Config.RUN_LOG_CODEC if Config.RUN_LOG_CODEC in ('gzip', 'none') else 'gzip'
+
+
+def compress(data, codec):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    if codec == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+    return data
+
+
+def decompress(data, codec):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('读取 zstd 压缩的日志需要安装 zstandard')
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == 'gzip':
+        return gzip.decompress(data)
+    return data
+
+
+def build_log_chunks(run_id, script, path, start=0, end=None, codec=None):
+    """把日志文件 [start, end) 切块压缩，返回 TaskRunLog 行的字段 dict 列表（不写库）"""
+    codec = codec or default_codec()
+    rows = []
+    for offset, data in read_file_range(path, start, end, chunk_size=Config.RUN_LOG_CHUNK_BYTES):
+        rows.append({
+            'run_id': run_id,
+            'script_filename': script,
+            'byte_offset': offset,
+            'raw_size': len(data),
+            'codec': codec,
+            'data': compress(data, codec),
+        })
+    return rows
+
+
+class LogShipper:
+    """边写边上报日志块（runner agent 使用）：API 节点没有运行目录，只能从数据库读取执行中的日志。
+
+    feed 收到的是写入日志文件的原始字节，缓冲满 RUN_LOG_CHUNK_BYTES 或距首次缓冲超过 interval 秒时
+    压缩为一块交给 sink（通常为 db_writer.insert），偏移量与日志文件一致。
+    """
+
+    def __init__(self, run_id, script, offset, sink, interval=None, codec=None):
+        self.run_id = run_id
+        self.script = script
+        self.offset = offset  # 缓冲区起始位置在日志中的偏移
+        self.sink = sink
+        self.interval = Config.RUNNER_LOG_SHIP_INTERVAL if interval is None else interval
+        self.codec = codec or default_codec()
+        self.buffer = bytearray()
+        self.lock = threading.Lock()
+        self._timer = None
+
+    def feed(self, offset, data):
+        with self.lock:
+            if offset != self.offset + len(self.buffer):
+                # 不连续（不应发生）：先把已缓冲的部分发出，从新偏移重新开始
+                self._ship()
+                self.offset = offset
+            self.buffer += data
+            if len(self.buffer) >= Config.RUN_LOG_CHUNK_BYTES:
+                self._ship()
+            elif self._timer is None and self.interval > 0:
+                self._timer = threading.Timer(self.interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self.lock:
+            self._ship()
+
+    def close(self):
+        self.flush()
+
+    def _ship(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self.buffer:
+            return
+        data = bytes(self.buffer)
+        self.sink({
+            'run_id': self.run_id,
+            'script_filename': self.script,
+            'byte_offset': self.offset,
+            'raw_size': len(data),
+            'codec': self.codec,
+            'data': compress(data, self.codec),
+        })
+        self.offset += len(data)
+        self.buffer.clear()
+
+
+def list_logs(run_id):
+    """数据库中有日志的脚本：{script: (总字节数, 最早写入时间)}"""
+    session = SessionLocal()
+    try:
+        rows = session.query(
+            TaskRunLog.script_filename,
+            func.max(TaskRunLog.byte_offset + TaskRunLog.raw_size),
+            func.min(TaskRunLog.created_at),
+        ).filter(TaskRunLog.run_id == run_id, TaskRunLog.byte_offset.isnot(None)) \
+            .group_by(TaskRunLog.script_filename).all()
+        return {name: (size or 0, created_at) for name, size, created_at in rows}
+    finally:
+        session.close()
+
+
+def _load_chunks(session, run_id, script, start, end, limit=None):
+    """按偏移顺序取与 [start, end) 重叠的块，返回 [(byte_offset, 原始字节)]"""
+    query = session.query(TaskRunLog.byte_offset, TaskRunLog.codec, TaskRunLog.data) \
+        .filter(TaskRunLog.run_id == run_id,
+                TaskRunLog.script_filename == script,
+                TaskRunLog.byte_offset + TaskRunLog.raw_size > start)
+    if end is not None:
+        query = query.filter(TaskRunLog.byte_offset < end)
+    query = query.order_by(TaskRunLog.byte_offset)
+    if limit:
+        query = query.limit(limit)
+    return [(offset, decompress(data, codec)) for offset, codec, data in query]
+
+
+def read_log_range(run_id, script, size, offset=0, limit=None):
+    """与 file_reader.read_range 相同的语义，只解压请求范围内的块"""
+    limit = Config.LOG_READ_MAX_BYTES if limit is None else limit
+    if offset < 0:
+        offset = max(0, size + offset)
+    offset = min(offset, size)
+    end = min(size, offset + max(0, limit))
+    session = SessionLocal()
+    try:
+        chunks = _load_chunks(session, run_id, script, offset, end) if end > offset else []
+    finally:
+        session.close()
+    data = b''.join(piece for _, piece in chunks)
+    if chunks:
+        data = data[offset - chunks[0][0]:end - chunks[0][0]]
+    end = offset + len(data)
+    if end < size:
+        cut = data.rfind(b'\n') + 1
+        if cut > 0:
+            data = data[:cut]
+            end = offset + cut
+    return {
+        'content': data.decode('utf-8', errors='replace'),
+        'offset': offset,
+        'next_offset': end,
+        'size': size,
+        'eof': end >= size,
+    }
+
+
+def tail_log(run_id, script, lines=100):
+    """从最后一块往前解压，直到凑够 N 行；返回 (文本, 起始偏移, 总字节数)"""
+    session = SessionLocal()
+    try:
+        metas = session.query(TaskRunLog.id, TaskRunLog.byte_offset, TaskRunLog.raw_size) \
+            .filter(TaskRunLog.run_id == run_id, TaskRunLog.script_filename == script,
+                    TaskRunLog.byte_offset.isnot(None)) \
+            .order_by(TaskRunLog.byte_offset.desc()).all()
+        if not metas:
+            return '', 0, 0
+        size = metas[0].byte_offset + metas[0].raw_size
+        if lines <= 0:
+            return '', size, size
+        data = b''
+        for meta in metas:
+            codec, raw = session.query(TaskRunLog.codec, TaskRunLog.data) \
+                .filter(TaskRunLog.id == meta.id).one()
+            data = decompress(raw, codec) + data
+            if data.count(b'\n') > lines:
+                break
+    finally:
+        session.close()
+    parts = data.split(b'\n')
+    keep = parts[-(lines + 1):] if data.endswith(b'\n') else parts[-lines:]
+    text = b'\n'.join(keep)
+    return text.decode('utf-8', errors='replace'), size - len(text), size
+
+
+def iter_log_range(run_id, script, start, end=None, batch=8):
+    """逐块产出 (offset, data)，供实时日志流在运行结束后补读；每次只取 batch 块"""
+    pos = start
+    while end is None or pos < end:
+        session = SessionLocal()
+        try:
+            chunks = _load_chunks(session, run_id, script, pos, end, limit=batch)
+        finally:
+            session.close()
+        if not chunks:
+            return
+        for offset, data in chunks:
+            if offset < pos:
+                data, offset = data[pos - offset:], pos
+            if end is not None and offset + len(data) > end:
+                data = data[:end - offset]
+            if data:
+                yield offset, data
+                pos = offset + len(data)
+
+
+def _context_entry(row):
+    entry = {
+        'position': row.position,
+        'script': row.script_filename,
+        'created_at': row.created_at.isoformat() if row.created_at else None,
+    }
+    # 旧版本写入的行只有完整快照
+    if row.context is not None or row.delta is None:
+        entry['context'] = row.context or {}
+    else:
+        entry['delta'] = row.delta
+    return entry
+
+
+def context_entries(run_id, session=None):
+    """数据库中的上下文历史条目，按写入顺序（增量依次相对前一条）"""
+    own = session is None
+    session = session or SessionLocal()
+    try:
+        rows = session.query(TaskRunContext).filter(TaskRunContext.run_id == run_id) \
+            .order_by(TaskRunContext.id).all()
+        return [dict(_context_entry(row), id=row.id) for row in rows]
+    finally:
+        if own:
+            session.close()
+
+
+def initial_context(run_id):
+    session = SessionLocal()
+    try:
+        row = session.query(TaskRun.initial_context).filter(TaskRun.id == run_id).first()
+        return (row.initial_context if row else None) or {}
+    finally:
+        session.close()
+
+
+def latest_context(run_id):
+    """最后一条记录之后的上下文（即最近完成的脚本之后的合并结果），没有记录时返回 None"""
+    entries = context_entries(run_id)
+    if not entries:
+        return None
+    return context_history.latest(initial_context(run_id), entries)
+
+
+def drop_contexts(session, run_id, keep_positions):
+    """删除 position 不在 keep_positions 中的上下文行（不提交），保留行的历史仍可完整还原"""
+    entries = context_entries(run_id, session)
+    if not entries:
+        return
+    row = session.query(TaskRun.initial_context).filter(TaskRun.id == run_id).first()
+    kept, rebased = context_history.drop(row.initial_context if row else {}, entries, set(keep_positions))
+    kept_ids = {entry['id'] for entry in kept}
+    dropped = [entry['id'] for entry in entries if entry['id'] not in kept_ids]
+    if dropped:
+        session.query(TaskRunContext).filter(TaskRunContext.id.in_(dropped)).delete(synchronize_session=False)
+    for entry in rebased:
+        session.query(TaskRunContext).filter(TaskRunContext.id == entry['id']) \
+            .update({'context': entry['context'], 'delta': None}, synchronize_session=False)
+
+
+def read_profile_files(prefix):
+    """读取脚本日志旁的剖析结果，返回 (mode, pstats 字节, 折叠调用栈字节)；没有结果时返回 None"""
+    data = []
+    for path in profiling.artifact_paths(prefix):
+        try:
+            with open(path, 'rb') as f:
+                data.append(f.read())
+        except FileNotFoundError:
+            data.append(None)
+    pstats_data, collapsed = data
+    if collapsed is None:
+        return None
+    return ('cprofile' if pstats_data is not None else 'sampling'), pstats_data, collapsed
+
+
+def build_profile_row(run_id, position, script, prefix, codec=None):
+    """把脚本的剖析结果文件压缩为 TaskRunProfile 行的字段 dict（不写库），没有结果文件时返回 None"""
+    found = read_profile_files(prefix)
+    if found is None:
+        return None
+    mode, pstats_data, collapsed = found
+    codec = codec or default_codec()
+    return {
+        'run_id': run_id,
+        'position': position,
+        'script_filename': script,
+        'mode': mode,
+        'codec': codec,
+        'pstats': compress(pstats_data, codec) if pstats_data is not None else None,
+        'collapsed': compress(collapsed, codec),
+    }
+
+
+def list_profiles(run_id):
+    """数据库中有剖析结果的脚本：{script: (mode, 写入时间)}，同一脚本执行多次时取最后一次"""
+    session = SessionLocal()
+    try:
+        rows = session.query(TaskRunProfile.script_filename, TaskRunProfile.mode, TaskRunProfile.created_at) \
+            .filter(TaskRunProfile.run_id == run_id).order_by(TaskRunProfile.id).all()
+        return {name: (mode, created_at) for name, mode, created_at in rows}
+    finally:
+        session.close()
+
+
+def load_profile(run_id, script):
+    """数据库中该脚本最后一次的剖析结果 (mode, pstats 字节, 折叠调用栈字节)，没有时返回 None"""
+    session = SessionLocal()
+    try:
+        row = session.query(TaskRunProfile).filter(TaskRunProfile.run_id == run_id,
+                                                    TaskRunProfile.script_filename == script) \
+            .order_by(TaskRunProfile.id.desc()).first()
+        if row is None:
+            return None
+        pstats_data = decompress(row.pstats, row.codec) if row.pstats is not None else None
+        return row.mode, pstats_data, decompress(row.collapsed or b'', row.codec)
+    finally:
+        session.close()
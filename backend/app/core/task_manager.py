@@ -2,12 +2,15 @@ import os
 import json
 import uuid
 import threading
+from collections import deque
 from app.utils.script_runner import run_script
+from app.utils.log_writer import ScriptLogWriter
 from datetime import datetime
 from pathlib import Path
 from app.utils.logger import setup_logger
 from app.core.config import Config
 from app.utils.process_lock import ProcessLock
+from app.core.run_scheduler import QueueFullError
 
 logger = setup_logger(__name__)
 
@@ -24,6 +27,15 @@ class TaskManager:
         self.process_lock = ProcessLock()
         from app.services.task_service import TaskService
         self.task_service = TaskService()
+        # 回收上次进程退出时遗留的运行，并为本进程的运行维持心跳
+        self.task_service.start_heartbeat()
+        from app.core.task_scheduler import TaskScheduler
+        self.task_scheduler = TaskScheduler(self.task_service, self.process_lock)
+        if Config.SCHEDULER_ENABLED:
+            self.task_scheduler.start()
+        if Config.LOG_RETENTION_ENABLED:
+            from app.core import log_retention
+            log_retention.start()
         logger.info("TaskManager 初始化完成")
     
     def list_tasks(self):
@@ -65,10 +77,10 @@ class TaskManager:
             logger.error(f"获取任务信息失败: {e}")
             return None
     
-    def create_db_task(self, name, description, script_filenames):
+    def create_db_task(self, name, description, script_filenames, parallelism=None, merge_policy=None):
         """通过数据库创建任务并编排脚本"""
         try:
-            task_id = self.task_service.create_task(name, description, script_filenames)
+            task_id = self.task_service.create_task(name, description, script_filenames, parallelism, merge_policy)
             logger.info(f"数据库任务创建成功: {task_id}")
             return True, task_id
         except Exception as e:
@@ -104,12 +116,16 @@ class TaskManager:
             logger.error(f"删除任务失败: {e}")
             return False, str(e)
     
-    def execute_db_task(self, task_id, context=None):
-        """通过数据库任务编排执行任务"""
+    def execute_db_task(self, task_id, context=None, force=False, profile=None):
+        """通过数据库任务编排执行任务；force 为 True 时忽略脚本的结果缓存，profile 为 cprofile / sampling 时剖析每个脚本"""
         try:
-            run_id, msg = self.task_service.run_task(task_id, context)
+            run_id, msg = self.task_service.run_task(task_id, context, force=force, profile=profile)
             logger.info(f"数据库任务执行: {task_id}, run_id: {run_id}")
             return run_id, msg
+        except QueueFullError as e:
+            # 背压：交由路由层返回 429
+            logger.warning(f"数据库任务被拒绝: {task_id}, {e}")
+            raise
         except Exception as e:
             logger.error(f"数据库任务执行失败: {e}")
             return None, str(e)
@@ -117,73 +133,47 @@ class TaskManager:
     def _execute_task_thread(self, task_id, run_id, task_path, params):
         """后台线程执行任务"""
         log_file = os.path.join(self.logs_dir, f"{task_id}_{run_id}.log")
-        manager = None
         try:
             # 构建命令
             cmd = ['python', task_path]
             if params:
                 cmd.extend([str(p) for p in params])
 
-            # 使用 Manager 提供共享上下文代理，方便脚本通过 SDK 读取/写入
-            from multiprocessing import Manager
-            manager = Manager()
-            context_proxy = manager.dict()
+            # 上下文以快照方式传入子进程，脚本通过 SDK 读取/写入
+            context = {}
 
-            # create a log queue and start consumer to capture streaming logs
-            from multiprocessing import Queue as MPQueue
-            log_queue = MPQueue()
-
-            stop_evt = threading.Event()
-            stream_logs = []
-            def _consume(q, stop_event, storage, logfile_path):
-                try:
-                    with open(logfile_path, 'a', encoding='utf-8') as lf:
-                        while not stop_event.is_set() or not q.empty():
-                            try:
-                                level, msg = q.get(timeout=0.5)
-                                line = f"[{level}] {msg}\n"
-                                storage.append(line)
-                                lf.write(line)
-                                lf.flush()
-                            except Exception:
-                                continue
-                except Exception:
-                    pass
-
-            logfile_path = os.path.join(self.logs_dir, f"{task_id}_{run_id}.log")
-            consumer_th = threading.Thread(target=_consume, args=(log_queue, stop_evt, stream_logs, logfile_path))
-            consumer_th.daemon = True
-            consumer_th.start()
+            # SDK 日志在子进程攒批后直接写入日志文件，内存中只保留尾部
+            stream_logs = deque(maxlen=Config.LOG_TAIL_LINES)
+            log_writer = ScriptLogWriter(log_file, tail=stream_logs)
 
             # 调用运行器
             params_for_run = cmd[1:] if len(cmd) > 1 else None
-            output, returncode, timed_out = run_script(
-                task_path,
-                params=params_for_run,
-                env=None,
-                cwd=self.tasks_dir,
-                timeout=self.task_timeout,
-                context_proxy=context_proxy,
-                log_queue=log_queue,
-            )
+            try:
+                output, returncode, timed_out = run_script(
+                    task_path,
+                    params=params_for_run,
+                    env=None,
+                    cwd=self.tasks_dir,
+                    timeout=self.task_timeout,
+                    context=context,
+                    log_sink=log_writer,
+                )
+            finally:
+                log_writer.close()
 
-            with open(log_file, 'w', encoding='utf-8') as lf:
-                lf.write(output or '')
+            if output:
+                with open(log_file, 'a', encoding='utf-8') as lf:
+                    lf.write(output)
 
             if timed_out:
                 status = 'timeout'
             else:
                 status = 'success' if returncode == 0 else 'failed'
 
-            # stop consumer and attach stream logs to active_tasks if present
-            try:
-                stop_evt.set()
-                consumer_th.join(timeout=1)
-            except Exception:
-                pass
+            # attach stream logs to active_tasks if present
             try:
                 if run_id in self.active_tasks:
-                    self.active_tasks[run_id].setdefault('stream_logs', []).extend(stream_logs)
+                    self.active_tasks[run_id]['stream_logs'] = stream_logs
             except Exception:
                 pass
 
@@ -201,13 +191,7 @@ class TaskManager:
                     self.active_tasks[run_id]['status'] = status
                     self.active_tasks[run_id]['end_time'] = datetime.now().isoformat()
 
-            # 关闭 manager（如果存在）并释放进程锁
-            try:
-                if manager is not None:
-                    manager.shutdown()
-            except Exception:
-                pass
-
+            # 释放进程锁
             try:
                 self.process_lock.release_lock(task_id)
             except Exception:
@@ -0,0 +1,437 @@
+"""编排任务的定时触发（cron 表达式 / 固定间隔）。
+
+所有定时配置共用一个计时线程：按触发时间维护一个最小堆，线程只睡到堆顶的时间；
+定时配置增删改时通过条件变量唤醒重新排期，不为每个定时配置单独开线程。
+
+- 抖动：每次触发在计划时间后随机延迟 0~jitter_seconds 秒，避免大量定时配置同时打满执行队列
+- 错过触发（停机、线程被阻塞等导致晚于计划时间超过宽限期）：
+  skip 直接跳到下一个计划时间；catchup 立即补触发，最多 catchup_limit 次
+- 重叠：以任务为粒度用 ProcessLock 标记定时触发的运行是否还在执行，
+  skip 跳过本次；queue 在上一次结束后立即补一次（最多排队一次）；allow 不限制
+
+下一次计划时间写回 task_schedules.next_fire_at，重启后据此判断停机期间错过的触发；
+其他进程对定时配置的修改按 SCHEDULE_RELOAD_INTERVAL 从数据库同步。
+"""
+import time
+import heapq
+import atexit
+import random
+import itertools
+import threading
+from datetime import datetime, timedelta, timezone
+from apscheduler.triggers.cron import CronTrigger
+from app.core.config import Config
+from app.core.run_scheduler import QueueFullError
+from app.models.db import SessionLocal
+from app.models.task_models import Task, TaskSchedule
+from app.utils import metrics
+from app.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+MISFIRE_POLICIES = ('skip', 'catchup')
+OVERLAP_POLICIES = ('skip', 'queue', 'allow')
+
+SCHEDULE_FIRES = metrics.counter('schedule_fires_total', '定时触发次数', labels=('outcome',))
+SCHEDULE_LAG = metrics.histogram('schedule_fire_lag_seconds', '实际触发时间相对计划时间（含抖动）的延迟')
+
+# 可通过接口修改的字段
+SCHEDULE_FIELDS = ('cron', 'interval_seconds', 'timezone', 'jitter_seconds', 'misfire_policy',
+                   'catchup_limit', 'misfire_grace_seconds', 'overlap_policy', 'context', 'enabled')
+# 修改后需要重新计算下一次触发时间的字段
+_TIMING_FIELDS = ('cron', 'interval_seconds', 'timezone')
+
+
+class ScheduleError(ValueError):
+    """定时配置不合法"""
+
+
+def _utcnow():
+    return datetime.now(timezone.utc)
+
+
+def _to_db(dt):
+    """带时区的时间 -> 数据库中的 UTC naive 时间"""
+    return dt.astimezone(timezone.utc).replace(tzinfo=None) if dt else None
+
+
+def _from_db(dt):
+    return dt.replace(tzinfo=timezone.utc) if dt else None
+
+
+def build_trigger(cron, tz=None):
+    """解析 5 段 crontab 表达式，不合法时抛出 ScheduleError"""
+    try:
+        return CronTrigger.from_crontab(cron, timezone=tz or Config.SCHEDULER_TIMEZONE)
+    except Exception as e:
+        raise ScheduleError(f"无效的 cron 表达式或时区: {cron} ({e})")
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def validate_schedule(fields):
+    """校验合并后的定时配置字段（dict），不合法时抛出 ScheduleError"""
+    cron, interval = fields.get('cron'), fields.get('interval_seconds')
+    if bool(cron) == (interval is not None):
+        raise ScheduleError('cron 与 interval_seconds 必须且只能指定一个')
+    if cron:
+        if not isinstance(cron, str):
+            raise ScheduleError('cron 必须是字符串')
+        build_trigger(cron, fields.get('timezone'))
+    elif not _is_int(interval) or interval < 1:
+        raise ScheduleError('interval_seconds 必须是正整数')
+    for name in ('jitter_seconds', 'catchup_limit', 'misfire_grace_seconds'):
+        value = fields.get(name)
+        if value is not None and (not _is_int(value) or value < 0):
+            raise ScheduleError(f"{name} 必须是非负整数")
+    if fields.get('misfire_policy', 'skip') not in MISFIRE_POLICIES:
+        raise ScheduleError(f"misfire_policy 必须是 {'/'.join(MISFIRE_POLICIES)} 之一")
+    if fields.get('overlap_policy', 'skip') not in OVERLAP_POLICIES:
+        raise ScheduleError(f"overlap_policy 必须是 {'/'.join(OVERLAP_POLICIES)} 之一")
+    if fields.get('context') is not None and not isinstance(fields['context'], dict):
+        raise ScheduleError('context 必须是对象')
+
+
+class _Plan:
+    """单个定时配置在计时线程中的状态"""
+
+    def __init__(self, row):
+        self.id = row.id
+        self.task_id = row.task_id
+        self.updated_at = row.updated_at
+        self.interval = row.interval_seconds
+        self.trigger = build_trigger(row.cron, row.timezone) if row.cron else None
+        self.jitter = max(0, row.jitter_seconds or 0)
+        self.misfire_policy = row.misfire_policy or 'skip'
+        self.catchup_limit = 1 if row.catchup_limit is None else max(0, row.catchup_limit)
+        self.grace = Config.SCHEDULE_MISFIRE_GRACE if row.misfire_grace_seconds is None \
+            else row.misfire_grace_seconds
+        self.overlap_policy = row.overlap_policy or 'skip'
+        self.context = dict(row.context or {})
+        self.nominal = _from_db(row.next_fire_at)  # 下一次计划时间（不含抖动）
+        self.token = None  # 堆中有效条目的序号，重新排期后旧条目作废
+        self.queued = False  # overlap=queue 时是否有一次等待补触发
+
+    def next_after(self, moment):
+        """严格晚于 moment 的下一个计划时间；cron 不再触发时返回 None"""
+        if self.trigger is not None:
+            return self.trigger.get_next_fire_time(moment, moment + timedelta(microseconds=1))
+        return moment + timedelta(seconds=self.interval)
+
+    def first_after(self, nominal, now):
+        """从 nominal 起的计划序列中第一个晚于 now 的时间"""
+        if self.trigger is not None:
+            return self.trigger.get_next_fire_time(None, max(nominal, now) + timedelta(microseconds=1))
+        steps = int((now - nominal).total_seconds() // self.interval) + 1 if now >= nominal else 1
+        return nominal + timedelta(seconds=steps * self.interval)
+
+
+class TaskScheduler:
+    """定时触发器 - 单线程 + 触发时间最小堆"""
+
+    def __init__(self, task_service, process_lock):
+        self.task_service = task_service
+        self.process_lock = process_lock
+        self.cond = threading.Condition()
+        self.plans = {}  # schedule_id -> _Plan
+        self.heap = []   # [(触发时间戳, 序号, schedule_id, 类型)]，类型为 due（计划触发）/ queued（排队补触发）
+        self._seq = itertools.count(1)
+        self._stopped = False
+        self._thread = None
+
+    # ---- 计时线程 ----
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.reload()
+        self._thread = threading.Thread(target=self._loop, name='task-scheduler')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.shutdown)
+        logger.info(f"TaskScheduler 已启动: {len(self.plans)} 个定时配置")
+
+    def shutdown(self):
+        with self.cond:
+            self._stopped = True
+            self.cond.notify_all()
+
+    def _loop(self):
+        next_reload = time.monotonic() + Config.SCHEDULE_RELOAD_INTERVAL
+        while True:
+            with self.cond:
+                while not self._stopped:
+                    timeout = next_reload - time.monotonic()
+                    if self.heap:
+                        timeout = min(timeout, self.heap[0][0] - time.time())
+                    if timeout <= 0:
+                        break
+                    self.cond.wait(timeout)
+                if self._stopped:
+                    return
+                due = []
+                now = time.time()
+                while self.heap and self.heap[0][0] <= now:
+                    due.append(heapq.heappop(self.heap))
+
+            if time.monotonic() >= next_reload:
+                next_reload = time.monotonic() + Config.SCHEDULE_RELOAD_INTERVAL
+                try:
+                    self.reload()
+                except Exception as e:
+                    logger.error(f"同步定时配置失败: {e}")
+            for entry in due:
+                try:
+                    self._handle(entry)
+                except Exception as e:
+                    logger.error(f"处理定时触发失败 schedule={entry[2]}: {e}")
+
+    def _push(self, plan, when_ts, kind='due'):
+        """调用方需持有 self.cond"""
+        seq = next(self._seq)
+        if kind == 'due':
+            plan.token = seq
+        heapq.heappush(self.heap, (when_ts, seq, plan.id, kind))
+        self.cond.notify_all()
+
+    def _arm(self, plan):
+        """把下一次计划触发放入堆中（加上随机抖动）；调用方需持有 self.cond"""
+        if plan.nominal is None:
+            plan.token = None
+            return
+        jitter = random.uniform(0, plan.jitter) if plan.jitter else 0
+        self._push(plan, plan.nominal.timestamp() + jitter)
+
+    def _handle(self, entry):
+        planned, seq, schedule_id, kind = entry
+        with self.cond:
+            plan = self.plans.get(schedule_id)
+            if plan is None or (kind == 'due' and plan.token != seq):
+                return  # 定时配置已删除或已重新排期
+
+            fires = 1
+            if kind == 'due':
+                now = _utcnow()
+                nominal = plan.nominal
+                late = time.time() - planned
+                if late > plan.grace:
+                    # 统计错过的计划时间，最多数到补触发上限即可
+                    missed, moment = 0, nominal
+                    while moment is not None and moment <= now and missed <= plan.catchup_limit:
+                        missed += 1
+                        moment = plan.next_after(moment)
+                    fires = min(missed, plan.catchup_limit) if plan.misfire_policy == 'catchup' else 0
+                    plan.nominal = plan.first_after(nominal, now)
+                    logger.warning(f"定时配置 {plan.id}（任务 {plan.task_id}）错过触发 {late:.0f}s，"
+                                   f"策略 {plan.misfire_policy}，补触发 {fires} 次")
+                    if missed > fires:
+                        SCHEDULE_FIRES.labels(outcome='misfire_skipped').inc(missed - fires)
+                else:
+                    plan.nominal = plan.next_after(nominal)
+                self._arm(plan)
+                next_fire_at = _to_db(plan.nominal)
+
+        if kind == 'due':
+            self._save(schedule_id, next_fire_at=next_fire_at)
+        SCHEDULE_LAG.observe(max(0.0, time.time() - planned))
+        for _ in range(fires):
+            self._fire(plan)
+
+    def _lock_key(self, task_id):
+        return f"schedule:task:{task_id}"
+
+    def _fire(self, plan):
+        """提交一次运行，按重叠策略处理上一次尚未结束的情况"""
+        key = self._lock_key(plan.task_id)
+        locked = False
+        if plan.overlap_policy != 'allow':
+            if self.process_lock.is_task_running(key) or not self.process_lock.acquire_lock(key, timeout=0):
+                if plan.overlap_policy == 'queue':
+                    with self.cond:
+                        plan.queued = True
+                    SCHEDULE_FIRES.labels(outcome='queued').inc()
+                    logger.info(f"定时配置 {plan.id}: 任务 {plan.task_id} 上一次运行未结束，排队等待")
+                else:
+                    SCHEDULE_FIRES.labels(outcome='skipped_overlap').inc()
+                    logger.info(f"定时配置 {plan.id}: 任务 {plan.task_id} 上一次运行未结束，跳过本次触发")
+                return
+            locked = True
+
+        on_finish = (lambda run_id, status: self._on_run_finished(plan.task_id)) if locked else None
+        try:
+            run_id, message = self.task_service.run_task(plan.task_id, dict(plan.context), on_finish=on_finish)
+            outcome = 'fired' if run_id else 'error'
+        except QueueFullError as e:
+            run_id, message, outcome = None, str(e), 'queue_full'
+        except Exception as e:
+            run_id, message, outcome = None, str(e), 'error'
+        SCHEDULE_FIRES.labels(outcome=outcome).inc()
+
+        if run_id is None:
+            if locked:
+                self.process_lock.release_lock(key)
+            logger.warning(f"定时配置 {plan.id} 触发任务 {plan.task_id} 失败: {message}")
+            return
+        logger.info(f"定时配置 {plan.id} 触发任务 {plan.task_id}: run_id={run_id}")
+        self._save(plan.id, last_fire_at=datetime.utcnow(), last_run_id=run_id)
+
+    def _on_run_finished(self, task_id):
+        """定时触发的运行结束：释放重叠锁，若有排队的触发则立即补一次"""
+        self.process_lock.release_lock(self._lock_key(task_id))
+        with self.cond:
+            for plan in sorted(self.plans.values(), key=lambda p: p.id):
+                if plan.task_id == task_id and plan.queued:
+                    plan.queued = False
+                    self._push(plan, time.time(), kind='queued')
+                    break
+
+    def _save(self, schedule_id, **fields):
+        session = SessionLocal()
+        try:
+            session.query(TaskSchedule).filter(TaskSchedule.id == schedule_id) \
+                .update(fields, synchronize_session=False)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(f"保存定时配置 {schedule_id} 状态失败: {e}")
+        finally:
+            session.close()
+
+    def reload(self):
+        """从数据库同步定时配置：新增 / 修改（updated_at 变化）的重新排期，停用或删除的移出"""
+        session = SessionLocal()
+        try:
+            rows = session.query(TaskSchedule).filter(TaskSchedule.enabled.is_(True)).all()
+        finally:
+            session.close()
+
+        unsaved = []
+        with self.cond:
+            seen = set()
+            now = _utcnow()
+            for row in rows:
+                seen.add(row.id)
+                plan = self.plans.get(row.id)
+                if plan is not None and plan.updated_at == row.updated_at:
+                    continue
+                try:
+                    new = _Plan(row)
+                except ScheduleError as e:
+                    logger.error(f"定时配置 {row.id} 无效，已忽略: {e}")
+                    continue
+                if plan is not None:
+                    new.queued = plan.queued
+                if new.nominal is None:
+                    start = now - timedelta(microseconds=1)
+                    new.nominal = new.next_after(start)
+                    unsaved.append((new.id, _to_db(new.nominal)))
+                self.plans[row.id] = new
+                self._arm(new)
+            for schedule_id in list(self.plans):
+                if schedule_id not in seen:
+                    del self.plans[schedule_id]
+        for schedule_id, next_fire_at in unsaved:
+            self._save(schedule_id, next_fire_at=next_fire_at)
+
+    # ---- 定时配置管理 ----
+
+    def _to_dict(self, row):
+        with self.cond:
+            plan = self.plans.get(row.id)
+            next_fire_at = _to_db(plan.nominal) if plan is not None else row.next_fire_at
+            queued = plan.queued if plan is not None else False
+        return {
+            'id': row.id,
+            'task_id': row.task_id,
+            'cron': row.cron,
+            'interval_seconds': row.interval_seconds,
+            'timezone': row.timezone or (Config.SCHEDULER_TIMEZONE if row.cron else None),
+            'jitter_seconds': row.jitter_seconds or 0,
+            'misfire_policy': row.misfire_policy or 'skip',
+            'catchup_limit': 1 if row.catchup_limit is None else row.catchup_limit,
+            'misfire_grace_seconds': row.misfire_grace_seconds,
+            'overlap_policy': row.overlap_policy or 'skip',
+            'context': row.context or {},
+            'enabled': bool(row.enabled),
+            'next_fire_at': next_fire_at.isoformat() if next_fire_at and row.enabled else None,
+            'last_fire_at': row.last_fire_at.isoformat() if row.last_fire_at else None,
+            'last_run_id': row.last_run_id,
+            'queued': queued,
+        }
+
+    def list_schedules(self, task_id=None):
+        session = SessionLocal()
+        try:
+            query = session.query(TaskSchedule)
+            if task_id is not None:
+                query = query.filter(TaskSchedule.task_id == task_id)
+            return [self._to_dict(row) for row in query.order_by(TaskSchedule.id)]
+        finally:
+            session.close()
+
+    def create_schedule(self, task_id, data):
+        """为任务新增定时配置；任务不存在返回 None，配置不合法时抛出 ScheduleError"""
+        fields = {k: data[k] for k in SCHEDULE_FIELDS if data.get(k) is not None}
+        fields.setdefault('enabled', True)
+        validate_schedule(fields)
+        session = SessionLocal()
+        try:
+            if session.query(Task.id).filter(Task.id == task_id).first() is None:
+                return None
+            row = TaskSchedule(task_id=task_id, **fields)
+            session.add(row)
+            session.commit()
+            schedule_id = row.id
+        finally:
+            session.close()
+        self.reload()
+        return self.get_schedule(schedule_id)
+
+    def get_schedule(self, schedule_id):
+        session = SessionLocal()
+        try:
+            row = session.query(TaskSchedule).filter(TaskSchedule.id == schedule_id).first()
+            return self._to_dict(row) if row else None
+        finally:
+            session.close()
+
+    def update_schedule(self, schedule_id, data):
+        """修改定时配置（只改传入的字段）；不存在返回 None，配置不合法时抛出 ScheduleError"""
+        session = SessionLocal()
+        try:
+            row = session.query(TaskSchedule).filter(TaskSchedule.id == schedule_id).first()
+            if row is None:
+                return None
+            changes = {k: data[k] for k in SCHEDULE_FIELDS if k in data}
+            # cron 与 interval_seconds 二选一：设置其中一个时清空另一个
+            if changes.get('cron'):
+                changes.setdefault('interval_seconds', None)
+            elif changes.get('interval_seconds') is not None:
+                changes.setdefault('cron', None)
+            merged = {k: getattr(row, k) for k in SCHEDULE_FIELDS}
+            merged.update(changes)
+            validate_schedule(merged)
+            for k, v in changes.items():
+                setattr(row, k, v)
+            if any(k in changes for k in _TIMING_FIELDS) or changes.get('enabled'):
+                # 触发规则变化或重新启用：从当前时间重新计算，不补触发此前错过的时间
+                row.next_fire_at = None
+            row.updated_at = datetime.utcnow()
+            session.commit()
+        finally:
+            session.close()
+        self.reload()
+        return self.get_schedule(schedule_id)
+
+    def delete_schedule(self, schedule_id):
+        session = SessionLocal()
+        try:
+            deleted = session.query(TaskSchedule).filter(TaskSchedule.id == schedule_id).delete()
+            session.commit()
+        finally:
+            session.close()
+        if deleted:
+            self.reload()
+        return bool(deleted)
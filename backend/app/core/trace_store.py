@@ -0,0 +1,143 @@
+"""运行追踪的导出与读取。
+
+RUN_STORAGE=db 时每个 span 为一行 TaskRunSpan，经 db_writer 与其他运行记录一起异步落库；
+files 时按行追加到运行目录的 trace.jsonl，随运行目录一起归档。
+timeline() 把一个运行的 span 还原成父子嵌套的时间线，并按阶段名汇总自身耗时，便于看出哪个阶段占主导。
+"""
+import os
+import datetime
+import threading
+from collections import defaultdict
+from app.core.config import Config
+from app.core.db_writer import db_writer
+from app.core.context_history import dumps, parse_lines
+from app.core import log_archive
+from app.models.db import SessionLocal
+from app.models.task_models import TaskRunSpan
+from app.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+TRACE_LOG = 'trace.jsonl'
+
+_file_lock = threading.Lock()
+
+
+def export(run_id, spans):
+    """导出一批已结束的 span（不阻塞调用方的落库路径）"""
+    if run_id is None or not spans:
+        return
+    if Config.RUN_STORAGE == 'db':
+        for item in spans:
+            db_writer.insert(TaskRunSpan, run_id=run_id, span_id=item['span_id'], parent_id=item.get('parent_id'),
+                             name=item['name'], start_time=item['start'], duration=item['duration'],
+                             attrs=item.get('attrs') or {})
+        return
+    run_dir = os.path.join(Config.LOGS_DIR, f"run_{run_id}")
+    try:
+        os.makedirs(run_dir, exist_ok=True)
+        with _file_lock, open(os.path.join(run_dir, TRACE_LOG), 'a', encoding='utf-8') as f:
+            f.write(''.join(dumps(item) + '\n' for item in spans))
+    except OSError as e:
+        logger.warning(f"运行 {run_id} 追踪写入失败: {e}")
+
+
+def load(run_id):
+    """运行的全部 span，依次取自数据库、运行目录与归档；没有时返回空列表"""
+    session = SessionLocal()
+    try:
+        rows = session.query(TaskRunSpan).filter(TaskRunSpan.run_id == run_id) \
+            .order_by(TaskRunSpan.start_time).all()
+        if rows:
+            return [{
+                'span_id': row.span_id,
+                'parent_id': row.parent_id,
+                'name': row.name,
+                'start': row.start_time,
+                'duration': row.duration,
+                'attrs': row.attrs or {},
+            } for row in rows]
+    finally:
+        session.close()
+    path = os.path.join(Config.LOGS_DIR, f"run_{run_id}", TRACE_LOG)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return parse_lines(f)
+    except FileNotFoundError:
+        return log_archive.read_jsonl(run_id, TRACE_LOG) or []
+
+
+def _covered(intervals):
+    """区间并集的总长度（并行子 span 重叠的部分只算一次）"""
+    total, end = 0.0, None
+    for start, stop in sorted(intervals):
+        if end is None or start > end:
+            total += stop - start
+            end = stop
+        elif stop > end:
+            total += stop - end
+            end = stop
+    return total
+
+
+def timeline(spans):
+    """按父子关系深度优先排列的时间线与各阶段的耗时汇总；没有 span 时返回 None。
+
+    self_ms 为 span 自身耗时（扣除子 span 覆盖的时间），phases 按阶段名汇总并按 self_ms 倒序。
+    """
+    if not spans:
+        return None
+    origin = min(s['start'] for s in spans)
+    finish = max(s['start'] + s['duration'] for s in spans)
+    ids = {s['span_id'] for s in spans}
+    children = defaultdict(list)
+    roots = []
+    for s in spans:
+        if s.get('parent_id') in ids:
+            children[s['parent_id']].append(s)
+        else:
+            roots.append(s)
+
+    items = []
+    phases = defaultdict(lambda: {'count': 0, 'total_ms': 0.0, 'self_ms': 0.0})
+
+    def visit(s, depth):
+        start, stop = s['start'], s['start'] + s['duration']
+        kids = sorted(children.get(s['span_id'], ()), key=lambda c: c['start'])
+        covered = _covered((max(start, c['start']), min(stop, c['start'] + c['duration']))
+                           for c in kids if c['start'] < stop and c['start'] + c['duration'] > start)
+        self_ms = max(0.0, s['duration'] - covered) * 1000
+        items.append({
+            'span_id': s['span_id'],
+            'parent_id': s.get('parent_id'),
+            'name': s['name'],
+            'depth': depth,
+            'offset_ms': round((start - origin) * 1000, 3),
+            'duration_ms': round(s['duration'] * 1000, 3),
+            'self_ms': round(self_ms, 3),
+            'attrs': s.get('attrs') or {},
+        })
+        phase = phases[s['name']]
+        phase['count'] += 1
+        phase['total_ms'] += s['duration'] * 1000
+        phase['self_ms'] += self_ms
+        for child in kids:
+            visit(child, depth + 1)
+
+    for root in sorted(roots, key=lambda r: r['start']):
+        visit(root, 0)
+
+    self_total = sum(p['self_ms'] for p in phases.values()) or 1.0
+    return {
+        'started_at': datetime.datetime.utcfromtimestamp(origin).isoformat(),
+        'duration_ms': round((finish - origin) * 1000, 3),
+        'span_count': len(spans),
+        'phases': sorted(({
+            'name': name,
+            'count': p['count'],
+            'total_ms': round(p['total_ms'], 3),
+            'self_ms': round(p['self_ms'], 3),
+            'self_percent': round(p['self_ms'] * 100 / self_total, 2),
+        } for name, p in phases.items()), key=lambda p: -p['self_ms']),
+        'spans': items,
+    }
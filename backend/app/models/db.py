@@ -1,18 +1,131 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
 from .task_models import Base
 import os
+import time
 from werkzeug.security import generate_password_hash
 from .task_models import User
 from sqlalchemy.exc import SQLAlchemyError
+from app.core.config import Config
+from app.utils import metrics
+from app.utils.logger import setup_logger
+from app.core import context_history
 
-DB_PATH = os.getenv('TASK_DB_PATH', f"sqlite:///{os.path.abspath(os.path.join(os.path.dirname(__file__), '../../db/taskrun.db'))}")
-engine = create_engine(DB_PATH, echo=True)
+logger = setup_logger(__name__)
+
+DB_COMMIT = metrics.histogram('db_commit_seconds', '会话提交耗时（含 flush）')
+
+DB_PATH = Config.TASK_DB_PATH
+
+
+def _sqlite_pragmas(journal_mode, synchronous, busy_timeout_ms):
+    """每个新连接上执行的 PRAGMA：WAL 下读写互不阻塞，写锁冲突时等待而不是立即报 database is locked"""
+    def on_connect(dbapi_conn, _record):
+        cursor = dbapi_conn.cursor()
+        try:
+            if journal_mode:
+                cursor.execute(f"PRAGMA journal_mode={journal_mode}")
+            if synchronous:
+                cursor.execute(f"PRAGMA synchronous={synchronous}")
+            cursor.execute(f"PRAGMA busy_timeout={int(busy_timeout_ms)}")
+        finally:
+            cursor.close()
+    return on_connect
+
+
+def build_engine(url=None, **overrides):
+    """按数据库类型创建引擎；overrides 可覆盖 Config 中的同名小写配置（供基准测试使用）"""
+    url = make_url(url or DB_PATH)
+
+    def opt(name):
+        return overrides.get(name, getattr(Config, name.upper()))
+
+    # JSON 列（上下文、执行计划等）使用紧凑序列化
+    kwargs = {'echo': opt('db_echo'), 'json_serializer': context_history.dumps}
+
+    if url.get_backend_name() == 'sqlite':
+        busy_timeout_ms = opt('sqlite_busy_timeout_ms')
+        # 连接在运行线程与请求线程之间复用，关闭 pysqlite 的同线程检查
+        kwargs['connect_args'] = {'check_same_thread': False, 'timeout': busy_timeout_ms / 1000.0}
+        if url.database in (None, '', ':memory:'):
+            kwargs['poolclass'] = StaticPool
+        else:
+            kwargs.update(pool_size=opt('db_pool_size'), max_overflow=opt('db_max_overflow'),
+                          pool_timeout=opt('db_pool_timeout'))
+        engine = create_engine(url, **kwargs)
+        event.listen(engine, 'connect', _sqlite_pragmas(
+            opt('sqlite_journal_mode'), opt('sqlite_synchronous'), busy_timeout_ms))
+        return engine
+
+    kwargs.update(
+        pool_size=opt('db_pool_size'),
+        max_overflow=opt('db_max_overflow'),
+        pool_timeout=opt('db_pool_timeout'),
+        pool_recycle=opt('db_pool_recycle'),
+        pool_pre_ping=opt('db_pool_pre_ping'),
+    )
+    return create_engine(url, **kwargs)
+
+
+engine = build_engine()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+
+@event.listens_for(SessionLocal, 'before_commit')
+def _commit_started(session):
+    session.info['commit_started'] = time.perf_counter()
+
+
+@event.listens_for(SessionLocal, 'after_commit')
+def _commit_finished(session):
+    started = session.info.pop('commit_started', None)
+    if started is not None:
+        DB_COMMIT.observe(time.perf_counter() - started)
+
+def ensure_schema():
+    """create_all 不会修改已存在的表：这里补齐新增的列（均按可空列添加）与索引。
+
+    多个进程同时启动时可能都尝试添加同一列 / 索引：失败后重新检查，已存在则忽略，
+    否则记录表名与列名 / 索引名后抛出，避免服务带着缺失的列启动、到查询时才报错。
+    """
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    preparer = engine.dialect.identifier_preparer
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {c['name'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = (f"ALTER TABLE {preparer.quote(table.name)} ADD COLUMN "
+                   f"{preparer.quote(column.name)} {column.type.compile(dialect=engine.dialect)}")
+            try:
+                with engine.begin() as conn:
+                    conn.execute(text(ddl))
+                logger.info(f"已为表 {table.name} 添加列 {column.name}")
+            except SQLAlchemyError as e:
+                if column.name in {c['name'] for c in inspect(engine).get_columns(table.name)}:
+                    logger.info(f"表 {table.name} 的列 {column.name} 已由其他进程添加")
+                    continue
+                logger.error(f"为表 {table.name} 添加列 {column.name} 失败: {e}")
+                raise
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(bind=engine, checkfirst=True)
+            except SQLAlchemyError as e:
+                if index.name in {i['name'] for i in inspect(engine).get_indexes(table.name)}:
+                    continue
+                logger.error(f"为表 {table.name} 创建索引 {index.name} 失败: {e}")
+                raise
+
 def init_db():
     # 创建表
     Base.metadata.create_all(bind=engine)
+    ensure_schema()
 
     # 在创建表后，检查 users 表或初始用户是否存在；若不存在，则插入初始管理员
     session = SessionLocal()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, JSON
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, JSON, Index, Float, BigInteger, LargeBinary, Boolean
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 import datetime
@@ -10,6 +10,8 @@ class Task(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String(128), nullable=False)
     description = Column(Text)
+    parallelism = Column(Integer)  # 依赖图中最多同时执行的脚本数，为空时使用 TASK_PARALLELISM
+    merge_policy = Column(String(16))  # 并行分支上下文冲突时的合并策略：order / last / error
     scripts = relationship('Script', order_by='Script.order', back_populates='task')
     runs = relationship('TaskRun', back_populates='task')
 
@@ -19,40 +21,204 @@ class Script(Base):
     task_id = Column(Integer, ForeignKey('tasks.id'))
     filename = Column(String(128), nullable=False)
     order = Column(Integer, nullable=False)
+    depends_on = Column(JSON)  # 依赖的脚本文件名列表；为空(NULL)时依赖上一个脚本，[] 表示无依赖
+    # 结果缓存（可选）：cache_ttl 不为空时，相同脚本内容 + 输入上下文 + 声明的输入命中缓存则跳过执行
+    cache_ttl = Column(Integer)
+    cache_inputs = Column(JSON)  # 声明的额外输入：TASKS_DIR 下的文件 / 目录路径，或 env:变量名
     task = relationship('Task', back_populates='scripts')
 
+    __table_args__ = (
+        Index('ix_scripts_task_order', 'task_id', 'order'),
+    )
+
 class TaskRun(Base):
     __tablename__ = 'task_runs'
     id = Column(Integer, primary_key=True)
     task_id = Column(Integer, ForeignKey('tasks.id'))
     started_at = Column(DateTime, default=datetime.datetime.utcnow)
     finished_at = Column(DateTime)
-    status = Column(String(32))
+    status = Column(String(32))  # queued / claimed / running / success / failed / interrupted
     initial_context = Column(JSON)  # 初始环境变量
     final_context = Column(JSON)    # 最终环境变量
+    plan = Column(JSON)  # 提交时确定的执行计划：scripts / deps / parallelism / merge_policy（恢复执行时含 resume）
+    # 运行队列：claimed_by 为执行该运行的节点，租约到期未续约时重新入队
+    claimed_by = Column(String(128))
+    lease_expires_at = Column(DateTime)
+    heartbeat_at = Column(DateTime)
+    attempts = Column(Integer, default=0)
+    # 资源用量汇总：峰值 RSS 取各脚本最大值，CPU 时间与磁盘读写字节数为各脚本之和
+    peak_rss = Column(BigInteger)
+    cpu_user = Column(Float)
+    cpu_system = Column(Float)
+    io_read_bytes = Column(BigInteger)
+    io_write_bytes = Column(BigInteger)
     logs = relationship('TaskRunLog', back_populates='run')
     contexts = relationship('TaskRunContext', back_populates='run')
+    profiles = relationship('TaskRunProfile', back_populates='run')
+    spans = relationship('TaskRunSpan', back_populates='run')
+    steps = relationship('TaskRunStep', order_by='TaskRunStep.position', back_populates='run')
     task = relationship('Task', back_populates='runs')
 
+    __table_args__ = (
+        # 按任务分页列出运行记录（id 倒序）
+        Index('ix_task_runs_task_id_id', 'task_id', 'id'),
+        # agent 按 id 顺序领取 queued 运行、回收过期租约
+        Index('ix_task_runs_status_id', 'status', 'id'),
+    )
+
 class TaskRunLog(Base):
+    """脚本日志的压缩分块：byte_offset / raw_size 为该块在原始日志中的字节范围"""
     __tablename__ = 'task_run_logs'
     id = Column(Integer, primary_key=True)
     run_id = Column(Integer, ForeignKey('task_runs.id'))
     script_filename = Column(String(128))
     output = Column(Text)
+    byte_offset = Column(BigInteger)
+    raw_size = Column(Integer)
+    codec = Column(String(16))  # zstd / gzip / none
+    data = Column(LargeBinary)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     run = relationship('TaskRun', back_populates='logs')
 
+    __table_args__ = (
+        Index('ix_task_run_logs_run_script_offset', 'run_id', 'script_filename', 'byte_offset'),
+    )
+
 class TaskRunContext(Base):
-    """记录每个脚本执行后生成的环境变量"""
+    """记录每个脚本执行后的环境变量：相对同一运行上一行的增量，或完整快照（见 context_history）"""
     __tablename__ = 'task_run_contexts'
     id = Column(Integer, primary_key=True)
     run_id = Column(Integer, ForeignKey('task_runs.id'))
+    position = Column(Integer)  # 脚本在本次运行中的执行序号
     script_filename = Column(String(128))
-    context = Column(JSON)  # 该脚本执行后生成的环境变量
+    context = Column(JSON)  # 完整快照：旧数据、恢复执行后的第一行等，为空时使用 delta
+    delta = Column(JSON)  # 相对上一行的增量 {'set': {...}, 'unset': [...]}
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     run = relationship('TaskRun', back_populates='contexts')
 
+    __table_args__ = (
+        Index('ix_task_run_contexts_run_position', 'run_id', 'position'),
+    )
+
+class TaskRunProfile(Base):
+    """按需剖析的脚本性能数据（压缩）：pstats 为 cProfile 统计（仅 cprofile 模式），collapsed 为折叠调用栈（值为微秒）"""
+    __tablename__ = 'task_run_profiles'
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey('task_runs.id'))
+    position = Column(Integer)  # 脚本在本次运行中的执行序号
+    script_filename = Column(String(128))
+    mode = Column(String(16))  # cprofile / sampling
+    codec = Column(String(16))
+    pstats = Column(LargeBinary)
+    collapsed = Column(LargeBinary)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    run = relationship('TaskRun', back_populates='profiles')
+
+    __table_args__ = (
+        Index('ix_task_run_profiles_run_script', 'run_id', 'script_filename'),
+    )
+
+class TaskRunSpan(Base):
+    """运行追踪的 span：从 API 请求、调度、脚本进程到落库的各阶段耗时（见 tracing / trace_store）"""
+    __tablename__ = 'task_run_spans'
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey('task_runs.id'))
+    span_id = Column(String(16))
+    parent_id = Column(String(16))
+    name = Column(String(128))
+    start_time = Column(Float)  # Unix 时间戳（秒）
+    duration = Column(Float)  # 秒
+    attrs = Column(JSON)
+    run = relationship('TaskRun', back_populates='spans')
+
+    __table_args__ = (
+        Index('ix_task_run_spans_run_start', 'run_id', 'start_time'),
+    )
+
+class TaskRunStep(Base):
+    """记录每个脚本的执行状态与耗时"""
+    __tablename__ = 'task_run_steps'
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey('task_runs.id'))
+    position = Column(Integer, nullable=False)  # 脚本在本次运行中的执行序号
+    script_filename = Column(String(128))
+    status = Column(String(32))  # running / success / failed / timeout / conflict / skipped / interrupted
+    returncode = Column(Integer)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    duration = Column(Float)  # 秒
+    cached = Column(Boolean, default=False)  # 命中结果缓存，未实际执行
+    peak_rss = Column(BigInteger)  # 峰值常驻内存（字节）
+    cpu_user = Column(Float)  # 用户态 CPU 时间（秒，含已回收的子进程）
+    cpu_system = Column(Float)  # 内核态 CPU 时间（秒）
+    io_read_bytes = Column(BigInteger)  # 磁盘读取字节数
+    io_write_bytes = Column(BigInteger)  # 磁盘写入字节数
+    run = relationship('TaskRun', back_populates='steps')
+
+    __table_args__ = (
+        Index('ix_task_run_steps_run_position', 'run_id', 'position'),
+    )
+
+class ScriptResultCache(Base):
+    """脚本执行结果缓存：cache_key 为脚本内容、输入上下文与声明输入的哈希"""
+    __tablename__ = 'script_result_cache'
+    id = Column(Integer, primary_key=True)
+    cache_key = Column(String(64), nullable=False, unique=True)
+    script_filename = Column(String(128))
+    delta = Column(JSON)  # 上下文增量：{'set': {...}, 'unset': [...]}
+    log_codec = Column(String(16))
+    log_data = Column(LargeBinary)  # 该次执行写入的日志（压缩）
+    size = Column(Integer)  # 日志原始字节数 + 增量 JSON 字节数，用于容量淘汰
+    hits = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    expires_at = Column(DateTime)
+    last_used_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        # 按最近使用时间淘汰
+        Index('ix_script_result_cache_last_used', 'last_used_at'),
+    )
+
+
+class TaskSchedule(Base):
+    """编排任务的定时触发：cron 表达式或固定间隔"""
+    __tablename__ = 'task_schedules'
+    id = Column(Integer, primary_key=True)
+    task_id = Column(Integer, ForeignKey('tasks.id'))
+    cron = Column(String(128))  # 5 段 crontab 表达式，与 interval_seconds 二选一
+    interval_seconds = Column(Integer)
+    timezone = Column(String(64))  # cron 表达式所用时区，为空时使用 SCHEDULER_TIMEZONE
+    jitter_seconds = Column(Integer, default=0)  # 在计划时间后随机延迟 0~N 秒，打散同时触发
+    misfire_policy = Column(String(16), default='skip')  # skip / catchup
+    catchup_limit = Column(Integer, default=1)  # catchup 时最多补触发的次数
+    misfire_grace_seconds = Column(Integer)  # 超过计划时间多久算错过，为空时使用 SCHEDULE_MISFIRE_GRACE
+    overlap_policy = Column(String(16), default='skip')  # 上一次触发的运行未结束时：skip / queue / allow
+    context = Column(JSON)  # 触发时传入的初始上下文
+    enabled = Column(Boolean, default=True)
+    next_fire_at = Column(DateTime)  # 下一次计划触发时间（UTC，不含抖动）
+    last_fire_at = Column(DateTime)
+    last_run_id = Column(Integer)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)
+    task = relationship('Task')
+
+
+class RunArchive(Base):
+    """已打包进 LOGS_DIR/archive/ 分片的运行目录（见 app.core.log_archive）"""
+    __tablename__ = 'run_archives'
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, nullable=False, unique=True)
+    task_id = Column(Integer)
+    archive = Column(String(64), nullable=False)  # 分片文件名：<结束日期>.<序号>.zip
+    files = Column(JSON)  # {文件名: [原始字节数, 修改时间戳]}
+    size = Column(BigInteger)  # 该运行的成员在分片中占用的字节数（压缩后数据与 zip 头）
+    archived_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_run_archives_archive', 'archive'),
+        Index('ix_run_archives_task_run', 'task_id', 'run_id'),
+    )
+
 
 class User(Base):
     __tablename__ = 'users'
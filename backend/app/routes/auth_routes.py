@@ -1,6 +1,6 @@
 from flask import Blueprint, request, current_app
 from app.utils.response import api_response
-from app.utils.auth import generate_token, get_username_from_token
+from app.utils.auth import generate_token, get_username_from_token, current_username, get_user
 from app.models.db import SessionLocal
 from app.models.task_models import User
 from werkzeug.security import check_password_hash
@@ -43,34 +43,31 @@ def login():
 def get_user_info():
     """根据请求头 Authorization: Bearer <token> 返回用户信息。"""
     try:
-        auth = request.headers.get('Authorization', '')
-        if not auth:
-            return api_response(None, '无效或已过期的 token', 401)
-
-        # 支持两种形式："Bearer <token>" 或 直接把 token 放在 Authorization 头里
-        if auth.startswith('Bearer '):
-            token = auth.split(' ', 1)[1].strip()
-        else:
-            token = auth.strip()
-        username = get_username_from_token(token)
+        # 全局鉴权已解码 token 并记录在 flask.g 上
+        username = current_username()
         if not username:
-            return api_response(None, '无效或已过期的 token', 401)
+            auth = request.headers.get('Authorization', '')
+            if not auth:
+                return api_response(None, '无效或已过期的 token', 401)
 
-        session = SessionLocal()
-        try:
-            user = session.query(User).filter_by(username=username).first()
-        finally:
-            session.close()
+            # 支持两种形式："Bearer <token>" 或 直接把 token 放在 Authorization 头里
+            if auth.startswith('Bearer '):
+                token = auth.split(' ', 1)[1].strip()
+            else:
+                token = auth.strip()
+            username = get_username_from_token(token)
+            if not username:
+                return api_response(None, '无效或已过期的 token', 401)
 
+        user = get_user(username)
         if not user:
             return api_response(None, '用户不存在', 404)
 
-        roles = user.roles.split(',') if user.roles else ['user']
         user_info = {
             'buttons': [],
-            'roles': roles,
-            'userId': user.id,
-            'userName': user.username,
+            'roles': user['roles'],
+            'userId': user['id'],
+            'userName': user['username'],
             'email': '',
             'avatar': ''
         }
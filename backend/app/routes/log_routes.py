@@ -3,6 +3,8 @@ from flask import Blueprint, request, current_app, send_file
 from app.utils.response import api_response
 from app.utils.logger import setup_logger
 from app.core.config import Config
+from app.utils.file_reader import read_range, tail_lines, count_lines
+from app.core import log_retention
 
 bp = Blueprint('logs', __name__, url_prefix='/api/logs')
 logger = setup_logger(__name__)
@@ -12,14 +14,16 @@ def list_logs():
     """列出所有日志文件"""
     try:
         logs = []
-        for file in os.listdir(Config.LOGS_DIR):
-            if file.endswith('.log'):
-                file_path = os.path.join(Config.LOGS_DIR, file)
-                logs.append({
-                    'filename': file,
-                    'size': os.path.getsize(file_path),
-                    'modified_at': os.path.getmtime(file_path)
-                })
+        # scandir 的目录项自带类型信息，运行目录（run_<id>/）无需逐个 stat
+        with os.scandir(Config.LOGS_DIR) as it:
+            for entry in it:
+                if entry.name.endswith('.log') and entry.is_file():
+                    st = entry.stat()
+                    logs.append({
+                        'filename': entry.name,
+                        'size': st.st_size,
+                        'modified_at': st.st_mtime
+                    })
         return api_response(logs, '获取成功', 200)
     except Exception as e:
         logger.error(f"列出日志文件失败: {e}")
@@ -33,10 +37,12 @@ def get_log(task_id, run_id):
         if not os.path.exists(log_file):
             return api_response(None, '日志文件不存在', 404)
         
-        with open(log_file, 'r', encoding='utf-8') as f:
-            content = f.read()
+        # 按 ?offset=&limit= 分页读取，内存占用与文件大小无关
+        offset = request.args.get('offset', 0, type=int)
+        limit = min(request.args.get('limit', Config.LOG_READ_MAX_BYTES, type=int), Config.LOG_READ_MAX_BYTES)
+        page = read_range(log_file, offset, limit)
         
-        return api_response({'filename': f"{task_id}_{run_id}.log", 'content': content}, '获取成功', 200)
+        return api_response({'filename': f"{task_id}_{run_id}.log", **page}, '获取成功', 200)
     except Exception as e:
         logger.error(f"获取日志失败: {e}")
         return api_response(None, str(e), 500)
@@ -49,10 +55,12 @@ def download_log(task_id, run_id):
         if not os.path.exists(log_file):
             return api_response(None, '日志文件不存在', 404)
         
+        # conditional=True 让 werkzeug 处理 Range / If-Range 请求，返回 206 分段内容
         return send_file(
             log_file,
             as_attachment=True,
-            download_name=f"{task_id}_{run_id}.log"
+            download_name=f"{task_id}_{run_id}.log",
+            conditional=True
         )
     except Exception as e:
         logger.error(f"下载日志失败: {e}")
@@ -66,13 +74,40 @@ def get_app_log():
         if not os.path.exists(app_log_file):
             return api_response(None, '应用日志不存在', 404)
         
-        # 获取最后N行
-        lines = request.args.get('lines', 100, type=int)
-        with open(app_log_file, 'r', encoding='utf-8') as f:
-            all_lines = f.readlines()
-            content = ''.join(all_lines[-lines:])
+        # 指定 offset 时按字节分页；否则反向读取最后 N 行，不加载整个文件
+        if 'offset' in request.args:
+            offset = request.args.get('offset', 0, type=int)
+            limit = min(request.args.get('limit', Config.LOG_READ_MAX_BYTES, type=int), Config.LOG_READ_MAX_BYTES)
+            page = read_range(app_log_file, offset, limit)
+            return api_response({'filename': 'app.log', **page}, '获取成功', 200)
+
+        lines = min(max(request.args.get('lines', 100, type=int), 0), 10000)
+        content, start, size = tail_lines(app_log_file, lines)
         
-        return api_response({'filename': 'app.log', 'content': content, 'total_lines': len(all_lines)}, '获取成功', 200)
+        # total_lines 为原有字段，行数按增量统计，不再整文件 readlines()
+        return api_response({'filename': 'app.log', 'content': content, 'total_lines': count_lines(app_log_file),
+                             'offset': start, 'size': size}, '获取成功', 200)
     except Exception as e:
         logger.error(f"获取应用日志失败: {e}")
         return api_response(None, str(e), 500)
+
+@bp.route('/retention', methods=['GET'])
+def get_retention():
+    """日志保留策略与最近一轮清理的结果"""
+    try:
+        return api_response(log_retention.status(), '获取成功', 200)
+    except Exception as e:
+        logger.error(f"获取日志保留状态失败: {e}")
+        return api_response(None, str(e), 500)
+
+@bp.route('/retention/sweep', methods=['POST'])
+def sweep_retention():
+    """立即执行一轮日志保留清理（在后台线程中进行）"""
+    try:
+        if not Config.LOG_RETENTION_ENABLED:
+            return api_response(None, '日志保留清理未启用（LOG_RETENTION_ENABLED=0）', 400)
+        log_retention.trigger()
+        return api_response(None, '已触发清理', 200)
+    except Exception as e:
+        logger.error(f"触发日志保留清理失败: {e}")
+        return api_response(None, str(e), 500)
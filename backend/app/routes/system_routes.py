@@ -1,4 +1,4 @@
-from flask import Blueprint, current_app
+from flask import Blueprint, current_app, request, Response
 from app.utils.response import api_response
 from app.utils.logger import setup_logger
 
@@ -25,9 +25,21 @@ def get_process_info():
         logger.error(f"获取进程信息失败: {e}")
         return api_response(None, str(e), 500)
 
+@bp.route('/history', methods=['GET'])
+def get_system_history():
+    """获取系统与本进程资源占用的时间序列（?seconds= 最近 N 秒，?limit= 最多返回的点数）"""
+    try:
+        seconds = request.args.get('seconds', type=float)
+        limit = request.args.get('limit', type=int)
+        history = current_app.process_manager.get_history(seconds=seconds, limit=limit)
+        return api_response(history, '获取成功', 200)
+    except Exception as e:
+        logger.error(f"获取资源历史失败: {e}")
+        return api_response(None, str(e), 500)
+
 @bp.route('/processes', methods=['GET'])
 def get_all_processes():
-    """获取所有Python进程"""
+    """获取本服务的进程树（当前进程及脚本进程、预热工作进程）"""
     try:
         processes = current_app.process_manager.get_all_processes()
         return api_response(processes, '获取成功', 200)
@@ -35,6 +47,54 @@ def get_all_processes():
         logger.error(f"获取进程列表失败: {e}")
         return api_response(None, str(e), 500)
 
+@bp.route('/worker-pool', methods=['GET'])
+def get_worker_pool_stats():
+    """获取预热进程池状态及脚本派发延迟"""
+    try:
+        from app.utils.worker_pool import get_pool_stats
+        return api_response(get_pool_stats(), '获取成功', 200)
+    except Exception as e:
+        logger.error(f"获取进程池状态失败: {e}")
+        return api_response(None, str(e), 500)
+
+@bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    """进程内指标：默认输出 Prometheus 文本格式，?format=json 返回 JSON 快照。
+
+    ?process=runner 时代理本机 runner 进程的指标端口（RUNNER_METRICS_PORT），运行相关的指标只在 runner 中。
+    """
+    try:
+        from app.utils import metrics
+        if request.args.get('process') == 'runner':
+            return _runner_metrics(request.args.get('format'))
+        if request.args.get('format') == 'json':
+            return api_response(metrics.snapshot(), '获取成功', 200)
+        return Response(metrics.render_text(), content_type=metrics.CONTENT_TYPE)
+    except Exception as e:
+        logger.error(f"获取指标失败: {e}")
+        return api_response(None, str(e), 500)
+
+def _runner_metrics(fmt):
+    import json
+    import urllib.request
+    from app.core.config import Config
+    from app.utils import metrics
+    if not Config.RUNNER_METRICS_PORT:
+        return api_response(None, '未开启 runner 指标端口（RUNNER_METRICS_PORT=0）', 404)
+    host = Config.RUNNER_METRICS_BIND
+    if host in ('', '0.0.0.0', '::'):
+        host = '127.0.0.1'
+    url = f"http://{host}:{Config.RUNNER_METRICS_PORT}/metrics" + ('?format=json' if fmt == 'json' else '')
+    try:
+        with urllib.request.urlopen(url, timeout=5) as resp:
+            body = resp.read()
+    except OSError as e:
+        logger.warning(f"读取 runner 指标失败: {url}, {e}")
+        return api_response(None, f"runner 指标不可用: {e}", 502)
+    if fmt == 'json':
+        return api_response(json.loads(body), '获取成功', 200)
+    return Response(body, content_type=metrics.CONTENT_TYPE)
+
 @bp.route('/health', methods=['GET'])
 def health_check():
     """健康检查"""
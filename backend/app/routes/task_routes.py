@@ -1,8 +1,12 @@
 
 import os
-from flask import Blueprint, request, current_app
+import json
+from flask import Blueprint, request, current_app, Response, stream_with_context
 from app.utils.response import api_response
 from app.utils.logger import setup_logger
+from app.core.run_scheduler import QueueFullError
+from app.core.task_scheduler import ScheduleError
+from app.core.log_hub import safe_script_name
 
 bp = Blueprint('tasks', __name__, url_prefix='/api/tasks')
 logger = setup_logger(__name__)
@@ -109,9 +113,12 @@ def get_active_tasks():
 
 @bp.route('/db', methods=['GET'])
 def list_db_tasks():
-    """获取所有编排任务"""
+    """获取编排任务，支持 ?after_id=&limit= 键集分页"""
     try:
-        tasks = current_app.task_manager.task_service.list_tasks()
+        tasks = current_app.task_manager.task_service.list_tasks(
+            after_id=request.args.get('after_id', type=int),
+            limit=request.args.get('limit', type=int)
+        )
         return api_response(tasks, '获取成功', 200)
     except Exception as e:
         logger.error(f"获取编排任务列表失败: {e}")
@@ -119,7 +126,12 @@ def list_db_tasks():
 
 @bp.route('/db', methods=['POST'])
 def create_db_task():
-    """通过数据库创建任务（含脚本顺序）"""
+    """通过数据库创建任务（含脚本顺序）。
+
+    scripts 每项为文件名，或 {"filename": ..., "depends_on": [...], "cache": ...} 声明依赖（组成 DAG）
+    与结果缓存（true / 有效期秒数 / {"ttl": 秒, "inputs": [...]}）；
+    可选 parallelism（并行脚本数）与 merge_policy（order / last / error）。
+    """
     try:
         data = request.get_json()
         name = data.get('name')
@@ -127,7 +139,8 @@ def create_db_task():
         script_filenames = data.get('scripts', [])
         if not name or not script_filenames:
             return api_response(None, '缺少name或scripts', 400)
-        success, result = current_app.task_manager.create_db_task(name, description, script_filenames)
+        success, result = current_app.task_manager.create_db_task(
+            name, description, script_filenames, data.get('parallelism'), data.get('merge_policy'))
         return api_response({'task_id': result} if success else None, result, 201 if success else 400)
     except Exception as e:
         logger.error(f"数据库任务创建失败: {e}")
@@ -143,7 +156,8 @@ def update_db_task(task_id):
         description = data.get('description', '')
         script_filenames = data.get('scripts', [])
 
-        success, message = current_app.task_manager.task_service.update_task(task_id, name, description, script_filenames)
+        success, message = current_app.task_manager.task_service.update_task(
+            task_id, name, description, script_filenames, data.get('parallelism'), data.get('merge_policy'))
         return api_response(None, message, 200 if success else 400)
     except Exception as e:
         logger.error(f"更新数据库任务失败: {e}")
@@ -151,34 +165,125 @@ def update_db_task(task_id):
 
 @bp.route('/db/<int:task_id>/execute', methods=['POST'])
 def execute_db_task(task_id):
-    """通过数据库任务编排执行任务"""
+    """通过数据库任务编排执行任务。
+
+    {"force": true} 时忽略结果缓存重新执行所有脚本；{"profile": "cprofile" | "sampling"} 时剖析每个脚本，
+    结果通过 /db/runs/<run_id>/profiles 查看与下载
+    """
     try:
         data = request.get_json() or {}
         context = data.get('context', {})
-        run_id, message = current_app.task_manager.execute_db_task(task_id, context)
+        force = bool(data.get('force')) or request.args.get('force', '').lower() in ('1', 'true', 'yes')
+        profile = data.get('profile') or request.args.get('profile') or None
+        run_id, message = current_app.task_manager.execute_db_task(task_id, context, force, profile)
         if run_id:
-            return api_response({'run_id': run_id}, message, 200)
+            position = current_app.task_manager.task_service.get_queue_position(run_id)
+            return api_response({
+                'run_id': run_id,
+                'status': 'queued' if position else 'running',
+                'queue_position': position or 0
+            }, message, 200)
         else:
             return api_response(None, message, 400)
+    except QueueFullError as e:
+        return api_response({
+            'queue_position': e.queue_position,
+            'queue_depth': e.queue_depth,
+            'max_pending': e.max_pending
+        }, str(e), 429)
     except Exception as e:
         logger.error(f"数据库任务执行失败: {e}")
         return api_response(None, str(e), 500)
 
+@bp.route('/db/queue', methods=['GET'])
+def get_db_queue_stats():
+    """获取编排任务调度队列状态"""
+    try:
+        stats = current_app.task_manager.task_service.get_queue_stats()
+        return api_response(stats, '获取成功', 200)
+    except Exception as e:
+        logger.error(f"获取调度队列状态失败: {e}")
+        return api_response(None, str(e), 500)
+
+@bp.route('/db/schedules', methods=['GET'])
+def list_db_schedules():
+    """获取全部定时配置（含下一次触发时间）"""
+    try:
+        schedules = current_app.task_manager.task_scheduler.list_schedules()
+        return api_response(schedules, '获取成功', 200)
+    except Exception as e:
+        logger.error(f"获取定时配置失败: {e}")
+        return api_response(None, str(e), 500)
+
+@bp.route('/db/<int:task_id>/schedules', methods=['GET'])
+def list_db_task_schedules(task_id):
+    """获取某个任务的定时配置"""
+    try:
+        schedules = current_app.task_manager.task_scheduler.list_schedules(task_id)
+        return api_response(schedules, '获取成功', 200)
+    except Exception as e:
+        logger.error(f"获取定时配置失败: {e}")
+        return api_response(None, str(e), 500)
+
+@bp.route('/db/<int:task_id>/schedules', methods=['POST'])
+def create_db_task_schedule(task_id):
+    """为任务新增定时配置。
+
+    cron（5 段 crontab，可配 timezone）与 interval_seconds 二选一；
+    可选 jitter_seconds、misfire_policy（skip / catchup）、catchup_limit、misfire_grace_seconds、
+    overlap_policy（skip / queue / allow）、context、enabled。
+    """
+    try:
+        data = request.get_json() or {}
+        schedule = current_app.task_manager.task_scheduler.create_schedule(task_id, data)
+        if schedule is None:
+            return api_response(None, '任务不存在', 404)
+        return api_response(schedule, '创建成功', 201)
+    except ScheduleError as e:
+        return api_response(None, str(e), 400)
+    except Exception as e:
+        logger.error(f"创建定时配置失败: {e}")
+        return api_response(None, str(e), 500)
+
+@bp.route('/db/schedules/<int:schedule_id>', methods=['PUT'])
+def update_db_schedule(schedule_id):
+    """修改定时配置，只更新传入的字段"""
+    try:
+        data = request.get_json() or {}
+        schedule = current_app.task_manager.task_scheduler.update_schedule(schedule_id, data)
+        if schedule is None:
+            return api_response(None, '定时配置不存在', 404)
+        return api_response(schedule, '更新成功', 200)
+    except ScheduleError as e:
+        return api_response(None, str(e), 400)
+    except Exception as e:
+        logger.error(f"更新定时配置失败: {e}")
+        return api_response(None, str(e), 500)
+
+@bp.route('/db/schedules/<int:schedule_id>', methods=['DELETE'])
+def delete_db_schedule(schedule_id):
+    """删除定时配置"""
+    try:
+        if not current_app.task_manager.task_scheduler.delete_schedule(schedule_id):
+            return api_response(None, '定时配置不存在', 404)
+        return api_response(None, '删除成功', 200)
+    except Exception as e:
+        logger.error(f"删除定时配置失败: {e}")
+        return api_response(None, str(e), 500)
+
 @bp.route('/db/<int:task_id>/runs', methods=['GET'])
 def get_db_task_runs(task_id):
-    """获取数据库任务的所有运行记录"""
-    try:
-        runs = current_app.task_manager.task_service.get_task_runs(task_id)
-        return api_response([
-            {
-                'run_id': r.id,
-                'status': r.status,
-                'started_at': r.started_at,
-                'finished_at': r.finished_at,
-                'initial_context': r.initial_context,
-                'final_context': r.final_context
-            } for r in runs
-        ], '获取成功', 200)
+    """获取数据库任务的运行记录，支持 ?after_id=&limit= 键集分页，
+    ?fields=initial_context,final_context 按需返回上下文大字段"""
+    try:
+        fields = [f.strip() for f in (request.args.get('fields') or '').split(',') if f.strip()]
+        runs = current_app.task_manager.task_service.get_task_runs(
+            task_id,
+            after_id=request.args.get('after_id', type=int),
+            limit=request.args.get('limit', type=int),
+            fields=fields
+        )
+        return api_response(runs, '获取成功', 200)
     except Exception as e:
         logger.error(f"获取数据库任务运行记录失败: {e}")
         return api_response(None, str(e), 500)
@@ -187,20 +292,169 @@ def get_db_task_runs(task_id):
 def get_db_run_logs(run_id):
     """获取某次数据库任务运行的所有脚本日志"""
     try:
-        logs = current_app.task_manager.task_service.get_run_logs(run_id)
-        # logs now returned as list of dicts with keys: script, output, created_at
+        logs = current_app.task_manager.task_service.get_run_logs(
+            run_id,
+            script=request.args.get('script') or None,
+            offset=request.args.get('offset', 0, type=int),
+            limit=request.args.get('limit', type=int),
+            tail=request.args.get('tail', type=int)
+        )
+        # list of dicts: script, output, offset, next_offset, size, eof, created_at
         return api_response(logs, '获取成功', 200)
     except Exception as e:
         logger.error(f"获取数据库任务日志失败: {e}")
         return api_response(None, str(e), 500)
 
+def _parse_cursor(value):
+    """解析 'a.py@120,b.py@48' 形式的续传游标"""
+    cursors = {}
+    for part in (value or '').split(','):
+        name, sep, offset = part.strip().rpartition('@')
+        if sep and name and offset.isdigit():
+            cursors[name] = int(offset)
+    return cursors
+
+
+def _format_sse(event):
+    if event is None:
+        return ': keepalive\n\n'
+    kind = event.pop('event')
+    lines = []
+    if 'cursor' in event:
+        lines.append(f"id: {event.pop('cursor')}")
+    lines.append(f"event: {kind}")
+    lines.append(f"data: {json.dumps(event, ensure_ascii=False)}")
+    return '\n'.join(lines) + '\n\n'
+
+
+@bp.route('/db/runs/<int:run_id>/logs/stream', methods=['GET'])
+def stream_db_run_logs(run_id):
+    """以 Server-Sent Events 实时跟随运行日志，支持 ?script=&from_offset= 或 Last-Event-ID 续传"""
+    try:
+        script = request.args.get('script') or None
+        cursors = _parse_cursor(request.headers.get('Last-Event-ID') or request.args.get('cursor'))
+        from_offset = request.args.get('from_offset', type=int)
+        if script and from_offset is not None:
+            cursors[script] = max(0, from_offset)
+        events = current_app.task_manager.task_service.stream_run_logs(run_id, cursors, script)
+        return Response(
+            stream_with_context(_format_sse(e) for e in events),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+    except Exception as e:
+        logger.error(f"实时日志流失败: {e}")
+        return api_response(None, str(e), 500)
+
+@bp.route('/db/runs/<int:run_id>/resume', methods=['POST'])
+def resume_db_run(run_id):
+    """从最后一个完成的脚本之后继续执行中断 / 失败的运行"""
+    try:
+        resumed, message = current_app.task_manager.task_service.resume_run(run_id)
+        if not resumed:
+            return api_response(None, message, 400)
+        return api_response({'run_id': run_id}, message, 200)
+    except QueueFullError as e:
+        return api_response({
+            'queue_position': e.queue_position,
+            'queue_depth': e.queue_depth,
+            'max_pending': e.max_pending
+        }, str(e), 429)
+    except Exception as e:
+        logger.error(f"恢复运行失败: {e}")
+        return api_response(None, str(e), 500)
+
+@bp.route('/db/runs/<int:run_id>/steps', methods=['GET'])
+def get_db_run_steps(run_id):
+    """获取运行中每个脚本的状态与耗时"""
+    try:
+        steps = current_app.task_manager.task_service.get_run_steps(run_id)
+        return api_response(steps, '获取成功', 200)
+    except Exception as e:
+        logger.error(f"获取运行步骤失败: {e}")
+        return api_response(None, str(e), 500)
+
 @bp.route('/db/runs/<int:run_id>/contexts', methods=['GET'])
 def get_db_run_contexts(run_id):
-    """获取某次数据库任务运行的环境变量历史"""
+    """获取某次数据库任务运行的环境变量历史。
+
+    ?format=snapshot（默认）返回每个脚本执行后的完整上下文，format=delta 只返回增量；
+    ?position=N 只还原第 N 个脚本执行后的上下文
+    """
     try:
-        contexts = current_app.task_manager.task_service.get_run_contexts(run_id)
-        # contexts returned as list of dicts with keys: script, context, created_at
+        fmt = request.args.get('format', 'snapshot')
+        if fmt not in ('snapshot', 'delta'):
+            return api_response(None, 'format 只能为 snapshot 或 delta', 400)
+        position = request.args.get('position', type=int)
+        contexts = current_app.task_manager.task_service.get_run_contexts(
+            run_id, materialize=fmt == 'snapshot', position=position)
+        # contexts returned as list of dicts with keys: script, position, context / delta, created_at
         return api_response(contexts, '获取成功', 200)
     except Exception as e:
         logger.error(f"获取数据库任务环境变量历史失败: {e}")
         return api_response(None, str(e), 500)
+
+@bp.route('/db/runs/<int:run_id>/profiles', methods=['GET'])
+def get_db_run_profiles(run_id):
+    """列出运行中有剖析结果的脚本"""
+    try:
+        profiles = current_app.task_manager.task_service.get_run_profiles(run_id)
+        return api_response(profiles, '获取成功', 200)
+    except Exception as e:
+        logger.error(f"获取剖析结果列表失败: {e}")
+        return api_response(None, str(e), 500)
+
+@bp.route('/db/runs/<int:run_id>/profiles/top', methods=['GET'])
+def get_db_run_profile_top(run_id):
+    """脚本最耗时的函数：?script=（必填）&limit=N&sort=self|total"""
+    try:
+        script = safe_script_name(request.args.get('script'))
+        if not script:
+            return api_response(None, '缺少或非法的 script 参数', 400)
+        sort = request.args.get('sort', 'self')
+        if sort not in ('self', 'total'):
+            return api_response(None, 'sort 只能为 self 或 total', 400)
+        limit = request.args.get('limit', type=int)
+        if limit is not None and limit <= 0:
+            return api_response(None, 'limit 必须为正整数', 400)
+        top = current_app.task_manager.task_service.get_profile_top(run_id, script, limit, sort)
+        if top is None:
+            return api_response(None, '该脚本没有剖析结果', 404)
+        return api_response(top, '获取成功', 200)
+    except Exception as e:
+        logger.error(f"获取剖析热点失败: {e}")
+        return api_response(None, str(e), 500)
+
+@bp.route('/db/runs/<int:run_id>/profiles/download', methods=['GET'])
+def download_db_run_profile(run_id):
+    """下载剖析结果：?script=（必填）&format=pstats|collapsed（默认 collapsed，可直接用于火焰图工具）"""
+    try:
+        script = safe_script_name(request.args.get('script'))
+        if not script:
+            return api_response(None, '缺少或非法的 script 参数', 400)
+        fmt = request.args.get('format', 'collapsed')
+        if fmt not in ('pstats', 'collapsed'):
+            return api_response(None, 'format 只能为 pstats 或 collapsed', 400)
+        data = current_app.task_manager.task_service.get_profile_file(run_id, script, fmt)
+        if data is None:
+            return api_response(None, '该脚本没有对应格式的剖析结果', 404)
+        return Response(
+            data,
+            mimetype='application/octet-stream' if fmt == 'pstats' else 'text/plain; charset=utf-8',
+            headers={'Content-Disposition': f'attachment; filename="run_{run_id}_{script}.{fmt}"'}
+        )
+    except Exception as e:
+        logger.error(f"下载剖析结果失败: {e}")
+        return api_response(None, str(e), 500)
+
+@bp.route('/db/runs/<int:run_id>/trace', methods=['GET'])
+def get_db_run_trace(run_id):
+    """运行的追踪时间线：从提交请求、排队、各脚本的子进程阶段到落库的嵌套 span，以及按阶段汇总的自身耗时"""
+    try:
+        data = current_app.task_manager.task_service.get_run_trace(run_id)
+        if data is None:
+            return api_response(None, '该运行没有追踪记录', 404)
+        return api_response(data)
+    except Exception as e:
+        logger.error(f"获取运行追踪失败: {e}")
+        return api_response(None, str(e), 500)
@@ -0,0 +1,130 @@
+"""生产部署：gunicorn（gthread）多 worker 提供 API，运行与定时触发集中在唯一的专用 runner 进程。
+
+- Web worker 以 RUN_MODE=queue、SCHEDULER_ENABLED=0 启动：执行请求只写入数据库运行队列，
+  worker 内不执行运行，N 个 worker 也不会各自启动定时触发
+- gunicorn master 启动时拉起一个 runner 进程（python -m app.agent --scheduler），
+  由它领取并执行运行、触发定时任务；runner 意外退出时按退避间隔重启，master 退出时 runner 随之停止
+- master 收到 SIGTERM：先在 graceful_timeout 内停止 Web worker，再向 runner 发送 SIGTERM；
+  runner 不再领取新运行并等待执行中的运行结束，超过 RUNNER_DRAIN_TIMEOUT 时终止脚本进程退出，
+  未完成的运行在租约过期后由重启后的 runner（或其他 agent）重新领取执行
+
+gunicorn.conf.py 加载时调用 prepare_environment()，worker 由 master fork，继承修改后的配置。
+
+用法（在 backend 目录下）：
+  gunicorn -c gunicorn.conf.py wsgi:app
+"""
+import os
+import sys
+import time
+import signal
+import subprocess
+import threading
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_scheduler_enabled = True
+
+
+def prepare_environment():
+    """让 Web worker 只入队不执行；返回是否需要由 runner 运行定时触发"""
+    global _scheduler_enabled
+    from app.core.config import Config
+    _scheduler_enabled = Config.SCHEDULER_ENABLED
+    # 环境变量传给 runner 子进程，类属性对已导入配置的 master 及 fork 出的 worker 生效
+    os.environ['RUN_MODE'] = Config.RUN_MODE = 'queue'
+    os.environ['SCHEDULER_ENABLED'] = '0'
+    Config.SCHEDULER_ENABLED = False
+    # 系统监控的进程树以 master 为根，包含全部 Web worker、runner 及其脚本进程
+    os.environ['SERVICE_ROOT_PID'] = str(os.getpid())
+    return _scheduler_enabled
+
+
+class RunnerSupervisor:
+    """在 gunicorn master 中管理唯一的 runner 进程"""
+
+    def __init__(self, scheduler=None):
+        self.scheduler = _scheduler_enabled if scheduler is None else scheduler
+        self.proc = None
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self._thread = None
+
+    def _logger(self):
+        from app.utils.logger import setup_logger
+        return setup_logger(__name__)
+
+    def _spawn(self):
+        from app.core.config import Config
+        cmd = [sys.executable, '-m', 'app.agent',
+               '--concurrency', str(Config.MAX_TASK_WORKERS),
+               '--drain-timeout', str(Config.RUNNER_DRAIN_TIMEOUT),
+               '--exit-with-parent']
+        if self.scheduler:
+            cmd.append('--scheduler')
+        # 独立会话：终端的 Ctrl-C 只发给 master，由 master 按顺序停止 worker 与 runner
+        proc = subprocess.Popen(cmd, cwd=BACKEND_DIR, start_new_session=True)
+        self._logger().info(f"runner 进程已启动: pid={proc.pid}, scheduler={self.scheduler}")
+        return proc
+
+    def start(self):
+        with self.lock:
+            if self._thread is not None:
+                return
+            self.proc = self._spawn()
+            self._thread = threading.Thread(target=self._monitor, name='runner-supervisor', daemon=True)
+            self._thread.start()
+
+    def _monitor(self):
+        backoff = 1.0
+        started = time.monotonic()
+        while not self.stopping.wait(1.0):
+            with self.lock:
+                proc = self.proc
+                if proc is None or proc.poll() is None:
+                    continue
+                if self.stopping.is_set():
+                    return
+                # 持续运行一段时间后退出的不计入退避，连续崩溃时重启间隔翻倍（最长 60 秒）
+                if time.monotonic() - started > 60:
+                    backoff = 1.0
+                # gunicorn master 会回收所有子进程，这里拿到的退出码不可靠，不做区分
+                self._logger().error(f"runner 进程 {proc.pid} 意外退出，{backoff:.0f}s 后重启")
+            if self.stopping.wait(backoff):
+                return
+            backoff = min(backoff * 2, 60.0)
+            with self.lock:
+                if self.stopping.is_set():
+                    return
+                self.proc = self._spawn()
+                started = time.monotonic()
+
+    def stop(self):
+        """通知 runner 排空并等待其退出；超过 RUNNER_DRAIN_TIMEOUT 仍未退出时终止整个进程树"""
+        import psutil
+        from app.core.config import Config
+        self.stopping.set()
+        with self.lock:
+            proc = self.proc
+        if proc is None or proc.poll() is not None:
+            return
+        logger = self._logger()
+        logger.info(f"通知 runner 进程 {proc.pid} 停止，等待执行中的运行结束（最长 {Config.RUNNER_DRAIN_TIMEOUT}s）")
+        proc.send_signal(signal.SIGTERM)
+        try:
+            # runner 自己会在 drain 超时后终止脚本并退出，这里多留出落库的时间
+            proc.wait(Config.RUNNER_DRAIN_TIMEOUT + Config.DB_WRITER_SHUTDOWN_TIMEOUT + 5)
+        except subprocess.TimeoutExpired:
+            logger.error(f"runner 进程 {proc.pid} 未能按时退出，强制终止")
+            try:
+                # 脚本进程各自是独立进程组，需按进程树逐个终止
+                children = psutil.Process(proc.pid).children(recursive=True)
+            except psutil.Error:
+                children = []
+            proc.kill()
+            for child in children:
+                try:
+                    child.kill()
+                except psutil.Error:
+                    pass
+            proc.wait()
+        logger.info(f"runner 进程 {proc.pid} 已退出")
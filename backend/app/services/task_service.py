@@ -1,70 +1,159 @@
 import os
 import threading
 from app.utils.script_runner import run_script
+from app.utils.log_writer import ScriptLogWriter
 import uuid
 import re
 import json
-from datetime import datetime
+import time
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
+from sqlalchemy import and_, or_, func
+from sqlalchemy.orm import joinedload
 from app.models.db import SessionLocal
-from app.models.task_models import Task, Script, TaskRun
+from app.models.task_models import Task, Script, TaskRun, TaskRunStep, TaskRunLog, TaskRunContext, TaskRunProfile
 from app.core.config import Config
+from app.core.run_scheduler import RunScheduler, QueueFullError
+from app.core.log_hub import log_hub, list_script_logs, safe_script_name
+from app.core.db_writer import db_writer
+from app.core import run_storage, run_queue, log_archive, context_history, trace_store
+from app.core.dag import ContextMerger, DagError, MERGE_POLICIES, normalize_scripts, resolve
+from app.core.result_cache import result_cache, parse_cache_option
+from app.core.context_history import context_delta, apply_delta
+from app.utils.file_reader import read_file_range, read_range, tail_lines
+from app.utils import proc_limits, metrics, profiling, tracing
+from app.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+RUN_QUEUE_DEPTH = metrics.gauge('run_queue_depth', '等待执行的运行数（queue 模式下为等待 agent 领取的运行数）')
+RUNS_ACTIVE = metrics.gauge('runs_active', '本进程正在执行的运行数')
+SCRIPT_DURATION = metrics.histogram('script_duration_seconds', '脚本执行耗时（不含命中结果缓存的脚本）',
+                                    labels=('status',))
 
 class TaskService:
     """数据库持久化任务编排与执行服务"""
-    def __init__(self):
+    def __init__(self, max_workers=None, ship_logs=False):
         self.tasks_dir = Config.TASKS_DIR
-        self.max_workers = Config.MAX_TASK_WORKERS
+        self.max_workers = max_workers or Config.MAX_TASK_WORKERS
         self.task_timeout = Config.TASK_TIMEOUT
         self.active_runs = {}
         self.lock = threading.RLock()
+        self.node = run_queue.node_name()
+        # runner agent 模式下边执行边上报日志块，API 节点据此提供执行中的日志
+        self.ship_logs = ship_logs
+        self._remote_callbacks = {}  # RUN_MODE=queue 时等待结束回调的 run_id -> on_finish
+        self._watcher = None
+        self._heartbeat = None
+        # 有界执行器：最多 max_workers 个运行并发，其余进入 FIFO 待执行队列
+        self.scheduler = RunScheduler(max_workers=self.max_workers)
+        metrics.register_collector(self.collect_metrics)
 
-    def list_tasks(self):
-        """获取所有编排任务"""
+    def list_tasks(self, after_id=None, limit=None):
+        """获取编排任务（按 id 升序，可用 after_id + limit 做键集分页）"""
         session = SessionLocal()
         try:
-            tasks = session.query(Task).all()
-            result = []
-            for task in tasks:
-                scripts = session.query(Script).filter(Script.task_id == task.id).order_by(Script.order).all()
-                result.append({
-                    'id': task.id,
-                    'name': task.name,
-                    'description': task.description,
-                    'scripts': [s.filename for s in scripts]
-                })
-            return result
+            # 一次查询连同脚本一起加载，避免每个任务再查一次 Script
+            query = session.query(Task).options(joinedload(Task.scripts)).order_by(Task.id)
+            if after_id is not None:
+                query = query.filter(Task.id > after_id)
+            if limit:
+                query = query.limit(self._page_limit(limit))
+            return [{
+                'id': task.id,
+                'name': task.name,
+                'description': task.description,
+                'scripts': [s.filename for s in task.scripts],
+                'depends_on': {s.filename: s.depends_on for s in task.scripts if s.depends_on is not None},
+                'cache': {s.filename: {'ttl': s.cache_ttl, 'inputs': s.cache_inputs}
+                          for s in task.scripts if s.cache_ttl},
+                'parallelism': task.parallelism,
+                'merge_policy': task.merge_policy
+            } for task in query.all()]
         finally:
             session.close()
 
-    def create_task(self, name, description, script_filenames):
-        """创建任务并编排脚本顺序"""
+    def _page_limit(self, limit):
+        if not limit or limit <= 0:
+            return Config.PAGE_SIZE
+        return min(limit, Config.MAX_PAGE_SIZE)
+
+    def _validate_options(self, parallelism, merge_policy):
+        if parallelism is not None and (not isinstance(parallelism, int) or parallelism < 1):
+            raise DagError('parallelism 必须是正整数')
+        if merge_policy is not None and merge_policy not in MERGE_POLICIES:
+            raise DagError(f"merge_policy 必须是 {'/'.join(MERGE_POLICIES)} 之一")
+
+    def _cache_option(self, item, previous=None):
+        """脚本项的 cache 配置 -> (ttl, inputs)；未写 cache 时沿用 previous 中该脚本原有的设置"""
+        if not isinstance(item, dict):
+            return (previous or {}).get(item, (None, None))
+        if 'cache' not in item:
+            return (previous or {}).get(item.get('filename') or item.get('name'), (None, None))
+        try:
+            return parse_cache_option(item['cache'])
+        except ValueError as e:
+            raise DagError(f"{item.get('filename') or item.get('name')}: {e}")
+
+    def create_task(self, name, description, script_filenames, parallelism=None, merge_policy=None):
+        """创建任务并编排脚本；脚本项可以是文件名或 {'filename', 'depends_on', 'cache'}，配置不合法时抛出 DagError"""
+        scripts = normalize_scripts(script_filenames)
+        caches = [self._cache_option(item) for item in script_filenames]
+        self._validate_options(parallelism, merge_policy)
         session = SessionLocal()
         try:
-            task = Task(name=name, description=description)
+            task = Task(name=name, description=description, parallelism=parallelism, merge_policy=merge_policy)
             session.add(task)
             session.flush()  # 获取task.id
-            for order, filename in enumerate(script_filenames):
-                script = Script(task_id=task.id, filename=filename, order=order)
+            for order, (filename, depends_on) in enumerate(scripts):
+                cache_ttl, cache_inputs = caches[order]
+                script = Script(task_id=task.id, filename=filename, order=order, depends_on=depends_on,
+                                cache_ttl=cache_ttl, cache_inputs=cache_inputs)
                 session.add(script)
             session.commit()
             return task.id
         finally:
             session.close()
 
-    def update_task(self, task_id, name, description, script_filenames):
-        """更新数据库中的任务及其脚本顺序"""
+    def update_task(self, task_id, name, description, script_filenames, parallelism=None, merge_policy=None):
+        """更新数据库中的任务及其脚本编排。
+
+        只传文件名的脚本项沿用该脚本原有的依赖声明与缓存设置（前端只调整顺序时不会丢失依赖图），
+        原依赖引用的脚本已被移除时回退为依赖上一个脚本。
+        """
         session = SessionLocal()
         try:
             task = session.query(Task).filter(Task.id == task_id).first()
             if not task:
                 return False, '任务不存在'
+            previous = {s.filename: s.depends_on for s in task.scripts}
+            previous_cache = {s.filename: (s.cache_ttl, s.cache_inputs) for s in task.scripts}
+            names = {i if isinstance(i, str) else (i or {}).get('filename') for i in script_filenames or []}
+            items = []
+            for item in script_filenames or []:
+                if isinstance(item, str) and previous.get(item) is not None:
+                    depends_on = previous[item]
+                    item = {'filename': item, 'depends_on': depends_on if set(depends_on) <= names else None}
+                items.append(item)
+            scripts = normalize_scripts(items)
+            caches = [self._cache_option(item, previous_cache) for item in script_filenames or []]
+            self._validate_options(parallelism, merge_policy)
+
             task.name = name or task.name
             task.description = description or task.description
+            if parallelism is not None:
+                task.parallelism = parallelism
+            if merge_policy is not None:
+                task.merge_policy = merge_policy
 
             # 删除旧的脚本并重新创建新的顺序
             session.query(Script).filter(Script.task_id == task_id).delete()
-            for order, filename in enumerate(script_filenames):
-                script = Script(task_id=task_id, filename=filename, order=order)
+            for order, (filename, depends_on) in enumerate(scripts):
+                cache_ttl, cache_inputs = caches[order]
+                script = Script(task_id=task_id, filename=filename, order=order, depends_on=depends_on,
+                                cache_ttl=cache_ttl, cache_inputs=cache_inputs)
                 session.add(script)
 
             session.commit()
@@ -75,176 +164,659 @@ class TaskService:
         finally:
             session.close()
 
-    def run_task(self, task_id, context=None):
-        """执行任务，依次执行脚本，支持环境变量上下文"""
+    def build_plan(self, task):
+        """由任务当前的脚本编排生成执行计划（提交时确定，之后修改任务不影响已提交的运行）；依赖不合法时抛出 DagError"""
+        ordered = sorted(task.scripts, key=lambda sc: sc.order)
+        deps = resolve([(sc.filename, sc.depends_on) for sc in ordered])
+        plan = {
+            'scripts': [sc.filename for sc in ordered],
+            'deps': [sorted(d) for d in deps],
+            'parallelism': task.parallelism or Config.TASK_PARALLELISM,
+            'merge_policy': task.merge_policy or Config.TASK_MERGE_POLICY,
+        }
+        cache = [{'ttl': sc.cache_ttl, 'inputs': sc.cache_inputs} if sc.cache_ttl else None for sc in ordered]
+        if any(cache):
+            plan['cache'] = cache
+        return plan
+
+    def run_task(self, task_id, context=None, on_finish=None, force=False, profile=None):
+        """提交任务运行：写入 queued 状态的 TaskRun 并交给调度器，队列已满时抛出 QueueFullError。
+
+        RUN_MODE=queue 时只写入数据库队列，由 runner agent 领取执行。
+        on_finish(run_id, status) 在运行结束（含异常）后回调，供定时触发释放重叠锁。
+        force 为 True 时开启了结果缓存的脚本也重新执行，并用本次结果覆盖缓存。
+        profile 为 cprofile / sampling 时每个脚本在对应的剖析器下执行（命中结果缓存的脚本不剖析）。
+        """
+        if profile and profile not in profiling.MODES:
+            return None, f"profile 只能为 {' / '.join(profiling.MODES)}"
+        queue_mode = Config.RUN_MODE == 'queue'
+        # 先做一次廉价的容量检查，避免突发流量下反复插入/删除运行记录
+        if not queue_mode and self.scheduler.is_full():
+            stats = self.scheduler.stats()
+            raise QueueFullError(stats['pending'], stats['max_pending'])
+
         session = SessionLocal()
         try:
+            if queue_mode:
+                depth = run_queue.pending_count(session)
+                if depth >= Config.MAX_PENDING_RUNS:
+                    raise QueueFullError(depth, Config.MAX_PENDING_RUNS)
             task = session.query(Task).filter(Task.id == task_id).first()
             if not task:
                 return None, "任务不存在"
+            try:
+                plan = self.build_plan(task)
+            except DagError as e:
+                return None, f"脚本依赖配置错误: {e}"
+            if force:
+                plan['force'] = True
+            if profile:
+                plan['profile'] = profile
+            trace = tracing.propagate()
+            if trace is not None:
+                # 运行的 span 挂在本次请求之下；queue 模式由 agent 从计划中取出
+                plan['trace'] = dict(trace, submitted_at=time.time())
             initial_context = context or {}
-            run = TaskRun(task_id=task.id, status='running', initial_context=initial_context, final_context=initial_context)
-            session.add(run)
-            session.commit()
-            thread = threading.Thread(target=self._run_scripts, args=(run.id,))
-            thread.daemon = False
-            thread.start()
-            # store a structure so we can collect streaming logs per script
-            self.active_runs[run.id] = {
-                'thread': thread,
-                'stream_logs': {},  # map: script_filename -> [lines]
-                'run_dir': os.path.join(Config.LOGS_DIR, f"run_{run.id}")
+            # 本地执行的运行直接记为本节点持有，不会被 agent 领取；final_context 在运行结束时写入
+            run = TaskRun(task_id=task.id, status='queued', initial_context=initial_context,
+                          plan=plan, heartbeat_at=datetime.utcnow(),
+                          claimed_by=None if queue_mode else self.node)
+            with tracing.span('db_insert_run'):
+                session.add(run)
+                session.commit()
+            run_id = run.id
+            tracing.bind_run(run_id)
+            if queue_mode:
+                if on_finish is not None:
+                    self._watch_remote_run(run_id, on_finish)
+                return run_id, "任务已进入运行队列，等待 runner 领取"
+            try:
+                position = self.start_run(run_id, plan, initial_context, on_finish)
+            except QueueFullError:
+                # 与其他请求竞争导致队列已满：撤销本次运行记录
+                session.delete(run)
+                session.commit()
+                raise
+            if position:
+                return run_id, f"任务已进入等待队列，当前位置: {position}"
+            return run_id, "任务已提交执行"
+        finally:
+            session.close()
+
+    def start_run(self, run_id, plan, context, on_finish=None):
+        """把已写入数据库的运行交给本进程的调度器执行，返回等待队列位置（0 表示立即执行）。
+
+        plan 含 resume 时跳过其中已完成的脚本，并以保存的上下文快照继续执行；
+        含 trace 时运行的 span 挂在提交运行的请求之下，排队耗时从 trace 中的提交时间算起。
+        """
+        resume = plan.get('resume') or {}
+        trace = dict(plan.get('trace') or {})
+        trace.setdefault('submitted_at', time.time())
+        if resume:
+            context = resume.get('context') or context
+        run_dir = os.path.join(Config.LOGS_DIR, f"run_{run_id}")
+        # store a structure so we can collect streaming logs per script
+        with self.lock:
+            self.active_runs[run_id] = {
+                'status': 'queued',
+                'stream_logs': {},  # map: script_filename -> deque of recent lines
+                'run_dir': run_dir,
+                'procs': proc_limits.ProcessGroups(),  # 执行中的脚本进程组，abort_run 时终止
             }
-            return run.id, "任务已提交执行"
+        # 排队期间连接的实时日志查看者也挂在同一个扇出缓冲上等待
+        log_hub.open_stream(run_id, run_dir)
+        try:
+            with tracing.span('schedule_submit'):
+                return self.scheduler.submit(
+                    run_id, self._run_scripts, run_id, plan['scripts'], [set(d) for d in plan['deps']],
+                    dict(context or {}), plan.get('parallelism'), plan.get('merge_policy') or Config.TASK_MERGE_POLICY,
+                    on_finish, resume.get('completed') or (), plan.get('cache'), plan.get('force', False),
+                    plan.get('profile'), trace)
+        except QueueFullError:
+            with self.lock:
+                self.active_runs.pop(run_id, None)
+            log_hub.close_stream(run_id)
+            raise
+
+    def _watch_remote_run(self, run_id, on_finish):
+        """由 agent 执行的运行：轮询数据库状态，结束后在本进程回调 on_finish"""
+        with self.lock:
+            self._remote_callbacks[run_id] = on_finish
+            if self._watcher is None:
+                self._watcher = threading.Thread(target=self._watch_loop, name='remote-run-watcher')
+                self._watcher.daemon = True
+                self._watcher.start()
+
+    def _watch_loop(self):
+        while True:
+            time.sleep(Config.RUNNER_POLL_INTERVAL)
+            with self.lock:
+                run_ids = list(self._remote_callbacks)
+            if not run_ids:
+                continue
+            session = SessionLocal()
+            try:
+                rows = session.query(TaskRun.id, TaskRun.status).filter(TaskRun.id.in_(run_ids)).all()
+            except Exception as e:
+                logger.error(f"查询远程运行状态失败: {e}")
+                continue
+            finally:
+                session.close()
+            statuses = dict(rows)
+            for run_id in run_ids:
+                status = statuses.get(run_id)
+                if status in run_queue.ACTIVE_STATUSES:
+                    continue
+                with self.lock:
+                    callback = self._remote_callbacks.pop(run_id, None)
+                if callback is not None:
+                    try:
+                        callback(run_id, status)
+                    except Exception as e:
+                        logger.error(f"运行 {run_id} 结束回调异常: {e}")
+
+    RESUMABLE_STATUSES = ('interrupted', 'failed')
+
+    def start_heartbeat(self):
+        """启动心跳线程：定期刷新本进程运行的 heartbeat_at，并回收心跳超时的孤儿运行"""
+        with self.lock:
+            if self._heartbeat is not None:
+                return
+            self._heartbeat = threading.Thread(target=self._heartbeat_loop, name='run-heartbeat')
+            self._heartbeat.daemon = True
+        try:
+            self.recover_runs()
+        except Exception as e:
+            logger.error(f"启动时回收中断的运行失败: {e}")
+        self._heartbeat.start()
+
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(Config.RUN_HEARTBEAT_INTERVAL)
+            now = datetime.utcnow()
+            with self.lock:
+                run_ids = [run_id for run_id, info in self.active_runs.items()
+                           if info.get('status') in ('queued', 'running')]
+            for run_id in run_ids:
+                db_writer.update_run(run_id, heartbeat_at=now)
+            try:
+                self.recover_runs()
+            except Exception as e:
+                logger.error(f"回收中断的运行失败: {e}")
+
+    def recover_runs(self):
+        """把心跳超时的本地运行（执行它的进程已退出）标记为 interrupted，返回这些 run_id。
+
+        只处理没有租约的运行：由 runner agent 执行的运行按租约过期重新入队（见 run_queue）。
+        RUN_RESUME_ON_RECOVERY 开启时随后从最后一个完成的脚本之后继续执行。
+        """
+        stale = datetime.utcnow() - timedelta(seconds=Config.RUN_HEARTBEAT_TIMEOUT)
+        orphaned = and_(
+            TaskRun.lease_expires_at.is_(None),
+            or_(TaskRun.status == 'running',
+                and_(TaskRun.status == 'queued', TaskRun.claimed_by.isnot(None))),
+            func.coalesce(TaskRun.heartbeat_at, TaskRun.started_at) < stale,
+        )
+        with self.lock:
+            local = {run_id for run_id, info in self.active_runs.items()
+                     if info.get('status') in ('queued', 'running')}
+        session = SessionLocal()
+        recovered = []
+        try:
+            candidates = [row.id for row in session.query(TaskRun.id).filter(orphaned)
+                          if row.id not in local]
+            now = datetime.utcnow()
+            for run_id in candidates:
+                # 条件更新：多个进程同时回收时只有一个成功
+                updated = session.query(TaskRun).filter(TaskRun.id == run_id, orphaned) \
+                    .update({'status': 'interrupted', 'finished_at': now}, synchronize_session=False)
+                if updated:
+                    session.query(TaskRunStep) \
+                        .filter(TaskRunStep.run_id == run_id, TaskRunStep.status == 'running') \
+                        .update({'status': 'interrupted', 'finished_at': now}, synchronize_session=False)
+                    recovered.append(run_id)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
         finally:
             session.close()
 
-    def _run_scripts(self, run_id):
-        """执行脚本序列，环境变量完全隔离，使用 multiprocessing.Manager() 提供共享上下文代理"""
-        from multiprocessing import Manager
+        for run_id in recovered:
+            logger.warning(f"运行 {run_id} 的心跳已超时（执行进程可能已退出），标记为 interrupted")
+            if Config.RUN_RESUME_ON_RECOVERY:
+                resumed, message = self.resume_run(run_id)
+                if not resumed:
+                    logger.warning(f"运行 {run_id} 未能自动恢复: {message}")
+        return recovered
+
+    def _resume_context(self, run, plan, completed):
+        """最后一个完成的脚本之后的上下文：数据库中的历史，其次 files 存储的 contexts.jsonl / 旧版 .context.json，
+        最后 final_context"""
+        context = run_storage.latest_context(run.id)
+        if context is not None:
+            return context
+        run_dir = os.path.join(Config.LOGS_DIR, f"run_{run.id}")
+        entries = context_history.read_file(run_dir)
+        if entries:
+            return context_history.latest(run.initial_context, entries)
+        names = {plan['scripts'][i] for i in completed}
+        paths = [os.path.join(run_dir, f"{name}.context.json") for name in names]
+        paths = [p for p in paths if os.path.exists(p)]
+        if paths:
+            try:
+                with open(max(paths, key=os.path.getmtime), 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"运行 {run.id} 的上下文文件无法读取: {e}")
+        return run.final_context or run.initial_context or {}
 
+    def resume_run(self, run_id):
+        """从最后一个完成的脚本之后继续执行中断 / 失败的运行（沿用同一个 run_id），返回 (run_id, 消息)"""
         session = SessionLocal()
-        manager = None
         try:
             run = session.query(TaskRun).filter(TaskRun.id == run_id).first()
-            task = run.task
-            context = dict(run.initial_context or {})  # 创建独立拷贝，完全隔离
+            if run is None:
+                return None, "运行不存在"
+            if run.status not in self.RESUMABLE_STATUSES:
+                return None, f"只能恢复 {'/'.join(self.RESUMABLE_STATUSES)} 状态的运行，当前为 {run.status}"
+            plan = dict(run.plan or {})
+            if not plan.get('scripts'):
+                try:
+                    plan = self.build_plan(run.task)
+                except DagError as e:
+                    return None, f"脚本依赖配置错误: {e}"
+            completed = sorted(
+                st.position for st in run.steps
+                if st.status == 'success' and st.position < len(plan['scripts']))
+            if len(completed) == len(plan['scripts']):
+                return None, "所有脚本均已完成，无需恢复"
+            # 已被打包进归档的运行目录先解压回来，已完成脚本的日志 / 上下文文件继续留在运行目录中
+            log_archive.restore(run_id, os.path.join(Config.LOGS_DIR, f"run_{run_id}"))
+            context = self._resume_context(run, plan, completed)
+            plan['resume'] = {'completed': completed, 'context': context}
+            plan.pop('trace', None)
+            trace = tracing.propagate()
+            if trace is not None:
+                plan['trace'] = dict(trace, submitted_at=time.time())
+
+            # 清掉未完成脚本的日志块 / 上下文 / 状态，以及本机运行目录中对应的日志文件
+            stale_logs = run_queue.reset_partial(session, run_id, plan)
+            run_dir = os.path.join(Config.LOGS_DIR, f"run_{run_id}")
+            for name in stale_logs:
+                for suffix in ('.log', '.context.json', profiling.PSTATS_SUFFIX, profiling.COLLAPSED_SUFFIX):
+                    try:
+                        os.remove(os.path.join(run_dir, f"{name}{suffix}"))
+                    except OSError:
+                        pass
+            entries = context_history.read_file(run_dir)
+            if entries:
+                kept, _ = context_history.drop(run.initial_context, entries, set(completed))
+                context_history.write_file(run_dir, kept)
+
+            queue_mode = Config.RUN_MODE == 'queue'
+            updated = session.query(TaskRun) \
+                .filter(TaskRun.id == run_id, TaskRun.status.in_(self.RESUMABLE_STATUSES)) \
+                .update({'status': 'queued', 'plan': plan, 'finished_at': None, 'final_context': None,
+                         'heartbeat_at': datetime.utcnow(), 'lease_expires_at': None, 'attempts': 0,
+                         'claimed_by': None if queue_mode else self.node}, synchronize_session=False)
+            if not updated:
+                session.rollback()
+                return None, "运行已被其他请求恢复"
+            session.commit()
+            tracing.bind_run(run_id)
+        finally:
+            session.close()
+
+        logger.info(f"运行 {run_id} 从第 {len(completed) + 1} 个脚本起恢复执行，跳过已完成的 {len(completed)} 个")
+        if queue_mode:
+            return run_id, f"已重新进入运行队列，跳过已完成的 {len(completed)} 个脚本"
+        try:
+            position = self.start_run(run_id, plan, context)
+        except QueueFullError:
+            db_writer.update_run(run_id, status='interrupted', finished_at=datetime.utcnow())
+            raise
+        if position:
+            return run_id, f"已进入等待队列，当前位置: {position}，跳过已完成的 {len(completed)} 个脚本"
+        return run_id, f"已恢复执行，跳过已完成的 {len(completed)} 个脚本"
+
+    def get_queue_position(self, run_id):
+        """返回运行在等待队列中的位置（0 表示执行中，None 表示不在调度器中）"""
+        if Config.RUN_MODE == 'queue':
+            return run_queue.position(run_id)
+        return self.scheduler.position(run_id)
+
+    def get_queue_stats(self):
+        """返回调度器的并发与队列状态、运行状态异步写入的积压情况，以及结果缓存的占用"""
+        stats = self.scheduler.stats()
+        stats['db_writer'] = db_writer.stats()
+        if Config.RESULT_CACHE_ENABLED:
+            stats['result_cache'] = result_cache.stats()
+        if Config.RUN_MODE == 'queue':
+            stats['run_queue'] = run_queue.stats()
+        return stats
+
+    def collect_metrics(self):
+        """后台采样：队列深度与执行中的运行数"""
+        stats = self.scheduler.stats()
+        RUNS_ACTIVE.set(stats['running'])
+        if Config.RUN_MODE == 'queue':
+            RUN_QUEUE_DEPTH.set(run_queue.pending_count())
+        else:
+            RUN_QUEUE_DEPTH.set(stats['pending'])
+
+    def _run_scripts(self, run_id, scripts, deps, initial_context, parallelism=1, merge_policy='order',
+                     on_finish=None, completed=(), cache=None, force=False, profile=None, trace=None):
+        """按依赖图执行脚本，环境变量完全隔离，上下文以快照方式传入子进程并在脚本结束时批量回写。
+
+        scripts 为按 order 排列的文件名，deps[i] 为脚本 i 依赖的下标集合（顺序任务即 {i-1}）。
+        依赖全部完成的节点并发执行，最多 parallelism 个；各节点的上下文回写由 ContextMerger 合并。
+        scripts / initial_context 在提交时已从数据库读出；运行期间不持有数据库连接，
+        状态、每个脚本的耗时与上下文都交给 db_writer 异步落库。
+        completed 为恢复执行时已完成的脚本下标，这些脚本不再执行，initial_context 为其后的上下文快照。
+        cache[i] 为脚本 i 的结果缓存设置 {'ttl', 'inputs'}（未开启为 None），force 时不读缓存。
+        profile 为 cprofile / sampling 时每个脚本的剖析结果保存在其日志旁（db 存储时另写入 TaskRunProfile）。
+        TRACE_ENABLED 时记录排队、各节点、上下文合并与收尾等阶段的 span，每个节点结束后增量导出（见 trace_store）。
+        """
+        final_status = None
+        trace = trace or {}
+        tracer = tracing.Tracer(run_id, Config.TRACE_MAX_SPANS) if Config.TRACE_ENABLED else None
+        run_span, run_started = tracing.new_id(), time.time()
+        trace_token = tracing.attach(tracer, run_span)
+        if tracer is not None and 'submitted_at' in trace:
+            tracer.record('queue_wait', trace['submitted_at'], run_started, trace.get('parent'))
+        try:
+            merger = ContextMerger(initial_context, merge_policy, deps)
             status = 'success'
+            store_in_db = Config.RUN_STORAGE == 'db'
+            write_mark = db_writer.mark()
+
+            # 从等待队列中被领取，标记为执行中（恢复执行的运行保留最初的开始时间）
+            if completed:
+                db_writer.update_run(run_id, status='running', heartbeat_at=datetime.utcnow())
+            else:
+                db_writer.update_run(run_id, status='running', started_at=datetime.utcnow(),
+                                     heartbeat_at=datetime.utcnow())
+            with self.lock:
+                if run_id in self.active_runs:
+                    self.active_runs[run_id]['status'] = 'running'
 
-            # 创建 Manager，并用 dict 代理保存初始上下文
-            manager = Manager()
-            context_proxy = manager.dict(context)
+            with self.lock:
+                procs = self.active_runs[run_id]['procs'] if run_id in self.active_runs else None
 
             # prepare run directory under configured LOGS_DIR
-            run_dir = os.path.join(Config.LOGS_DIR, f"run_{run.id}")
+            run_dir = os.path.join(Config.LOGS_DIR, f"run_{run_id}")
             try:
                 os.makedirs(run_dir, exist_ok=True)
             except Exception:
                 pass
+            # 实时日志扇出缓冲，供 SSE 查看者共享
+            log_stream = log_hub.open_stream(run_id, run_dir)
 
-            # start consumer thread helper
-            def _consume_logs(q, stop_evt, logs_list, logfile_path):
-                try:
-                    with open(logfile_path, 'a', encoding='utf-8') as lf:
-                        while not stop_evt.is_set() or not q.empty():
-                            try:
-                                level, msg = q.get(timeout=0.5)
-                                line = f"[{level}] {msg}\n"
-                                logs_list.append(line)
-                                lf.write(line)
-                                lf.flush()
-                            except Exception:
-                                continue
-                except Exception:
-                    pass
+            done = set(completed)
+            pending = set(range(len(scripts))) - done
+            # 上下文历史只记录相对上一条的增量；恢复执行时起点不在历史中，第一条记录完整快照
+            recorded, full = merger.snapshot(), bool(completed)
+            usage = self._completed_usage(run_id, completed)
+            running = {}  # future -> (下标, 启动时的上下文快照)
+            parallelism = max(1, parallelism or 1)
+            with ThreadPoolExecutor(max_workers=parallelism, thread_name_prefix=f"run-{run_id}-node") as pool:
+                while pending or running:
+                    if status == 'success' and not (procs is not None and procs.killed):
+                        # 同名脚本共用一个日志文件，不能同时执行
+                        busy = {scripts[i] for i, _ in running.values()}
+                        for i in sorted(pending):
+                            if len(running) >= parallelism:
+                                break
+                            if deps[i] <= done and scripts[i] not in busy:
+                                pending.discard(i)
+                                busy.add(scripts[i])
+                                before = merger.snapshot()
+                                future = pool.submit(tracing.run_in_span, tracer, run_span, 'node',
+                                                     {'script': scripts[i], 'position': i},
+                                                     self._run_node, run_id, i, scripts[i], before,
+                                                     run_dir, log_stream, store_in_db,
+                                                     cache[i] if cache else None, force, profile, procs)
+                                running[future] = (i, before)
+                    if not running:
+                        break
 
-            for script in sorted(task.scripts, key=lambda s: s.order):
-                script_path = os.path.join(self.tasks_dir, script.filename)
-                logfile_path = os.path.join(run_dir, f"{script.filename}.log")
+                    finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        position, before = running.pop(future)
+                        filename = scripts[position]
+                        after, step_status, step_usage = future.result()
+                        done.add(position)
+                        proc_limits.merge_usage(usage, step_usage)
 
-                # create per-script log queue and consumer to avoid cross-script mixing
-                from multiprocessing import Queue as MPQueue
-                script_log_q = MPQueue()
-                script_stop_evt = threading.Event()
-                # ensure per-script storage exists
-                try:
-                    self.active_runs[run.id]['stream_logs'].setdefault(script.filename, [])
-                    script_storage = self.active_runs[run.id]['stream_logs'][script.filename]
-                except Exception:
-                    script_storage = []
+                        with tracing.span('context_merge', script=filename):
+                            conflicts = merger.apply(position, before, after) if step_status == 'success' else []
+                            if conflicts:
+                                logger.warning(f"运行 {run_id} 脚本 {filename} 的上下文与并行分支冲突 "
+                                               f"({merge_policy}): {conflicts}")
+                                if merge_policy == 'error':
+                                    step_status = 'conflict'
+                                    db_writer.update_step(run_id, position, status='conflict')
+                            context = merger.snapshot()
+                            entry = context_history.make_entry(position, filename, recorded, context, full)
+                            recorded, full = context, False
 
-                consumer_thread = threading.Thread(target=_consume_logs, args=(script_log_q, script_stop_evt, script_storage, logfile_path))
-                consumer_thread.daemon = True
-                consumer_thread.start()
+                            if store_in_db:
+                                db_writer.insert(TaskRunContext, run_id=run_id, position=position,
+                                                 script_filename=filename, context=entry.get('context'),
+                                                 delta=entry.get('delta'), created_at=datetime.utcnow())
+                            else:
+                                # 追加到运行目录的 contexts.jsonl
+                                try:
+                                    context_history.append_file(run_dir, entry)
+                                except Exception:
+                                    pass
+                        if tracer is not None:
+                            trace_store.export(run_id, tracer.drain())
 
-                output, new_context = self._execute_script(script_path, context, context_proxy, script_log_q)
+                        if step_status != 'success':
+                            # 不再启动新节点，等待已在执行的节点结束
+                            status = 'failed'
 
-                # stop consumer for this script and wait a short time for remaining logs
-                try:
-                    script_stop_evt.set()
-                    consumer_thread.join(timeout=2)
-                except Exception:
-                    pass
+            if procs is not None and procs.killed:
+                # 被 abort_run 中止：运行已由其他节点接管或已标记失败，不再写入任何状态
+                logger.warning(f"运行 {run_id} 已中止，{len(pending)} 个脚本未执行")
+                final_status = 'aborted'
+                if store_in_db:
+                    shutil.rmtree(run_dir, ignore_errors=True)
+                return
 
-                # 如果脚本通过代理修改了上下文，则以代理为准
-                try:
-                    context = dict(context_proxy)
-                except Exception:
-                    context = dict(new_context or context)
+            # 因失败未执行的节点
+            for position in sorted(pending):
+                db_writer.update_step(run_id, position, script_filename=scripts[position], status='skipped')
 
-                # 保存脚本输出日志（优先写入通过 SDK 发送的流式日志，避免重复）
-                try:
-                    script_streamed_list = self.active_runs[run.id]['stream_logs'].get(script.filename, [])
-                    streamed = ''.join(script_streamed_list)
-                except Exception:
-                    streamed = ''
+            with tracing.span('finalize', status=status):
+                context = merger.snapshot()
+                db_writer.update_run(run_id, status=status, finished_at=datetime.utcnow(), final_context=context,
+                                     **usage)
+                with self.lock:
+                    if run_id in self.active_runs:
+                        self.active_runs[run_id]['status'] = status
+                final_status = status
 
-                # 只保留通过 SDK (streamed) 的日志；若没有则写入空文件(或保持已打开文件)
+                # 日志与上下文全部落库后运行目录不再需要，删除以免大量小文件堆积
+                if store_in_db and db_writer.flush(since=write_mark):
+                    shutil.rmtree(run_dir, ignore_errors=True)
+        except Exception as e:
+            logger.error(f"运行 {run_id} 执行异常: {e}")
+            final_status = 'failed'
+            db_writer.update_run(run_id, status='failed', finished_at=datetime.utcnow())
+            with self.lock:
+                if run_id in self.active_runs:
+                    self.active_runs[run_id]['status'] = 'failed'
+        finally:
+            tracing.detach(trace_token)
+            if tracer is not None:
+                # 运行目录已删除时（db 存储）span 仍经 db_writer 落库
+                tracer.record('run', run_started, time.time(), trace.get('parent'),
+                              {'status': final_status, 'scripts': len(scripts), 'resumed': bool(completed)},
+                              run_span)
+                trace_store.export(run_id, tracer.drain())
+                if tracer.dropped:
+                    logger.warning(f"运行 {run_id} 追踪超出 TRACE_MAX_SPANS，丢弃 {tracer.dropped} 个 span")
+            log_hub.close_stream(run_id, final_status)
+            if on_finish is not None:
                 try:
-                    script_streamed_list = self.active_runs[run.id]['stream_logs'].get(script.filename, [])
-                    streamed = ''.join(script_streamed_list)
-                except Exception:
-                    streamed = ''
+                    on_finish(run_id, final_status)
+                except Exception as e:
+                    logger.error(f"运行 {run_id} 结束回调异常: {e}")
+
+    def abort_run(self, run_id):
+        """中止本进程中的运行（runner 失去租约时）：丢弃其尚未落库的写入，终止脚本进程组并不再启动新脚本。
+
+        返回运行是否在本进程中；中止后运行线程很快结束，以 'aborted' 回调 on_finish，不再写入状态。
+        """
+        db_writer.abandon(run_id)
+        with self.lock:
+            info = self.active_runs.get(run_id)
+        if info is None:
+            return False
+        killed = info['procs'].kill()
+        if killed:
+            logger.warning(f"运行 {run_id} 已中止，终止 {killed} 个脚本进程组")
+        return True
+
+    def _completed_usage(self, run_id, completed):
+        """恢复执行时已完成脚本的资源用量，作为运行级汇总的起点"""
+        usage = {}
+        if not completed:
+            return usage
+        session = SessionLocal()
+        try:
+            steps = session.query(TaskRunStep).filter(TaskRunStep.run_id == run_id,
+                                                      TaskRunStep.position.in_(list(completed))).all()
+            for st in steps:
+                proc_limits.merge_usage(usage, {f: getattr(st, f) for f in proc_limits.USAGE_FIELDS})
+        finally:
+            session.close()
+        return usage
 
+    def _run_node(self, run_id, position, filename, context, run_dir, log_stream, store_in_db,
+                  cache=None, force=False, profile=None, procs=None):
+        """执行依赖图中的一个脚本节点，返回 (脚本结束后的上下文, 状态, 资源用量)。
+
+        开启结果缓存的脚本先按 (脚本内容, 输入上下文, 声明的输入) 查缓存，命中时回放日志、
+        应用上下文增量而不启动子进程；未命中且执行成功时写入缓存。
+        """
+        script_path = os.path.join(self.tasks_dir, filename)
+        logfile_path = os.path.join(run_dir, f"{filename}.log")
+        step_started = datetime.utcnow()
+        db_writer.update_step(run_id, position, script_filename=filename,
+                              status='running', started_at=step_started)
+        cache_key = cached = None
+        if cache and Config.RESULT_CACHE_ENABLED:
+            with tracing.span('cache_lookup') as sp:
+                cache_key = result_cache.make_key(script_path, context, cache.get('inputs'))
+                cached = result_cache.get(cache_key, force) if cache_key else None
+                sp.set('hit', cached is not None)
+        captured = [] if cache_key else None  # 未命中时收集本次写入的日志，执行成功后存入缓存
+        usage = {}
+
+        # per-script buffered writer: batches arrive from the child on this thread
+        # and go straight to disk; only a bounded tail is kept in memory
+        try:
+            with self.lock:
+                script_storage = self.active_runs[run_id]['stream_logs'].setdefault(
+                    filename, deque(maxlen=Config.LOG_TAIL_LINES))
+        except Exception:
+            script_storage = None
+        shipper = None
+
+        def _on_write(offset, data):
+            nonlocal captured
+            log_stream.publish(filename, offset, data)
+            if shipper is not None:
+                shipper.feed(offset, data)
+            if captured is not None:
+                captured.append(data)
+                if offset + len(data) - log_start > Config.RESULT_CACHE_MAX_ENTRY_BYTES:
+                    captured = None
+
+        log_writer = ScriptLogWriter(logfile_path, tail=script_storage, on_write=_on_write)
+        log_start = log_writer.offset
+        if store_in_db and self.ship_logs:
+            shipper = run_storage.LogShipper(run_id, filename, log_start,
+                                             lambda row: db_writer.insert(TaskRunLog, **row))
+        try:
+            if cached is not None:
+                delta, logs = cached
+                captured = None
+                log_writer.write_batch([('INFO', f"命中结果缓存 {cache_key[:12]}，跳过执行")])
+                log_writer.write_bytes(logs)
+                new_context, step_status, returncode = apply_delta(context, delta), 'success', 0
+            else:
+                with tracing.span('execute') as sp:
+                    output, new_context, step_status, returncode = self._execute_script(
+                        script_path, context, log_writer, usage,
+                        {'mode': profile, 'prefix': os.path.join(run_dir, filename)} if profile else None, procs)
+                    sp.set('status', step_status)
+            if cached is None and step_status != 'success' and output:
+                # 超时 / 执行异常的说明写入该脚本的日志文件
+                log_writer.write_batch([('ERROR', line) for line in output.splitlines()])
+        except Exception as e:
+            new_context, step_status, returncode = context, 'failed', None
+            logger.error(f"运行 {run_id} 脚本执行异常: {filename}, {e}")
+        finally:
+            log_writer.close()
+
+        if shipper is not None:
+            with tracing.span('log_persist', shipped=True):
+                shipper.close()
+        elif store_in_db:
+            # 本脚本新写入的日志区间压缩分块，与状态一起异步落库
+            with tracing.span('log_persist', bytes=log_writer.offset - log_start):
                 try:
-                    # truncate/create logfile; write only streamed logs if present
-                    with open(logfile_path, 'w', encoding='utf-8') as lf:
-                        if streamed:
-                            lf.write(streamed)
-                        else:
-                            # intentionally write nothing to preserve 'only SDK logs' policy
-                            lf.write('')
-                except Exception:
-                    pass
+                    for row in run_storage.build_log_chunks(run_id, filename, logfile_path,
+                                                            log_start, log_writer.offset):
+                        db_writer.insert(TaskRunLog, **row)
+                except Exception as e:
+                    logger.error(f"运行 {run_id} 日志分块失败: {filename}, {e}")
 
-                # 保存此脚本执行后的环境变量状态到文件
-                ctx_path = os.path.join(run_dir, f"{script.filename}.context.json")
+        if profile and cached is None and store_in_db:
+            # 剖析结果与日志一样在运行结束后随运行目录删除，先压缩落库
+            with tracing.span('profile_persist'):
                 try:
-                    with open(ctx_path, 'w', encoding='utf-8') as cf:
-                        json.dump(context, cf, ensure_ascii=False, indent=2)
-                except Exception:
-                    pass
+                    row = run_storage.build_profile_row(run_id, position, filename, os.path.join(run_dir, filename))
+                    if row is not None:
+                        db_writer.insert(TaskRunProfile, **row)
+                except Exception as e:
+                    logger.error(f"运行 {run_id} 剖析结果保存失败: {filename}, {e}")
 
-                # commit run state (update DB TaskRun only)
-                session.commit()
+        if captured is not None and step_status == 'success':
+            with tracing.span('cache_store'):
+                result_cache.put(cache_key, filename, context_delta(context, new_context or context),
+                                 b''.join(captured), cache['ttl'])
 
-                if 'ERROR' in output:
-                    status = 'failed'
-                    break
+        step_finished = datetime.utcnow()
+        if cached is None:
+            SCRIPT_DURATION.labels(status=step_status).observe((step_finished - step_started).total_seconds())
+        db_writer.update_step(run_id, position, status=step_status, returncode=returncode,
+                              finished_at=step_finished, cached=cached is not None,
+                              duration=(step_finished - step_started).total_seconds(), **usage)
+        # 脚本通过 SDK 回写的增量已合并进 new_context
+        return dict(new_context or context), step_status, usage
 
-            run.status = status
-            run.finished_at = datetime.utcnow()
-            run.final_context = context
-            session.commit()
-        finally:
-            try:
-                if manager is not None:
-                    manager.shutdown()
-            except Exception:
-                pass
-            # no global stop_event to set; per-script consumers are stopped after each script
-            try:
-                # optional: keep stream logs in active_runs for a short while
-                pass
-            except Exception:
-                pass
-            session.close()
+    def _execute_script(self, script_path, context, log_sink=None, usage=None, profile=None, procs=None):
+        """执行单个脚本，环境变量隔离。
 
-    def _execute_script(self, script_path, context, context_proxy=None, log_queue=None):
-        """执行单个脚本，环境变量隔离"""
+        返回 (output, 合并了脚本回写后的新上下文, 状态, returncode)，
+        状态为 success / failed / timeout，以退出码判断而不是扫描输出内容。
+        usage 不为 None 时填入脚本的峰值 RSS、CPU 时间与磁盘读写字节数。
+        profile 为 {'mode', 'prefix'} 时在剖析器下执行，结果写到 prefix 对应的文件（超时被终止的脚本没有结果）。
+        procs 为运行的 ProcessGroups，执行期间登记脚本进程组，供 abort_run 终止。
+        """
         # 完整隔离环境变量：创建干净的环境，只注入需要的变量
         env = os.environ.copy()
-        # 清除可能的污染，注入当前任务的上下文（同时支持 proxy）
-        if context_proxy is not None:
-            try:
-                for k, v in dict(context_proxy).items():
-                    env[str(k)] = str(v)
-            except Exception:
-                for k, v in context.items():
-                    env[str(k)] = str(v)
-        else:
-            for k, v in context.items():
-                env[str(k)] = str(v)
+        # 清除可能的污染，注入当前任务的上下文
+        for k, v in context.items():
+            env[str(k)] = str(v)
+        # run_script 会把子进程回写的增量原地合并进该拷贝
+        script_context = dict(context)
 
         try:
             output, returncode, timed_out = run_script(
@@ -253,18 +825,21 @@ class TaskService:
                 env=env,
                 cwd=self.tasks_dir,
                 timeout=self.task_timeout,
-                context_proxy=context_proxy,
-                log_queue=log_queue,
+                context=script_context,
+                log_sink=log_sink,
+                usage=usage,
+                profile=profile,
+                procs=procs,
             )
 
             if timed_out:
-                return f"ERROR: 脚本执行超时 ({self.task_timeout}s)", context
+                return f"ERROR: 脚本执行超时 ({self.task_timeout}s)", script_context, 'timeout', returncode
 
             # 改进的 JSON 解析：支持多行和嵌套
-            new_context = self._parse_context_from_output(output, context)
-            return output, new_context
+            new_context = self._parse_context_from_output(output, script_context)
+            return output, new_context, 'success' if returncode == 0 else 'failed', returncode
         except Exception as e:
-            return f"ERROR: {str(e)}", context
+            return f"ERROR: {str(e)}", context, 'failed', None
 
     def _parse_context_from_output(self, output, context):
         """改进的上下文解析，支持多行JSON"""
@@ -288,46 +863,308 @@ class TaskService:
             pass
         return context
 
-    def get_task_runs(self, task_id):
-        """获取任务的所有运行记录"""
+    # 运行记录列表默认不返回的大字段，需通过 fields 显式请求
+    RUN_OPTIONAL_FIELDS = ('initial_context', 'final_context') + proc_limits.USAGE_FIELDS
+
+    def get_task_runs(self, task_id, after_id=None, limit=None, fields=None):
+        """获取任务的运行记录（按 id 倒序，键集分页）。
+
+        排队的运行开始执行时会改写 started_at，因此按不变的主键分页，翻页期间不会重复或漏掉记录。
+        after_id 为上一页最后一条的 run_id；fields 为需要额外返回的字段
+        （initial_context / final_context），默认只查询列表所需的列。
+        """
+        extra = [f for f in self.RUN_OPTIONAL_FIELDS if f in (fields or ())]
+        columns = [TaskRun.id, TaskRun.status, TaskRun.started_at, TaskRun.finished_at]
+        columns += [getattr(TaskRun, f) for f in extra]
         session = SessionLocal()
         try:
-            runs = session.query(TaskRun).filter(TaskRun.task_id == task_id).order_by(TaskRun.started_at.desc()).all()
-            return runs
+            query = session.query(*columns).filter(TaskRun.task_id == task_id)
+            if after_id is not None:
+                query = query.filter(TaskRun.id < after_id)
+            rows = query.order_by(TaskRun.id.desc()).limit(self._page_limit(limit)).all()
+            result = []
+            for row in rows:
+                item = {
+                    'run_id': row.id,
+                    'status': row.status,
+                    'started_at': row.started_at,
+                    'finished_at': row.finished_at
+                }
+                for f in extra:
+                    item[f] = getattr(row, f)
+                result.append(item)
+            return result
         finally:
             session.close()
 
-    def get_run_logs(self, run_id):
-        """获取运行的脚本日志"""
+    def get_run_logs(self, run_id, script=None, offset=0, limit=None, tail=None):
+        """获取运行的脚本日志，每个脚本只读取一页（默认最多 LOG_READ_MAX_BYTES 字节）。
+
+        offset 为负数时表示从末尾往前的字节数；tail 指定时返回每个脚本的最后 N 行。
+        返回项中的 next_offset / size / eof 可用于继续分页。
+        运行目录中仍有日志文件（执行中或 files 存储）时读文件，否则只解压数据库中请求范围内的日志块，
+        运行目录已打包进归档时从归档分片中读取。
+        """
         run_dir = os.path.join(Config.LOGS_DIR, f"run_{run_id}")
+        limit = min(limit or Config.LOG_READ_MAX_BYTES, Config.LOG_READ_MAX_BYTES)
         result = []
         try:
-            if not os.path.exists(run_dir):
-                return []
-            for fname in sorted(os.listdir(run_dir)):
-                if fname.endswith('.log'):
-                    path = os.path.join(run_dir, fname)
-                    try:
-                        with open(path, 'r', encoding='utf-8') as f:
-                            content = f.read()
-                        result.append({
-                            'script': fname.replace('.log', ''),
-                            'output': content,
-                            'created_at': datetime.fromtimestamp(os.path.getctime(path)).isoformat()
-                        })
-                    except Exception:
-                        continue
+            on_disk = set(list_script_logs(run_dir))
+            stored = {} if script is not None and script in on_disk else run_storage.list_logs(run_id)
+            archived = {} if on_disk or stored else log_archive.list_logs(run_id)
+            for name in sorted(on_disk | set(stored) | set(archived)):
+                if script is not None and name != script:
+                    continue
+                try:
+                    if name in on_disk:
+                        path = os.path.join(run_dir, f"{name}.log")
+                        if tail:
+                            content, start, size = tail_lines(path, tail)
+                            page = {'content': content, 'offset': start, 'next_offset': size, 'size': size, 'eof': True}
+                        else:
+                            page = read_range(path, offset or 0, limit)
+                        created_at = datetime.fromtimestamp(os.path.getctime(path)).isoformat()
+                    elif name in archived:
+                        if tail:
+                            content, start, size = log_archive.tail_log(run_id, name, tail)
+                            page = {'content': content, 'offset': start, 'next_offset': size, 'size': size, 'eof': True}
+                        else:
+                            page = log_archive.read_log_range(run_id, name, offset or 0, limit)
+                        created_at = archived[name][1].isoformat()
+                    else:
+                        size, created = stored[name]
+                        if tail:
+                            content, start, size = run_storage.tail_log(run_id, name, tail)
+                            page = {'content': content, 'offset': start, 'next_offset': size, 'size': size, 'eof': True}
+                        else:
+                            page = run_storage.read_log_range(run_id, name, size, offset or 0, limit)
+                        created_at = created.isoformat() if created else None
+                    result.append({
+                        'script': name,
+                        'output': page['content'],
+                        'offset': page['offset'],
+                        'next_offset': page['next_offset'],
+                        'size': page['size'],
+                        'eof': page['eof'],
+                        'created_at': created_at
+                    })
+                except Exception:
+                    continue
         except Exception:
             return []
         return result
 
-    def get_run_contexts(self, run_id):
-        """获取运行的环境变量历史"""
+    def stream_run_logs(self, run_id, cursors=None, script=None, heartbeat=None):
+        """按字节偏移跟随运行日志。
+
+        cursors 为 {script: offset}（未出现的脚本从 0 开始），script 可限定只跟随一个脚本。
+        产出 {'event': 'log', 'script', 'offset', 'next_offset', 'text', 'cursor'}；
+        空闲超过 heartbeat 秒时产出 None 作为心跳；运行结束后产出 {'event': 'end'} 并返回。
+        """
         run_dir = os.path.join(Config.LOGS_DIR, f"run_{run_id}")
+        heartbeat = heartbeat or Config.LOG_STREAM_HEARTBEAT
+        cursors = dict(cursors or {})
+        if script is not None:
+            script = safe_script_name(script)
+            if script is None:
+                return
+        cursors = {k: v for k, v in cursors.items() if safe_script_name(k) and (script is None or k == script)}
+        archived = {} if os.path.isdir(run_dir) else log_archive.list_logs(run_id)
+
+        def _event(name, offset, data):
+            cursors[name] = offset + len(data)
+            return {
+                'event': 'log',
+                'script': name,
+                'offset': offset,
+                'next_offset': cursors[name],
+                'text': data.decode('utf-8', errors='replace'),
+                'cursor': ','.join(f"{k}@{v}" for k, v in sorted(cursors.items())),
+            }
+
+        def _from_disk(name, end=None):
+            # 运行目录已删除（日志已转存数据库）时从日志块补读，偏移量一致
+            path = os.path.join(run_dir, f"{name}.log")
+            if os.path.exists(path):
+                chunks = read_file_range(path, cursors.get(name, 0), end)
+            elif name in archived:
+                chunks = log_archive.iter_log_range(run_id, name, cursors.get(name, 0), end)
+            else:
+                chunks = run_storage.iter_log_range(run_id, name, cursors.get(name, 0), end)
+            for offset, data in chunks:
+                yield _event(name, offset, data)
+
+        def _names(extra=()):
+            if script is not None:
+                return [script]
+            names = set(list_script_logs(run_dir)) | set(cursors) | set(extra)
+            if not os.path.isdir(run_dir):
+                names |= set(run_storage.list_logs(run_id)) | set(archived)
+            return sorted(names)
+
+        stream = log_hub.get_stream(run_id)
+        if stream is None:
+            # 运行已结束，或在其他节点（runner agent）上执行：按偏移读取磁盘文件 / 数据库日志块，
+            # 执行中时轮询数据库中新上报的日志块直到运行结束
+            idle = 0.0
+            while True:
+                status = self._get_run_status(run_id)
+                sent = False
+                for name in _names():
+                    for event in _from_disk(name):
+                        sent = True
+                        yield event
+                if status not in run_queue.ACTIVE_STATUSES:
+                    yield {'event': 'end', 'status': status}
+                    return
+                idle = 0.0 if sent else idle + Config.RUNNER_POLL_INTERVAL
+                if idle >= heartbeat:
+                    idle = 0.0
+                    yield None
+                time.sleep(Config.RUNNER_POLL_INTERVAL)
+
+        seq = 0
+        while True:
+            chunks, seq_now, floors, closed = stream.snapshot(seq)
+            for name in _names(floors):
+                floor = floors.get(name)
+                if floor is None:
+                    # 尚未在本次运行中产生日志的脚本：磁盘上已有内容（如重复执行的脚本）直接补读
+                    yield from _from_disk(name)
+                elif cursors.get(name, 0) < floor:
+                    # 已滑出环形缓冲的部分从磁盘补读
+                    yield from _from_disk(name, floor)
+            for _, name, offset, data in chunks:
+                if script is not None and name != script:
+                    continue
+                cur = cursors.get(name, 0)
+                if offset + len(data) <= cur:
+                    continue
+                if offset < cur:
+                    data, offset = data[cur - offset:], cur
+                elif offset > cur:
+                    yield from _from_disk(name, offset)
+                yield _event(name, offset, data)
+            seq = seq_now
+            if closed:
+                yield {'event': 'end', 'status': stream.status}
+                return
+            if not stream.wait(seq, heartbeat):
+                yield None
+
+    def _get_run_status(self, run_id):
+        # 本进程内的运行以内存状态为准，数据库中的状态由 db_writer 异步写入，可能稍有滞后
+        with self.lock:
+            active = self.active_runs.get(run_id)
+            if active is not None:
+                return active.get('status')
+        session = SessionLocal()
+        try:
+            run = session.query(TaskRun).filter(TaskRun.id == run_id).first()
+            return run.status if run else None
+        finally:
+            session.close()
+
+    def get_run_steps(self, run_id):
+        """获取运行中每个脚本的状态与耗时"""
+        session = SessionLocal()
+        try:
+            steps = session.query(TaskRunStep).filter(TaskRunStep.run_id == run_id) \
+                .order_by(TaskRunStep.position).all()
+            return [{
+                'position': st.position,
+                'script': st.script_filename,
+                'status': st.status,
+                'returncode': st.returncode,
+                'cached': bool(st.cached),
+                **{f: getattr(st, f) for f in proc_limits.USAGE_FIELDS},
+                'started_at': st.started_at,
+                'finished_at': st.finished_at,
+                'duration': st.duration
+            } for st in steps]
+        finally:
+            session.close()
+
+    def get_run_contexts(self, run_id, materialize=True, position=None):
+        """获取运行的环境变量历史。
+
+        历史依次取自数据库、运行目录或其归档中的 contexts.jsonl；更早的运行回退读取每个脚本的
+        .context.json 完整快照。materialize 为 True 时每项的 context 为该脚本执行后的完整上下文，
+        否则只返回增量 delta（以运行的 initial_context 为起点按顺序应用，带 context 的项为新的起点）。
+        position 指定时只还原并返回该脚本的一项。
+        """
+        entries = run_storage.context_entries(run_id)
+        if not entries:
+            run_dir = os.path.join(Config.LOGS_DIR, f"run_{run_id}")
+            entries = context_history.read_file(run_dir) if os.path.isdir(run_dir) \
+                else log_archive.read_context_entries(run_id)
+            if entries is None:
+                return self._legacy_run_contexts(run_id, run_dir)
+        if materialize or position is not None:
+            result = []
+            for entry, snapshot in context_history.materialize(run_storage.initial_context(run_id), entries):
+                if position is None or entry.get('position') == position:
+                    result.append({'script': entry.get('script'), 'position': entry.get('position'),
+                                   'context': snapshot, 'created_at': entry.get('created_at')})
+                    if position is not None:
+                        break
+            result.sort(key=lambda item: item['position'] if item['position'] is not None else -1)
+            return result
+        return [{k: v for k, v in entry.items() if k != 'id'} for entry in entries]
+
+    def get_run_profiles(self, run_id):
+        """运行中有剖析结果的脚本：[{'script', 'mode', 'created_at'}]，取自运行目录、数据库与归档"""
+        found = dict(log_archive.list_profiles(run_id))
+        found.update(run_storage.list_profiles(run_id))
+        run_dir = os.path.join(Config.LOGS_DIR, f"run_{run_id}")
+        try:
+            names = os.listdir(run_dir)
+        except OSError:
+            names = []
+        for script, mode in profiling.scripts_with_profiles(names).items():
+            path = os.path.join(run_dir, script + profiling.COLLAPSED_SUFFIX)
+            try:
+                found[script] = (mode, datetime.fromtimestamp(os.path.getmtime(path)))
+            except OSError:
+                continue
+        return [{'script': script, 'mode': mode, 'created_at': created_at}
+                for script, (mode, created_at) in sorted(found.items())]
+
+    def _load_profile(self, run_id, script):
+        """脚本的剖析结果 (mode, pstats 字节, 折叠调用栈字节)，依次取自运行目录、数据库与归档，没有时返回 None"""
+        run_dir = os.path.join(Config.LOGS_DIR, f"run_{run_id}")
+        return run_storage.read_profile_files(os.path.join(run_dir, script)) \
+            or run_storage.load_profile(run_id, script) \
+            or log_archive.read_profile(run_id, script)
+
+    def get_profile_top(self, run_id, script, limit=None, sort='self'):
+        """脚本最耗时的 N 个函数，sort 为 self（自身耗时）或 total（含子调用），没有剖析结果时返回 None"""
+        found = self._load_profile(run_id, script)
+        if found is None:
+            return None
+        mode, pstats_data, collapsed = found
+        functions, total = profiling.top_functions(pstats_data, collapsed.decode('utf-8', errors='replace'),
+                                                   limit or Config.PROFILE_TOP_N, sort)
+        return {'script': script, 'mode': mode, 'sort': sort, 'total_seconds': total, 'functions': functions}
+
+    def get_profile_file(self, run_id, script, fmt):
+        """下载用的剖析结果原始内容，fmt 为 pstats / collapsed；没有对应结果时返回 None"""
+        found = self._load_profile(run_id, script)
+        if found is None:
+            return None
+        _, pstats_data, collapsed = found
+        return pstats_data if fmt == 'pstats' else collapsed
+
+    def get_run_trace(self, run_id):
+        """运行的追踪时间线与各阶段耗时汇总（见 trace_store.timeline），没有记录时返回 None"""
+        return trace_store.timeline(trace_store.load(run_id))
+
+    def _legacy_run_contexts(self, run_id, run_dir):
+        """旧版本每个脚本一个 .context.json 完整快照"""
         result = []
         try:
             if not os.path.exists(run_dir):
-                return []
+                return log_archive.list_contexts(run_id)
             for fname in sorted(os.listdir(run_dir)):
                 if fname.endswith('.context.json'):
                     path = os.path.join(run_dir, fname)
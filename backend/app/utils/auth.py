@@ -1,7 +1,61 @@
 import time
+import hashlib
+import threading
+from collections import OrderedDict
 from typing import Optional
 import jwt
-from flask import current_app
+from flask import current_app, g
+from sqlalchemy import event, inspect
+from app.core.config import Config
+from app.models.db import SessionLocal
+from app.models.task_models import User
+from app.utils import metrics
+
+TOKEN_CACHE = metrics.counter('auth_token_cache_total', 'token 校验缓存查询次数', labels=('outcome',))
+USER_CACHE = metrics.counter('auth_user_cache_total', '用户信息缓存查询次数', labels=('outcome',))
+
+
+class _TTLCache:
+    """有界 LRU 缓存，每个条目有各自的过期时间（time.time() 秒）"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[0] <= time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value, expires_at):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# 已验证的 token：键为 token 的哈希（不在内存中保留 token 原文），到 token 的 exp 过期
+_token_cache = _TTLCache(Config.AUTH_TOKEN_CACHE_SIZE)
+# 用户名 -> 用户信息；本进程修改 User 时立即失效，其他进程的修改在 AUTH_USER_CACHE_TTL 内生效
+_user_cache = _TTLCache(Config.AUTH_TOKEN_CACHE_SIZE)
 
 
 def generate_token(username: str, expire_seconds: int = 3600 * 24) -> str:
@@ -20,14 +74,32 @@ def generate_token(username: str, expire_seconds: int = 3600 * 24) -> str:
     return token
 
 
+def _token_key(secret, token):
+    return hashlib.sha256(f"{secret}\0{token}".encode('utf-8')).hexdigest()
+
+
 def verify_token(token: str) -> Optional[dict]:
-    """验证 token，成功返回 payload（dict），失败返回 None。"""
+    """验证 token，成功返回 payload（dict），失败返回 None。
+
+    验证通过的 token 按哈希缓存到其 exp，缓存命中时不再做签名校验；失败的结果不缓存。
+    """
+    if not token:
+        return None
     secret = current_app.config.get('SECRET_KEY')
+    key = _token_key(secret, token)
+    payload = _token_cache.get(key)
+    if payload is not None:
+        TOKEN_CACHE.labels(outcome='hit').inc()
+        return dict(payload)
+    TOKEN_CACHE.labels(outcome='miss').inc()
     try:
         payload = jwt.decode(token, secret, algorithms=['HS256'])
-        return payload
     except Exception:
         return None
+    exp = payload.get('exp')
+    if isinstance(exp, (int, float)):
+        _token_cache.set(key, dict(payload), exp)
+    return payload
 
 
 def get_username_from_token(token: str) -> Optional[str]:
@@ -35,3 +107,63 @@ def get_username_from_token(token: str) -> Optional[str]:
     if not payload:
         return None
     return payload.get('sub')
+
+
+def current_username() -> Optional[str]:
+    """全局鉴权在 flask.g 上记录的当前用户名，未经鉴权的请求返回 None"""
+    payload = g.get('token_payload')
+    return payload.get('sub') if payload else None
+
+
+def get_user(username: str) -> Optional[dict]:
+    """按用户名获取 {'id', 'username', 'roles'}，带缓存；用户不存在返回 None。
+
+    缓存中 roles 存为元组，每次返回新的 dict 与 roles 列表，调用方修改返回值不会影响缓存。
+    """
+    if not username:
+        return None
+    user = _user_cache.get(username)
+    if user is not None:
+        USER_CACHE.labels(outcome='hit').inc()
+        return dict(user, roles=list(user['roles']))
+    USER_CACHE.labels(outcome='miss').inc()
+    session = SessionLocal()
+    try:
+        row = session.query(User).filter_by(username=username).first()
+        if row is None:
+            return None
+        user = {
+            'id': row.id,
+            'username': row.username,
+            'roles': row.roles.split(',') if row.roles else ['user'],
+        }
+    finally:
+        session.close()
+    _user_cache.set(username, dict(user, roles=tuple(user['roles'])), time.time() + Config.AUTH_USER_CACHE_TTL)
+    return user
+
+
+def invalidate_user(username: Optional[str] = None):
+    """清除用户信息缓存；username 为空时全部清除"""
+    if username is None:
+        _user_cache.clear()
+    else:
+        _user_cache.pop(username)
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _user_changed(mapper, connection, target):
+    # 用户名本身被修改时旧用户名也要失效
+    for name in inspect(target).attrs.username.history.deleted or ():
+        invalidate_user(name)
+    invalidate_user(target.username)
+
+
+@event.listens_for(SessionLocal, 'after_bulk_update')
+@event.listens_for(SessionLocal, 'after_bulk_delete')
+def _users_bulk_changed(update_context):
+    # query(User).update() / delete() 不触发对象级事件，无法得知影响了哪些用户，整体清除
+    if update_context.mapper.class_ is User:
+        invalidate_user()
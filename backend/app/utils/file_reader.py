@@ -0,0 +1,121 @@
+"""按偏移/尾部读取大文件的工具函数，内存占用与文件大小无关。"""
+import os
+import threading
+
+# 单次从磁盘读取的块大小
+READ_CHUNK = 64 * 1024
+
+
+def tail_lines(path, lines=100, block_size=READ_CHUNK):
+    """从文件末尾反向按块读取，返回 (最后 N 行文本, 起始字节偏移, 文件大小)"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if lines <= 0 or size == 0:
+            return '', size, size
+        pos = size
+        data = b''
+        # 多找一个换行以定位第 N 行的行首（末尾换行不计为一行）
+        while pos > 0 and data.count(b'\n') <= lines:
+            step = min(block_size, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+        parts = data.split(b'\n')
+        trailing = data.endswith(b'\n')
+        keep = parts[-(lines + 1):] if trailing else parts[-lines:]
+        text = b'\n'.join(keep)
+        start = size - len(text)
+        return text.decode('utf-8', errors='replace'), start, size
+
+
+# 只追加的文件（app.log）的行数缓存：path -> (inode, 已统计的字节数, 行数, 末尾是否为换行)
+_line_counts = {}
+_line_counts_lock = threading.Lock()
+
+
+def count_lines(path, block_size=READ_CHUNK):
+    """文件行数（与 readlines() 的结果一致），按块统计换行不加载整个文件。
+
+    同一文件只增长时只统计新增的部分；被轮转（inode 变化）或截断后重新统计。
+    """
+    st = os.stat(path)
+    with _line_counts_lock:
+        cached = _line_counts.get(path)
+    ino, done, count, ends_nl = cached if cached and cached[0] == st.st_ino and cached[1] <= st.st_size \
+        else (st.st_ino, 0, 0, True)
+    with open(path, 'rb') as f:
+        f.seek(done)
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            count += data.count(b'\n')
+            done += len(data)
+            ends_nl = data.endswith(b'\n')
+    with _line_counts_lock:
+        _line_counts[path] = (ino, done, count, ends_nl)
+    # 最后一行没有换行时同样计为一行
+    return count + (0 if ends_nl else 1)
+
+
+def read_range(path, offset=0, limit=READ_CHUNK * 16):
+    """读取 [offset, offset+limit) 字节；offset 为负数时表示从末尾往前的字节数。
+
+    未读到文件末尾时在最后一个换行处截断，保证下一页从行首开始。
+    返回 dict：content / offset / next_offset / size / eof。
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if offset < 0:
+            offset = max(0, size + offset)
+        offset = min(offset, size)
+        f.seek(offset)
+        data = f.read(max(0, limit))
+    end = offset + len(data)
+    if end < size:
+        cut = data.rfind(b'\n') + 1
+        if cut > 0:
+            data = data[:cut]
+            end = offset + cut
+    return {
+        'content': data.decode('utf-8', errors='replace'),
+        'offset': offset,
+        'next_offset': end,
+        'size': size,
+        'eof': end >= size,
+    }
+
+
+def read_file_range(path, start, end=None, chunk_size=READ_CHUNK):
+    """按字节偏移从磁盘读取 [start, end)，逐块产出 (offset, data)，块尽量在换行处切分"""
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        return
+    with f:
+        yield from iter_chunks(f, start, end, chunk_size)
+
+
+def iter_chunks(f, start, end=None, chunk_size=READ_CHUNK):
+    """read_file_range 的文件对象版本（如 zip 成员），只向前 seek"""
+    f.seek(start)
+    offset = start
+    pending = b''
+    while end is None or offset + len(pending) < end:
+        size = chunk_size if end is None else min(chunk_size, end - offset - len(pending))
+        data = f.read(size)
+        if not data:
+            break
+        pending += data
+        cut = pending.rfind(b'\n') + 1
+        if cut == 0:
+            if len(pending) < chunk_size:
+                continue
+            cut = len(pending)
+        yield offset, pending[:cut]
+        offset += cut
+        pending = pending[cut:]
+    if pending:
+        yield offset, pending
@@ -0,0 +1,130 @@
+"""脚本日志写入器：每个脚本一个带缓冲的文件写入器，按批写入、定期 fsync，内存中只保留有限的尾部行。"""
+import os
+import time
+import threading
+from collections import deque
+from app.core.config import Config
+from app.utils import metrics
+
+LOG_LINES = metrics.counter('log_lines_total', '写入磁盘的脚本日志行数')
+LOG_BATCHES = metrics.counter('log_batches_total', '收到的脚本日志批次数')
+LOG_LAG = metrics.histogram('log_queue_lag_seconds', '日志从脚本产生到写入文件的延迟')
+LOG_RATE = metrics.gauge('log_lines_per_second', '最近窗口内的日志写入速率')
+
+
+class _RateMeter:
+    """按秒分桶的滑动窗口速率"""
+
+    def __init__(self, window=10):
+        self.window = window
+        self.buckets = deque()  # [(second, count)]
+        self.lock = threading.Lock()
+
+    def add(self, n, now=None):
+        sec = int(now or time.time())
+        with self.lock:
+            if self.buckets and self.buckets[-1][0] == sec:
+                self.buckets[-1][1] += n
+            else:
+                self.buckets.append([sec, n])
+            self._trim(sec)
+            return self._rate(sec)
+
+    def _trim(self, sec):
+        while self.buckets and self.buckets[0][0] <= sec - self.window:
+            self.buckets.popleft()
+
+    def _rate(self, sec):
+        return sum(c for _, c in self.buckets) / float(self.window)
+
+    def rate(self):
+        sec = int(time.time())
+        with self.lock:
+            self._trim(sec)
+            return self._rate(sec)
+
+
+_rate_meter = _RateMeter()
+
+
+def current_rate():
+    """最近窗口内的全局日志行速率（行/秒）"""
+    rate = _rate_meter.rate()
+    LOG_RATE.set(rate)
+    return rate
+
+
+metrics.register_collector(current_rate)
+
+
+def format_line(level, message):
+    return f"[{level}] {message}\n"
+
+
+class ScriptLogWriter:
+    """单个脚本的日志写入器，作为 run_script 的 log_sink 使用"""
+
+    def __init__(self, path, tail=None, fsync_interval=None, tail_lines=None, on_write=None):
+        self.path = path
+        # on_write(offset, data)：每批写入后回调，供实时日志流按字节偏移扇出
+        self.on_write = on_write
+        self.fsync_interval = Config.LOG_FSYNC_INTERVAL if fsync_interval is None else fsync_interval
+        # 内存中只保留最近 N 行，供活跃运行快速查看
+        self.tail = tail if tail is not None else deque(maxlen=tail_lines or Config.LOG_TAIL_LINES)
+        self.lines = 0
+        self._file = open(path, 'ab', buffering=64 * 1024)
+        self.offset = self._file.tell()
+        self._last_sync = time.monotonic()
+
+    def __call__(self, batch):
+        self.write_batch(batch.get('lines') or [], batch.get('first_at'))
+
+    def write_batch(self, lines, first_at=None):
+        if not lines:
+            return
+        text = [format_line(level, msg) for level, msg in lines]
+        self._write(''.join(text).encode('utf-8'), text, first_at)
+
+    def write_bytes(self, data):
+        """写入已格式化的日志字节（如结果缓存中保存的日志），按行更新尾部缓冲"""
+        if not data:
+            return
+        text = data.decode('utf-8', errors='replace').splitlines(keepends=True)
+        self._write(data, text)
+
+    def _write(self, data, text, first_at=None):
+        self._file.write(data)
+        self.tail.extend(text)
+        self.lines += len(text)
+        if self.on_write is not None:
+            try:
+                self.on_write(self.offset, data)
+            except Exception:
+                pass
+        self.offset += len(data)
+
+        now = time.monotonic()
+        if now - self._last_sync >= self.fsync_interval:
+            self._sync()
+            self._last_sync = now
+
+        LOG_LINES.inc(len(text))
+        LOG_BATCHES.inc()
+        LOG_RATE.set(_rate_meter.add(len(text)))
+        if first_at:
+            LOG_LAG.observe(max(0.0, time.time() - first_at))
+
+    def _sync(self):
+        self._file.flush()
+        try:
+            os.fsync(self._file.fileno())
+        except OSError:
+            pass
+
+    def close(self):
+        if self._file.closed:
+            return
+        try:
+            self._sync()
+        finally:
+            self._file.close()
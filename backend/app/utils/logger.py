@@ -1,38 +1,95 @@
 import logging
+import logging.handlers
 import os
+import threading
 from app.core.config import Config
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_file_handler = None
+_file_handler_lock = threading.Lock()
+
+
+class AppLogHandler(logging.handlers.RotatingFileHandler):
+    """按大小轮转的 app.log，可由多个进程（gunicorn worker、runner）同时写入。
+
+    是否轮转按文件的实际大小判断；其他进程完成轮转后（路径指向新文件）重新打开，
+    轮转本身在文件锁内进行，避免多个进程同时改名。
+    """
+
+    def __init__(self, filename, max_bytes, backup_count):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True)
+
+    def _reopen_if_rotated(self):
+        if self.stream is not None:
+            try:
+                rotated = os.stat(self.baseFilename).st_ino != os.fstat(self.stream.fileno()).st_ino
+            except OSError:
+                rotated = True
+            if rotated:
+                self.stream.close()
+                self.stream = None
+        if self.stream is None:
+            self.stream = self._open()
+
+    def shouldRollover(self, record):
+        self._reopen_if_rotated()
+        if self.maxBytes <= 0:
+            return False
+        try:
+            return os.fstat(self.stream.fileno()).st_size >= self.maxBytes
+        except OSError:
+            return False
+
+    def doRollover(self):
+        if fcntl is None:
+            return super().doRollover()
+        with open(self.baseFilename + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # 拿到锁时其他进程可能刚完成轮转，重新确认一次
+            self._reopen_if_rotated()
+            if os.fstat(self.stream.fileno()).st_size >= self.maxBytes:
+                super().doRollover()
+
+
+def _get_file_handler():
+    """进程内所有记录器共用一个 app.log 处理器（各自持有处理器时无法正确轮转）"""
+    global _file_handler
+    with _file_handler_lock:
+        if _file_handler is None:
+            log_dir = Config.LOGS_DIR
+            # 确保日志目录存在
+            try:
+                os.makedirs(log_dir, exist_ok=True)
+            except (PermissionError, OSError):
+                # 如果无法创建目标目录，使用相对路径
+                log_dir = './logs'
+                os.makedirs(log_dir, exist_ok=True)
+
+            log_file = os.path.join(log_dir, 'app.log')
+            _file_handler = AppLogHandler(log_file, Config.APP_LOG_MAX_MB * 1024 * 1024, Config.APP_LOG_BACKUP_COUNT)
+            _file_handler.setLevel(getattr(logging, Config.LOG_LEVEL))
+            _file_handler.setFormatter(logging.Formatter(Config.LOG_FORMAT))
+        return _file_handler
+
+
 def setup_logger(name):
     """配置日志记录器"""
     logger = logging.getLogger(name)
-    
+
     if not logger.handlers:
         logger.setLevel(getattr(logging, Config.LOG_LEVEL))
-        
+
         # 控制台处理器
         console_handler = logging.StreamHandler()
         console_handler.setLevel(getattr(logging, Config.LOG_LEVEL))
-        
-        # 文件处理器
-        log_dir = Config.LOGS_DIR
-        # 确保日志目录存在
-        try:
-            os.makedirs(log_dir, exist_ok=True)
-        except (PermissionError, OSError):
-            # 如果无法创建目标目录，使用相对路径
-            log_dir = './logs'
-            os.makedirs(log_dir, exist_ok=True)
-        
-        log_file = os.path.join(log_dir, 'app.log')
-        file_handler = logging.FileHandler(log_file, encoding='utf-8')
-        file_handler.setLevel(getattr(logging, Config.LOG_LEVEL))
-        
-        # 格式化器
-        formatter = logging.Formatter(Config.LOG_FORMAT)
-        console_handler.setFormatter(formatter)
-        file_handler.setFormatter(formatter)
-        
+        console_handler.setFormatter(logging.Formatter(Config.LOG_FORMAT))
+
         logger.addHandler(console_handler)
-        logger.addHandler(file_handler)
-    
+        # 文件处理器
+        logger.addHandler(_get_file_handler())
+
     return logger
@@ -0,0 +1,338 @@
+"""进程内指标注册表：计数器 / 仪表 / 直方图，线程安全，无外部依赖。
+
+使用方式::
+    from app.utils import metrics
+    SPAWN = metrics.histogram('script_spawn_seconds', '脚本派发延迟', labels=('mode',))
+    SPAWN.labels(mode='fork').observe(0.012)
+    metrics.snapshot()          # JSON 友好的结构
+    metrics.render_text()       # Prometheus 文本格式
+
+需要主动采样的仪表（系统资源、队列深度）通过 register_collector 注册采样函数，
+由后台线程按固定间隔调用，读取指标时不做任何阻塞采样。
+没有 Web 接口的进程（runner agent）用 serve() 在独立端口上输出 /metrics。
+"""
+import json
+import bisect
+import math
+import time
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help_text='', labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, **kwargs):
+        key = tuple(str(kwargs.get(n, '')) for n in self.label_names)
+        with self._lock:
+            child = self._children.get(key)
+            if child is None:
+                child = self._new_child()
+                self._children[key] = child
+            return child
+
+    def _default(self):
+        return self.labels()
+
+    def samples(self):
+        """返回 [(labels_dict, child)]"""
+        with self._lock:
+            items = list(self._children.items())
+        return [(dict(zip(self.label_names, key)), child) for key, child in items]
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def get(self):
+        return self.value
+
+
+class _GaugeChild(_CounterChild):
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最后一个为 +Inf
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[idx] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q):
+        """基于分桶的分位数估计（桶内线性插值）"""
+        with self._lock:
+            counts = list(self.counts)
+            total = self.count
+        if total == 0:
+            return None
+        rank = q * total
+        seen = 0
+        lower = 0.0
+        for i, c in enumerate(counts):
+            upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+            if seen + c >= rank and c > 0:
+                return lower + (upper - lower) * ((rank - seen) / c)
+            seen += c
+            lower = upper
+        return self.buckets[-1]
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'avg': round(self.sum / self.count, 6) if self.count else None,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+        }
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._default().set(value)
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def dec(self, amount=1):
+        self._default().dec(amount)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text='', labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _get_or_create(cls, name, *args, **kwargs):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = cls(name, *args, **kwargs)
+            _registry[name] = metric
+        return metric
+
+
+def counter(name, help_text='', labels=()):
+    return _get_or_create(Counter, name, help_text, labels)
+
+
+def gauge(name, help_text='', labels=()):
+    return _get_or_create(Gauge, name, help_text, labels)
+
+
+def histogram(name, help_text='', labels=(), buckets=DEFAULT_BUCKETS):
+    return _get_or_create(Histogram, name, help_text, labels, buckets=buckets)
+
+
+def all_metrics():
+    with _registry_lock:
+        return list(_registry.values())
+
+
+def snapshot():
+    """以 JSON 友好的结构返回全部指标"""
+    result = {}
+    for metric in all_metrics():
+        series = []
+        for labels, child in metric.samples():
+            if metric.kind == 'histogram':
+                series.append({'labels': labels, **child.summary()})
+            else:
+                series.append({'labels': labels, 'value': child.get()})
+        result[metric.name] = {'type': metric.kind, 'help': metric.help, 'series': series}
+    return result
+
+
+# ---- Prometheus 文本格式 ----
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels_text(labels, extra=None):
+    pairs = list(labels.items()) + list((extra or {}).items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_text():
+    """按 Prometheus 文本格式（0.0.4）输出全部指标"""
+    lines = []
+    for metric in sorted(all_metrics(), key=lambda m: m.name):
+        samples = metric.samples()
+        help_text = metric.help.replace('\\', '\\\\').replace('\n', '\\n')
+        lines.append(f"# HELP {metric.name} {help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for labels, child in samples:
+            if metric.kind == 'histogram':
+                with child._lock:
+                    counts = list(child.counts)
+                    total, value_sum = child.count, child.sum
+                cumulative = 0
+                for bound, c in zip(list(child.buckets) + [math.inf], counts):
+                    cumulative += c
+                    lines.append(f"{metric.name}_bucket{_labels_text(labels, {'le': _number(bound)})} {cumulative}")
+                lines.append(f"{metric.name}_sum{_labels_text(labels)} {_number(value_sum)}")
+                lines.append(f"{metric.name}_count{_labels_text(labels)} {total}")
+            else:
+                lines.append(f"{metric.name}{_labels_text(labels)} {_number(child.get())}")
+    return '\n'.join(lines) + '\n'
+
+
+# ---- 后台采样 ----
+
+_collectors = []
+_collector_thread = None
+_collector_lock = threading.Lock()
+_logger = logging.getLogger(__name__)
+
+
+def register_collector(fn):
+    """注册周期采样函数 fn()，由 start_collector 启动的后台线程调用"""
+    with _collector_lock:
+        if fn not in _collectors:
+            _collectors.append(fn)
+    return fn
+
+
+def unregister_collector(fn):
+    with _collector_lock:
+        if fn in _collectors:
+            _collectors.remove(fn)
+
+
+def collect():
+    """立即执行一轮采样（单个采样函数出错不影响其他）"""
+    with _collector_lock:
+        fns = list(_collectors)
+    for fn in fns:
+        try:
+            fn()
+        except Exception as e:
+            _logger.warning(f"指标采样失败 {getattr(fn, '__qualname__', fn)}: {e}")
+
+
+def start_collector(interval):
+    """启动后台采样线程（进程内只启动一次）"""
+    global _collector_thread
+    with _collector_lock:
+        if _collector_thread is not None:
+            return _collector_thread
+
+        def _loop():
+            while True:
+                started = time.monotonic()
+                collect()
+                time.sleep(max(0.1, interval - (time.monotonic() - started)))
+
+        _collector_thread = threading.Thread(target=_loop, name='metrics-collector', daemon=True)
+        _collector_thread.start()
+        return _collector_thread
+
+
+# ---- 独立的指标端口 ----
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path != '/metrics':
+            self.send_error(404)
+            return
+        if parse_qs(url.query).get('format') == ['json']:
+            body, content_type = json.dumps(snapshot(), ensure_ascii=False).encode('utf-8'), 'application/json'
+        else:
+            body, content_type = render_text().encode('utf-8'), CONTENT_TYPE
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host, port):
+    """在后台线程中监听 host:port，GET /metrics 输出 Prometheus 文本（?format=json 为 JSON 快照）。
+
+    端口被占用等启动失败时记录警告并返回 None，不影响调用方。
+    """
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        _logger.warning(f"指标端口 {host}:{port} 监听失败: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
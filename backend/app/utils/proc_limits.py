@@ -0,0 +1,337 @@
+"""脚本进程的资源限制、进程组与资源用量统计。
+
+- rlimit：CPU 时间（RLIMIT_CPU）、地址空间（RLIMIT_AS）、打开文件数（RLIMIT_NOFILE）。只调整软限制，
+  预热进程池的工作进程在每个脚本结束后恢复原值，CPU 时间按脚本开始时已用的时间累加
+- 进程组：fork 出的脚本进程 / 预热工作进程各自是一个进程组的组长，超时或结束时整组终止，
+  脚本派生的子进程不会在 terminate() 之后残留
+- cgroup v2（可选）：SCRIPT_CGROUP_ROOT 指向委派给本服务的 cgroup 目录时，每个脚本进程 / 预热工作进程
+  放入其下独立的子 cgroup，memory.max / cpu.max / pids.max 对整个进程树生效
+- 用量：峰值 RSS、用户态 / 内核态 CPU 时间、磁盘读写字节数，由执行脚本的进程在脚本结束时自行统计
+"""
+import os
+import time
+import signal
+import threading
+import psutil
+from app.core.config import Config
+from app.utils import metrics
+from app.utils.logger import setup_logger
+
+try:
+    import resource
+except ImportError:  # Windows 没有 rlimit
+    resource = None
+
+logger = setup_logger(__name__)
+
+SCRIPT_CPU = metrics.histogram('script_cpu_seconds', '脚本消耗的 CPU 时间（用户态 + 内核态）')
+SCRIPT_PEAK_RSS = metrics.histogram('script_peak_rss_bytes', '脚本进程的峰值常驻内存',
+                                    buckets=tuple(2 ** n * 1024 * 1024 for n in range(4, 15)))
+SCRIPT_KILLED = metrics.counter('script_limit_kills_total', '因资源限制被终止的脚本数', labels=('reason',))
+
+USAGE_FIELDS = ('peak_rss', 'cpu_user', 'cpu_system', 'io_read_bytes', 'io_write_bytes')
+
+MB = 1024 * 1024
+
+
+# ---- rlimit ----
+
+def _rlimit_targets():
+    """[(资源, 软限制, 是否按已用量累加)]"""
+    if resource is None:
+        return []
+    targets = []
+    if Config.SCRIPT_CPU_LIMIT > 0:
+        targets.append((resource.RLIMIT_CPU, Config.SCRIPT_CPU_LIMIT, True))
+    if Config.SCRIPT_MEMORY_LIMIT_MB > 0 and not Config.SCRIPT_CGROUP_ROOT:
+        # 有 cgroup 时用 memory.max 限制实际内存，地址空间限制容易误伤预留大量虚拟内存的库
+        targets.append((resource.RLIMIT_AS, Config.SCRIPT_MEMORY_LIMIT_MB * MB, False))
+    if Config.SCRIPT_NOFILE_LIMIT > 0:
+        targets.append((resource.RLIMIT_NOFILE, Config.SCRIPT_NOFILE_LIMIT, False))
+    return targets
+
+
+def apply_rlimits():
+    """按配置降低当前进程的软限制，返回 restore_rlimits 所需的原值"""
+    saved = []
+    for res, value, relative in _rlimit_targets():
+        try:
+            soft, hard = resource.getrlimit(res)
+            if relative:
+                used = resource.getrusage(resource.RUSAGE_SELF)
+                value += int(used.ru_utime + used.ru_stime) + 1
+            if hard != resource.RLIM_INFINITY:
+                value = min(value, hard)
+            resource.setrlimit(res, (value, hard))
+            saved.append((res, (soft, hard)))
+        except (ValueError, OSError) as e:
+            logger.warning(f"设置资源限制失败 ({res}): {e}")
+    return saved
+
+
+def restore_rlimits(saved):
+    for res, limits in saved:
+        try:
+            resource.setrlimit(res, limits)
+        except (ValueError, OSError):
+            pass
+
+
+# ---- 进程组 ----
+
+def new_process_group(pid=0):
+    """让进程成为新进程组的组长；父子进程各调用一次，避免 fork 后的竞争"""
+    try:
+        os.setpgid(pid, pid)
+    except (AttributeError, OSError):
+        pass
+
+
+def kill_group(pgid, sig=signal.SIGKILL):
+    """向整个进程组发送信号，返回组内是否还有进程"""
+    try:
+        os.killpg(pgid, sig)
+        return True
+    except (AttributeError, ProcessLookupError, PermissionError):
+        return False
+
+
+def kill_children():
+    """终止当前进程遗留的全部子孙进程（预热工作进程在脚本之间调用），返回终止的进程数"""
+    try:
+        children = psutil.Process().children(recursive=True)
+    except psutil.Error:
+        return 0
+    for child in children:
+        try:
+            child.kill()
+        except psutil.Error:
+            pass
+    psutil.wait_procs(children, timeout=1)
+    return len(children)
+
+
+class ProcessGroups:
+    """一组正在执行脚本的进程组（如同一运行的全部脚本），kill() 后再加入的进程组立即终止"""
+
+    def __init__(self):
+        self.killed = False
+        self._pgids = set()
+        self._lock = threading.Lock()
+
+    def add(self, pgid):
+        with self._lock:
+            if not self.killed:
+                self._pgids.add(pgid)
+                return
+        kill_group(pgid, signal.SIGKILL)
+
+    def discard(self, pgid):
+        with self._lock:
+            self._pgids.discard(pgid)
+
+    def kill(self):
+        """终止组内全部进程组，返回终止的进程组数"""
+        with self._lock:
+            self.killed = True
+            pgids, self._pgids = self._pgids, set()
+        return sum(1 for pgid in pgids if kill_group(pgid, signal.SIGKILL))
+
+
+def describe_exit(exitcode, cgroup=None):
+    """子进程被信号终止时的说明；能从 rlimit / cgroup 判断原因时计入 script_limit_kills_total"""
+    if exitcode is None or exitcode >= 0:
+        return None
+    if exitcode == -getattr(signal, 'SIGXCPU', -1):
+        SCRIPT_KILLED.labels(reason='cpu').inc()
+        return f"ERROR: 脚本超出 CPU 时间限制 ({Config.SCRIPT_CPU_LIMIT}s)"
+    if exitcode == -signal.SIGKILL and (cgroup or {}).get('oom_kill'):
+        SCRIPT_KILLED.labels(reason='memory').inc()
+        return f"ERROR: 脚本超出内存限制 ({Config.SCRIPT_MEMORY_LIMIT_MB}MB)"
+    try:
+        name = signal.Signals(-exitcode).name
+    except ValueError:
+        name = str(-exitcode)
+    return f"ERROR: 脚本进程被信号 {name} 终止"
+
+
+# ---- cgroup v2 ----
+
+def cgroup_path(pid):
+    root = Config.SCRIPT_CGROUP_ROOT
+    return os.path.join(root, f"script-{pid}") if root else None
+
+
+def enter_cgroup():
+    """把当前进程放入 SCRIPT_CGROUP_ROOT 下的独立子 cgroup 并写入限制；未配置或失败时返回 None"""
+    path = cgroup_path(os.getpid())
+    if path is None:
+        return None
+    limits = {}
+    if Config.SCRIPT_MEMORY_LIMIT_MB > 0:
+        limits['memory.max'] = str(Config.SCRIPT_MEMORY_LIMIT_MB * MB)
+        limits['memory.swap.max'] = '0'
+    if Config.SCRIPT_CGROUP_CPUS > 0:
+        limits['cpu.max'] = f"{int(Config.SCRIPT_CGROUP_CPUS * 100000)} 100000"
+    if Config.SCRIPT_PIDS_LIMIT > 0:
+        limits['pids.max'] = str(Config.SCRIPT_PIDS_LIMIT)
+    try:
+        os.makedirs(path, exist_ok=True)
+        for name, value in limits.items():
+            try:
+                with open(os.path.join(path, name), 'w') as f:
+                    f.write(value)
+            except OSError as e:
+                # 对应控制器未在 cgroup.subtree_control 中启用
+                logger.warning(f"cgroup 限制 {name} 写入失败: {e}")
+        with open(os.path.join(path, 'cgroup.procs'), 'w') as f:
+            f.write(str(os.getpid()))
+        return path
+    except OSError as e:
+        logger.warning(f"无法放入 cgroup {path}: {e}")
+        return None
+
+
+def release_cgroup(pid):
+    """进程退出后终止 cgroup 中残留的进程并删除目录，返回 {'memory_peak', 'oom_kill'}"""
+    path = cgroup_path(pid)
+    if path is None or not os.path.isdir(path):
+        return {}
+    info = {}
+    try:
+        with open(os.path.join(path, 'memory.peak')) as f:
+            info['memory_peak'] = int(f.read().strip())
+    except (OSError, ValueError):
+        pass
+    try:
+        with open(os.path.join(path, 'memory.events')) as f:
+            for line in f:
+                key, _, value = line.partition(' ')
+                if key == 'oom_kill':
+                    info['oom_kill'] = int(value)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open(os.path.join(path, 'cgroup.kill'), 'w') as f:
+            f.write('1')
+    except OSError:
+        pass
+    for _ in range(20):
+        try:
+            os.rmdir(path)
+            break
+        except FileNotFoundError:
+            break
+        except OSError:
+            # cgroup.kill 异步生效，等待进程全部退出
+            time.sleep(0.05)
+    return info
+
+
+# ---- 资源用量 ----
+
+def _read_proc_io():
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return int(fields['read_bytes']), int(fields['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _read_hwm():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class UsageMeter:
+    """统计一段执行期间当前进程（含已回收的子进程）的资源用量"""
+
+    def __init__(self):
+        # 重置峰值 RSS（Linux 4.0+），预热工作进程中只统计本次脚本
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:
+            pass
+        self.start = self._sample()
+
+    def _sample(self):
+        if resource is None:
+            return None
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return {
+            'cpu_user': own.ru_utime + children.ru_utime,
+            'cpu_system': own.ru_stime + children.ru_stime,
+            'children_maxrss': children.ru_maxrss,
+            'maxrss': own.ru_maxrss,
+            'io': _read_proc_io(),
+        }
+
+    def finish(self):
+        end = self._sample()
+        if end is None or self.start is None:
+            return {}
+        # ru_maxrss 在 Linux 上是 KB，macOS 上是字节
+        scale = 1 if os.uname().sysname == 'Darwin' else 1024
+        peak = _read_hwm() or end['maxrss'] * scale
+        cpu_user = end['cpu_user'] - self.start['cpu_user']
+        cpu_system = end['cpu_system'] - self.start['cpu_system']
+        if end['children_maxrss'] > self.start['children_maxrss']:
+            peak = max(peak, end['children_maxrss'] * scale)
+        usage = {'peak_rss': peak, 'cpu_user': round(cpu_user, 4), 'cpu_system': round(cpu_system, 4)}
+        if end['io'] and self.start['io']:
+            usage['io_read_bytes'] = end['io'][0] - self.start['io'][0]
+            usage['io_write_bytes'] = end['io'][1] - self.start['io'][1]
+        return usage
+
+
+def sample_process(pid):
+    """父进程侧对仍在运行的脚本进程树采样（超时终止前调用），得不到子进程自行上报的用量时使用"""
+    try:
+        proc = psutil.Process(pid)
+        procs = [proc] + proc.children(recursive=True)
+    except psutil.Error:
+        return {}
+    usage = {'peak_rss': 0, 'cpu_user': 0.0, 'cpu_system': 0.0, 'io_read_bytes': 0, 'io_write_bytes': 0}
+    for p in procs:
+        try:
+            with p.oneshot():
+                usage['peak_rss'] += p.memory_info().rss
+                cpu = p.cpu_times()
+                usage['cpu_user'] += cpu.user
+                usage['cpu_system'] += cpu.system
+                io = p.io_counters()
+                usage['io_read_bytes'] += io.read_bytes
+                usage['io_write_bytes'] += io.write_bytes
+        except (psutil.Error, AttributeError):
+            continue
+    return usage
+
+
+def record_usage(usage):
+    if not usage:
+        return
+    SCRIPT_CPU.observe(usage.get('cpu_user', 0) + usage.get('cpu_system', 0))
+    if usage.get('peak_rss'):
+        SCRIPT_PEAK_RSS.observe(usage['peak_rss'])
+
+
+def merge_usage(total, usage):
+    """运行级汇总：峰值 RSS 取最大，其余累加"""
+    for key in USAGE_FIELDS:
+        value = usage.get(key)
+        if value is None:
+            continue
+        if key == 'peak_rss':
+            total[key] = max(total.get(key) or 0, value)
+        else:
+            total[key] = (total.get(key) or 0) + value
+    return total
@@ -16,11 +16,14 @@ class ProcessLock:
         """获取任务锁"""
         start_time = time.time()
         
-        while time.time() - start_time < timeout:
+        # timeout=0 时只尝试一次，不等待
+        while True:
             with self.global_lock:
                 if task_id not in self.locks:
                     self.locks[task_id] = threading.Lock()
                     return self.locks[task_id].acquire(blocking=False)
+            if time.time() - start_time >= timeout:
+                break
             time.sleep(0.1)
         
         logger.warning(f"无法在 {timeout}s 内获取任务锁: {task_id}")
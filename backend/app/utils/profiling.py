@@ -0,0 +1,249 @@
+"""脚本性能剖析：在执行脚本的（子）进程内运行 cProfile（确定性）或定时采样调用栈（低开销）。
+
+结果保存在脚本日志旁：
+  <脚本>.pstats     仅 cprofile 模式，pstats 格式（python -m pstats / snakeviz 可直接打开）
+  <脚本>.collapsed  折叠调用栈，每行 "帧;帧;...;帧 微秒"，可交给 flamegraph.pl / speedscope 生成火焰图
+
+采样模式由后台线程按 PROFILE_SAMPLE_INTERVAL 抓取执行脚本线程的调用栈，每个样本计入距上一次采样的实际耗时；
+cprofile 模式没有完整调用栈，折叠调用栈由调用关系推导：每个函数的自身耗时按各调用方的累计耗时占比分摊到调用链上。
+"""
+import os
+import re
+import sys
+import time
+import marshal
+import cProfile
+import threading
+from collections import Counter, defaultdict
+from contextlib import nullcontext
+
+MODES = ('cprofile', 'sampling')
+PSTATS_SUFFIX = '.pstats'
+COLLAPSED_SUFFIX = '.collapsed'
+MAX_STACK_DEPTH = 128
+# cprofile 推导调用链时，分摊比例低于该值的分支不再展开
+MIN_CHAIN_SHARE = 0.001
+
+_LABEL_RE = re.compile(r'^(.*) \((.*):(\d+)\)$')
+
+
+def artifact_paths(prefix):
+    """(pstats 文件, 折叠调用栈文件)，prefix 为运行目录下的脚本文件名"""
+    return prefix + PSTATS_SUFFIX, prefix + COLLAPSED_SUFFIX
+
+
+def scripts_with_profiles(names):
+    """文件名中有剖析结果的脚本：{script: mode}，有 pstats 文件的为 cprofile"""
+    names = set(names)
+    result = {}
+    for name in names:
+        if name.endswith(COLLAPSED_SUFFIX):
+            script = name[:-len(COLLAPSED_SUFFIX)]
+            result[script] = 'cprofile' if script + PSTATS_SUFFIX in names else 'sampling'
+    return result
+
+
+def _label(func):
+    filename, lineno, name = func
+    if filename == '~':
+        # 内置函数：('~', 0, '<built-in method time.sleep>')
+        return name
+    return f"{name} ({filename}:{lineno})"
+
+
+def _parse_label(label):
+    m = _LABEL_RE.match(label)
+    if m is None:
+        return label, None, None
+    return m.group(1), m.group(2), int(m.group(3))
+
+
+class StackSampler:
+    """后台线程按固定间隔抓取目标线程的调用栈，base_frame 及其外层（执行器自身）不计入"""
+
+    def __init__(self, interval, thread_id=None, base_frame=None):
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.base_frame = base_frame
+        self.stacks = Counter()  # (帧, ...) -> 微秒
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name='profile-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _loop(self):
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter()
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and frame is not self.base_frame and len(stack) < MAX_STACK_DEPTH:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += (now - last) * 1e6
+                self.samples += 1
+            last = now
+
+
+def collapse_pstats(stats):
+    """由 pstats 的调用关系推导折叠调用栈：{(帧, ...): 微秒}"""
+    result = Counter()
+
+    def chains(func, weight, floor, seen, depth):
+        callers = {c: v for c, v in stats[func][4].items() if c in stats and c not in seen}
+        # 调用方的累计耗时都为 0 时按调用次数分摊
+        index = 3 if sum(v[3] for v in callers.values()) > 0 else 0
+        total = sum(v[index] for v in callers.values())
+        if not callers or total <= 0 or depth >= MAX_STACK_DEPTH:
+            yield (func,), weight
+            return
+        for caller, v in callers.items():
+            share = weight * v[index] / total
+            if share < floor:
+                continue
+            for chain, w in chains(caller, share, floor, seen | {caller}, depth + 1):
+                yield chain + (func,), w
+
+    for func, (cc, nc, tt, ct, callers) in stats.items():
+        us = tt * 1e6
+        if us < 1:
+            continue
+        floor = max(MIN_CHAIN_SHARE, 1 / us)
+        for chain, w in chains(func, 1.0, floor, {func}, 0):
+            result[chain] += us * w
+    return result
+
+
+def write_collapsed(path, stacks):
+    with open(path, 'w', encoding='utf-8') as f:
+        for chain, us in sorted(stacks.items(), key=lambda kv: -kv[1]):
+            value = int(round(us))
+            if value > 0:
+                f.write(';'.join(_label(func) for func in chain) + f" {value}\n")
+
+
+class ScriptProfiler:
+    """with 块内剖析当前线程，退出时把结果写到 prefix 对应的文件；块内抛出的异常（含 SystemExit）照常向外传播"""
+
+    def __init__(self, mode, prefix, interval=0.005):
+        if mode not in MODES:
+            raise ValueError(f"未知的剖析模式: {mode}")
+        self.mode = mode
+        self.prefix = prefix
+        self.interval = interval
+        self._profiler = None
+        self._sampler = None
+
+    def __enter__(self):
+        for path in artifact_paths(self.prefix):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        if self.mode == 'cprofile':
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        else:
+            self._sampler = StackSampler(self.interval, base_frame=sys._getframe(1))
+            self._sampler.start()
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            self.save()
+        except Exception as e:
+            # 剖析结果写入失败不影响脚本本身的结果
+            print(f"保存剖析结果失败: {e}", file=sys.__stderr__)
+        return False
+
+    def save(self):
+        pstats_path, collapsed_path = artifact_paths(self.prefix)
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.create_stats()
+            self._profiler.dump_stats(pstats_path)
+            stacks = collapse_pstats(self._profiler.stats)
+        else:
+            self._sampler.stop()
+            stacks = self._sampler.stacks
+        write_collapsed(collapsed_path, stacks)
+
+
+def session(profile, interval=0.005):
+    """profile 为 {'mode', 'prefix'} 时返回 ScriptProfiler，为空时返回空的上下文管理器"""
+    if not profile:
+        return nullcontext()
+    return ScriptProfiler(profile['mode'], profile['prefix'], interval)
+
+
+def _top_from_pstats(data):
+    stats = marshal.loads(data)
+    total = sum(v[2] for v in stats.values()) or 0.0
+    rows = []
+    for (filename, lineno, name), (cc, nc, tt, ct, _) in stats.items():
+        rows.append({
+            'function': name,
+            'file': None if filename == '~' else filename,
+            'line': lineno or None,
+            'calls': nc,
+            'primitive_calls': cc,
+            'self_seconds': tt,
+            'total_seconds': ct,
+        })
+    return rows, total
+
+
+def _top_from_collapsed(text):
+    self_us, total_us = defaultdict(float), defaultdict(float)
+    for line in text.splitlines():
+        stack, _, value = line.rpartition(' ')
+        try:
+            value = float(value)
+        except ValueError:
+            continue
+        frames = stack.split(';')
+        self_us[frames[-1]] += value
+        for label in set(frames):
+            total_us[label] += value
+    rows = []
+    for label, us in total_us.items():
+        name, filename, lineno = _parse_label(label)
+        rows.append({
+            'function': name,
+            'file': filename,
+            'line': lineno,
+            'calls': None,
+            'primitive_calls': None,
+            'self_seconds': self_us.get(label, 0.0) / 1e6,
+            'total_seconds': us / 1e6,
+        })
+    return rows, sum(self_us.values()) / 1e6
+
+
+def top_functions(pstats_data=None, collapsed_text=None, limit=20, sort='self'):
+    """最耗时的 limit 个函数；有 pstats 时用精确统计，否则由折叠调用栈汇总（采样模式没有调用次数）。
+
+    返回 (函数列表, 自身耗时合计秒数)，sort 为 self（自身耗时）或 total（含子调用）。
+    """
+    if pstats_data:
+        rows, total = _top_from_pstats(pstats_data)
+    else:
+        rows, total = _top_from_collapsed(collapsed_text or '')
+    key = 'self_seconds' if sort == 'self' else 'total_seconds'
+    rows.sort(key=lambda r: -r[key])
+    rows = rows[:limit]
+    for row in rows:
+        row['self_percent'] = round(row['self_seconds'] * 100 / total, 2) if total else 0.0
+        row['self_seconds'] = round(row['self_seconds'], 6)
+        row['total_seconds'] = round(row['total_seconds'], 6)
+    return rows, round(total, 6)
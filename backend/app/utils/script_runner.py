@@ -2,12 +2,40 @@ import os
 import sys
 import io
 import runpy
+import time
+import signal
 import traceback
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Pipe
+from multiprocessing.connection import wait
+from app.core.config import Config
 from app.utils import task_ipc
+from app.utils import metrics
+from app.utils import proc_limits
+from app.utils import profiling
+from app.utils import tracing
+from app.utils.logger import setup_logger
 
+logger = setup_logger(__name__)
 
-def _worker(script_path, params, env, cwd, q: Queue, context_proxy=None, log_queue=None):
+SPAWN_LATENCY = metrics.histogram('script_spawn_seconds', '从派发脚本到子进程开始执行的延迟', labels=('mode',))
+
+
+def _execute(script_path, params, env, cwd, conn, context=None, forward_logs=False, profile=None, trace=None):
+    """在当前（子）进程内执行脚本并返回结果 dict；fork 模式与预热进程池共用。
+
+    脚本执行期间按配置收紧 rlimit，结束后恢复，结果中的 usage 为本次执行的资源用量。
+    profile 为 {'mode', 'prefix'} 时在剖析器下执行脚本，结果写到 prefix 对应的文件（见 profiling）。
+    trace 为 {'parent': span id} 时记录子进程内各阶段（及脚本通过 task_sdk.span 打开）的 span，放在结果的 spans 中。
+    """
+    setup_started = time.time()
+    tracer = tracing.Tracer(max_spans=Config.TRACE_MAX_SPANS) if trace else None
+    trace_token = tracing.attach(tracer, (trace or {}).get('parent'))
+    channel = None
+    batcher = None
+    meter = proc_limits.UsageMeter()
+    saved_limits = proc_limits.apply_rlimits()
+    # 脚本主线程与日志刷新线程共用同一管道
+    conn = task_ipc.LockedConn(conn)
     try:
         # apply env and cwd
         if env is not None:
@@ -27,17 +55,13 @@ def _worker(script_path, params, env, cwd, q: Queue, context_proxy=None, log_que
         except Exception:
             pass
 
-        # inject context proxy and log queue into task_ipc so script SDK can access them
-        try:
-            if context_proxy is not None:
-                task_ipc.CONTEXT_PROXY = context_proxy
-        except Exception:
-            pass
-        try:
-            if log_queue is not None:
-                task_ipc.LOG_QUEUE = log_queue
-        except Exception:
-            pass
+        # inject context channel and log batcher into task_ipc so script SDK can access them
+        if context is not None:
+            channel = task_ipc.ContextChannel(context, conn)
+            task_ipc.CONTEXT_CHANNEL = channel
+        if forward_logs:
+            batcher = task_ipc.LogBatcher(conn, Config.LOG_BATCH_MAX_LINES, Config.LOG_BATCH_INTERVAL)
+            task_ipc.LOG_QUEUE = batcher
 
         # prepare argv
         sys.argv = [script_path] + (params or [])
@@ -100,7 +124,10 @@ def _worker(script_path, params, env, cwd, q: Queue, context_proxy=None, log_que
             sys.stdout = QueueWriter(sio, queue=writer_queue, level='INFO')
             sys.stderr = QueueWriter(sio, queue=writer_queue, level='ERROR')
             # run the script as __main__ so if it checks __name__ == '__main__' it executes
-            runpy.run_path(script_path, run_name="__main__")
+            tracing.record('child_setup', setup_started, time.time())
+            with tracing.span('script_body', script=os.path.basename(script_path)), \
+                    profiling.session(profile, Config.PROFILE_SAMPLE_INTERVAL):
+                runpy.run_path(script_path, run_name="__main__")
             # flush any remaining buffered text
             try:
                 sys.stdout.flush()
@@ -115,10 +142,10 @@ def _worker(script_path, params, env, cwd, q: Queue, context_proxy=None, log_que
             # injected queue contents (task_sdk.log). Return empty output
             # in that case to avoid duplicate storage.
             if injected_q is not None:
-                q.put({"output": "", "returncode": 0})
+                result = {"output": "", "returncode": 0}
             else:
                 output = sio.getvalue()
-                q.put({"output": output, "returncode": 0})
+                result = {"output": output, "returncode": 0}
         finally:
             sys.stdout = old_out
             sys.stderr = old_err
@@ -129,43 +156,205 @@ def _worker(script_path, params, env, cwd, q: Queue, context_proxy=None, log_que
         except Exception:
             code = 1
         output = '' if 'sio' in locals() and injected_q is not None else (sio.getvalue() if 'sio' in locals() else '')
-        q.put({"output": output, "returncode": code})
+        result = {"output": output, "returncode": code}
     except Exception:
         tb = traceback.format_exc()
         output = '' if 'sio' in locals() and injected_q is not None else ((sio.getvalue() + "\n" + tb) if 'sio' in locals() else tb)
-        q.put({"output": output, "returncode": 1})
+        if 'injected_q' in locals() and injected_q is not None:
+            # 输出不回传时，异常堆栈改走日志通道，避免失败的脚本不留任何痕迹
+            for line in tb.rstrip().splitlines():
+                injected_q.put(('ERROR', line))
+        result = {"output": output, "returncode": 1}
+
+    # batched write-back: remaining logs and pending context updates go out right before the result
+    try:
+        if batcher is not None:
+            with tracing.span('log_drain'):
+                batcher.close()
+    except Exception:
+        pass
+    try:
+        if channel is not None:
+            with tracing.span('context_flush'):
+                channel.flush()
+    except Exception:
+        pass
+    proc_limits.restore_rlimits(saved_limits)
+    result['usage'] = meter.finish()
+    tracing.detach(trace_token)
+    if tracer is not None:
+        result['spans'] = tracer.drain()
+    return result
+
+
+def _worker(script_path, params, env, cwd, conn, context=None, forward_logs=False, profile=None, trace=None):
+    # 独立进程组（及可选的 cgroup）：超时或结束时脚本派生的整个进程树一起终止
+    proc_limits.new_process_group()
+    proc_limits.enter_cgroup()
+    conn.send(('started', None))
+    conn.send(('result', _execute(script_path, params, env, cwd, conn, context, forward_logs, profile, trace)))
+
+
+def _handle_message(msg, context, state, log_sink=None):
+    kind, payload = msg
+    if kind == 'context':
+        if context is not None:
+            task_ipc.apply_context_delta(context, payload)
+    elif kind == 'started':
+        state['started_at'] = time.monotonic()
+    elif kind == 'log':
+        # 一个批次：{'lines': [(level, message)], 'first_at': 批次中最早一行的产生时间}
+        if log_sink is not None:
+            log_sink(payload)
+    elif kind == 'result':
+        state['result'] = payload
+        state['result_at'] = time.monotonic()
+
+
+def _collect(conn, sentinel, deadline, context, state, log_sink=None):
+    """父进程侧消息循环：处理子进程消息直到收到结果、子进程退出或超时；返回是否超时"""
+    while 'result' not in state:
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            return True
+        ready = wait([conn, sentinel], timeout=remaining)
+        if conn in ready:
+            try:
+                _handle_message(conn.recv(), context, state, log_sink)
+            except EOFError:
+                return False
+            continue
+        if sentinel in ready:
+            # child exited: drain whatever is still buffered in the pipe
+            while conn.poll(0):
+                try:
+                    _handle_message(conn.recv(), context, state, log_sink)
+                except EOFError:
+                    break
+            return False
+    return False
+
+
+def _finish(state, timed_out, timeout, exit_message=None):
+    if timed_out:
+        partial = (state.get('result') or {}).get('output')
+        out = partial or f"ERROR: 脚本执行超时 ({timeout}s)"
+        return out, -1, True
 
+    res = state.get('result')
+    if res is None:
+        # 子进程没有回传结果就退出（被 rlimit / OOM 等信号终止）
+        return exit_message or "", -1, False
+    return res.get('output', ''), res.get('returncode', 0), False
 
-def run_script(script_path, params=None, env=None, cwd=None, timeout=None, context_proxy=None, log_queue=None):
-    """Run a Python script in a separate forked process and capture its output.
+
+def _report_spans(state, dispatched_at, dispatched_wall, mode):
+    """记录派发到子进程开始执行（spawn）、收到结果到回收完子进程（reap）两段，并加入子进程回传的 span"""
+    if 'started_at' in state:
+        tracing.record('spawn', dispatched_wall, dispatched_wall + state['started_at'] - dispatched_at, mode=mode)
+    result = state.get('result') or {}
+    tracing.extend(result.get('spans'))
+    if 'result_at' in state:
+        tracing.record('reap', dispatched_wall + state['result_at'] - dispatched_at,
+                       dispatched_wall + time.monotonic() - dispatched_at)
+
+
+def _report_usage(state, usage, sampled=None, cgroup=None):
+    """把子进程上报（或超时前采样）的资源用量写入调用方传入的 usage dict"""
+    measured = dict((state.get('result') or {}).get('usage') or sampled or {})
+    if cgroup and cgroup.get('memory_peak'):
+        # cgroup 的峰值覆盖整个进程树
+        measured['peak_rss'] = max(measured.get('peak_rss') or 0, cgroup['memory_peak'])
+    proc_limits.record_usage(measured)
+    if usage is not None:
+        usage.update(measured)
+
+
+def run_script(script_path, params=None, env=None, cwd=None, timeout=None, context=None, log_sink=None,
+               use_pool=None, usage=None, profile=None, procs=None):
+    """Run a Python script in a separate process and capture its output.
+
+    When ``context`` (a dict) is given, the child loads it as a snapshot and the
+    updates it writes back (at exit or on ``task_sdk.flush()``) are merged into
+    the same dict in place, including updates flushed before a timeout.
+
+    When ``log_sink`` (a callable) is given, ``task_sdk.log()`` lines are batched
+    in the child and delivered to it as ``{'lines': [(level, message)], 'first_at': ts}``
+    on this thread; plain ``print()`` output is then not returned.
+
+    ``use_pool`` selects the pre-forked warm worker pool (defaults to
+    ``Config.WARM_POOL_ENABLED``); if no warm worker is idle the script falls
+    back to a freshly forked process.
+
+    When ``usage`` (a dict) is given it is filled with the script's resource
+    usage: ``peak_rss`` (bytes), ``cpu_user`` / ``cpu_system`` (seconds) and
+    ``io_read_bytes`` / ``io_write_bytes``.
+
+    When ``profile`` (``{'mode': 'cprofile' | 'sampling', 'prefix': path}``) is
+    given the script body runs under that profiler and the results are written
+    to ``prefix + '.pstats'`` (cprofile only) and ``prefix + '.collapsed'``.
+
+    When the calling thread has an active trace (see ``tracing``), the spawn /
+    reap phases and the spans recorded inside the child are added to it.
+
+    When ``procs`` (a ``proc_limits.ProcessGroups``) is given, the script's
+    process group is registered there while it runs so that the caller can
+    kill it from another thread (e.g. when a runner loses the run's lease).
 
     Returns (output: str, returncode: int, timed_out: bool).
     """
-    q = Queue()
-    p = Process(target=_worker, args=(script_path, params, env, cwd, q, context_proxy, log_queue))
+    if use_pool is None:
+        use_pool = Config.WARM_POOL_ENABLED
+    # 调用方正在记录追踪时，子进程内的 span 挂在当前 span 之下
+    trace = tracing.propagate()
+    if use_pool:
+        from app.utils.worker_pool import get_pool
+        res = get_pool().run(script_path, params, env, cwd, timeout, context, log_sink, usage, profile, trace,
+                             procs)
+        if res is not None:
+            return res
+
+    recv_conn, send_conn = Pipe(duplex=False)
+    p = Process(target=_worker, args=(script_path, params, env, cwd, send_conn, context, log_sink is not None,
+                                      profile, trace))
+    dispatched_at, dispatched_wall = time.monotonic(), time.time()
     p.start()
-    p.join(timeout)
-    if p.is_alive():
-        # timeout: terminate process
-        try:
-            p.terminate()
-        except Exception:
-            pass
-        p.join(1)
-        # try to get any partial output
-        partial = None
-        try:
-            if not q.empty():
-                res = q.get_nowait()
-                partial = res.get('output', '')
-        except Exception:
-            partial = None
-        out = partial or f"ERROR: 脚本执行超时 ({timeout}s)"
-        return out, -1, True
+    proc_limits.new_process_group(p.pid)
+    if procs is not None:
+        procs.add(p.pid)
+    # 关闭父进程持有的发送端，子进程退出后 recv 端才能感知 EOF
+    send_conn.close()
 
-    # finished normally
+    state = {}
+    deadline = None if timeout is None else dispatched_at + timeout
+    timed_out = False
+    sampled = None
     try:
-        res = q.get(timeout=1)
-        return res.get('output', ''), res.get('returncode', 0), False
-    except Exception:
-        return "", -1, False
+        timed_out = _collect(recv_conn, p.sentinel, deadline, context, state, log_sink)
+    finally:
+        if timed_out and p.is_alive():
+            sampled = proc_limits.sample_process(p.pid)
+            # 先礼后兵：整个进程组 SIGTERM，1 秒后仍未退出的 SIGKILL
+            if not proc_limits.kill_group(p.pid, signal.SIGTERM):
+                try:
+                    p.terminate()
+                except Exception:
+                    pass
+        p.join(1)
+        # 进程组内仍存活的进程（脚本派生的后台进程，或回传结果后迟迟未退出的脚本进程）一并终止
+        exited = p.exitcode is not None
+        if proc_limits.kill_group(p.pid, signal.SIGKILL) and exited and not timed_out:
+            logger.warning(f"脚本退出后仍有子进程残留，已终止: {script_path}")
+        if p.exitcode is None:
+            p.join(1)
+        recv_conn.close()
+        if procs is not None:
+            procs.discard(p.pid)
+    cgroup = proc_limits.release_cgroup(p.pid)
+
+    if 'started_at' in state:
+        SPAWN_LATENCY.labels(mode='fork').observe(state['started_at'] - dispatched_at)
+    _report_usage(state, usage, sampled, cgroup)
+    _report_spans(state, dispatched_at, dispatched_wall, 'fork')
+    exit_message = None if timed_out or 'result' in state else proc_limits.describe_exit(p.exitcode, cgroup)
+    return _finish(state, timed_out, timeout, exit_message)
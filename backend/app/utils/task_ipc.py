@@ -1,20 +1,136 @@
-"""进程间上下文代理占位模块。
-子进程运行时，`script_runner` 会在子进程中设置 `CONTEXT_PROXY`，脚本通过 `task_sdk` 访问该代理。
+"""进程间上下文通道占位模块。
+子进程运行时，`script_runner` 会在子进程中设置 `CONTEXT_CHANNEL`，脚本通过 `task_sdk` 访问该通道。
+
+通道在子进程启动时载入父进程传入的上下文快照，读操作完全在本地完成；
+写操作只记录增量，在脚本结束或调用 `task_sdk.flush()` 时批量回传父进程。
+
+日志同样在子进程内攒批：`task_sdk.log()` 写入 `LOG_QUEUE`（`LogBatcher`），
+达到行数阈值或时间阈值时整批经同一管道发送，避免每行一次 pickle + 管道写。
 """
-CONTEXT_PROXY = None
+import time
+import threading
 
-# optional log queue injected by runner
+CONTEXT_CHANNEL = None
+
+# optional log sink injected by runner (anything with put((level, message)))
 LOG_QUEUE = None
 
 
-def has_proxy():
-    return CONTEXT_PROXY is not None
+class LockedConn:
+    """子进程内多个线程（脚本主线程、日志定时刷新线程）共享管道时串行化 send"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._lock = threading.Lock()
+
+    def send(self, obj):
+        with self._lock:
+            self.conn.send(obj)
+
+
+class LogBatcher:
+    """子进程侧日志攒批：满 max_lines 行或最早一行等待超过 interval 秒即发送"""
+
+    def __init__(self, conn, max_lines=200, interval=0.2):
+        self.conn = conn
+        self.max_lines = max(1, max_lines)
+        self.interval = interval
+        self._lines = []
+        self._first_at = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, name='log-batcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, item):
+        with self._lock:
+            if not self._lines:
+                self._first_at = time.time()
+            self._lines.append(item)
+            if len(self._lines) >= self.max_lines:
+                self._send()
+
+    def _send(self):
+        # 在锁内发送以保证批次顺序；管道写满时自然对脚本形成背压
+        if self._lines:
+            self.conn.send(('log', {'lines': self._lines, 'first_at': self._first_at}))
+            self._lines, self._first_at = [], None
+
+    def flush(self):
+        with self._lock:
+            self._send()
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                if self._lines and time.time() - self._first_at >= self.interval:
+                    self._send()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(self.interval + 1)
+        self.flush()
 
 
-def get_proxy():
-    return CONTEXT_PROXY
+class ContextChannel:
+    """子进程侧的上下文快照 + 待回写增量"""
+
+    def __init__(self, snapshot, conn):
+        self.data = dict(snapshot or {})
+        self.conn = conn
+        self._updates = {}
+        self._deleted = set()
+        self._lock = threading.Lock()
+
+    def get_all(self):
+        with self._lock:
+            return dict(self.data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self.data.get(key, default)
+
+    def update(self, mapping):
+        with self._lock:
+            for k, v in mapping.items():
+                self.data[k] = v
+                self._updates[k] = v
+                self._deleted.discard(k)
+
+    def delete(self, key):
+        with self._lock:
+            self.data.pop(key, None)
+            self._updates.pop(key, None)
+            self._deleted.add(key)
+
+    def flush(self):
+        """把累计的增量一次性发送给父进程，无增量时不产生任何 IPC"""
+        with self._lock:
+            if not self._updates and not self._deleted:
+                return False
+            delta = {'set': self._updates, 'delete': list(self._deleted)}
+            self._updates = {}
+            self._deleted = set()
+            self.conn.send(('context', delta))
+            return True
+
+
+def apply_context_delta(context, delta):
+    """父进程侧：把子进程回传的增量合并进上下文 dict"""
+    for k in delta.get('delete') or []:
+        context.pop(k, None)
+    context.update(delta.get('set') or {})
+    return context
+
+
+def has_channel():
+    return CONTEXT_CHANNEL is not None
+
+
+def get_context_channel():
+    return CONTEXT_CHANNEL
 
 
 def get_log_queue():
     return LOG_QUEUE
-
@@ -4,30 +4,34 @@
     from app.utils import task_sdk
     ctx = task_sdk.get_context()
     task_sdk.update_context({'key': 'value'})
+    task_sdk.flush()  # 可选：立即把已写入的上下文回传给调度进程
+    with task_sdk.span('load_data', rows=100):  # 可选：自定义追踪 span，出现在运行时间线中
+        ...
 
-该 SDK 优先使用 `task_ipc.CONTEXT_PROXY`（由 runner 注入的 `multiprocessing.Manager().dict()` 代理）。
-如果代理不可用，SDK 会回退到读取环境变量，并仍然支持打印 `__CONTEXT__` 以兼容旧版实现。
+该 SDK 优先使用 `task_ipc.CONTEXT_CHANNEL`（由 runner 注入的上下文快照通道），读取不产生 IPC，
+写入在脚本结束或调用 `flush()` 时批量回传。
+如果通道不可用，SDK 会回退到读取环境变量，并仍然支持打印 `__CONTEXT__` 以兼容旧版实现。
 """
 import os
 import json
 from typing import Any, Dict
 
 from app.utils import task_ipc
+from app.utils import tracing
 
 
-def _proxy_available():
+def _channel_available():
     try:
-        return task_ipc.get_proxy() is not None
+        return task_ipc.get_context_channel() is not None
     except Exception:
         return False
 
 
 def get_context() -> Dict[str, Any]:
-    """返回当前上下文（非代理时基于环境变量）。"""
-    if _proxy_available():
-        proxy = task_ipc.get_proxy()
+    """返回当前上下文（非通道时基于环境变量）。"""
+    if _channel_available():
         try:
-            return dict(proxy)
+            return task_ipc.get_context_channel().get_all()
         except Exception:
             return {}
 
@@ -41,23 +45,23 @@ def get_context() -> Dict[str, Any]:
 
 
 def get(key, default=None):
+    if _channel_available():
+        try:
+            return task_ipc.get_context_channel().get(key, default)
+        except Exception:
+            return default
     ctx = get_context()
     return ctx.get(key, default)
 
 
 def update_context(update: Dict[str, Any]):
-    """更新上下文。如果有 proxy 则写入代理，否则打印 __CONTEXT__ 供上层解析。"""
+    """更新上下文。如果有通道则写入本地快照并记录增量，否则打印 __CONTEXT__ 供上层解析。"""
     if not isinstance(update, dict):
         raise ValueError('update must be a dict')
 
-    if _proxy_available():
-        proxy = task_ipc.get_proxy()
+    if _channel_available():
         # shallow update
-        for k, v in update.items():
-            try:
-                proxy[k] = v
-            except Exception:
-                pass
+        task_ipc.get_context_channel().update(update)
         return True
 
     # fallback: emit __CONTEXT__ to stdout to keep backward compatibility
@@ -68,6 +72,16 @@ def update_context(update: Dict[str, Any]):
         return False
 
 
+def flush():
+    """立即回传尚未同步的上下文增量（脚本结束时 runner 会自动调用）。"""
+    if not _channel_available():
+        return False
+    try:
+        return task_ipc.get_context_channel().flush()
+    except Exception:
+        return False
+
+
 def log(message: str, level: str = 'INFO'):
     """Emit a log message. If a LOG_QUEUE is injected, push a tuple (level, message).
     Otherwise fall back to printing to stdout.
@@ -93,3 +107,11 @@ def log(message: str, level: str = 'INFO'):
 
 def set_key(key: str, value: Any):
     return update_context({key: value})
+
+
+def span(name: str, **attrs):
+    """自定义追踪 span（上下文管理器），记录 with 块的耗时，出现在运行的 trace 时间线中。
+
+    返回的句柄可用 set(key, value) 补充属性；运行未开启追踪（TRACE_ENABLED=0）时什么也不做。
+    """
+    return tracing.span(name, **attrs)
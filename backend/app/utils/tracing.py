@@ -0,0 +1,168 @@
+"""运行内的轻量追踪：把一次运行从 API 请求、调度、脚本进程到落库的各阶段记录为嵌套的 span。
+
+每个 span 为 {'span_id', 'parent_id', 'name', 'start'（Unix 时间戳，秒）, 'duration'（秒）, 'attrs'}，由 Tracer 收集。
+当前线程正在记录的 Tracer 与 span 保存在线程局部变量中；没有激活的 Tracer 时 span() / record() 什么也不做，
+因此可以放在任何代码路径上。跨线程 / 跨进程只传递父 span 的 id（运行计划中的 plan['trace']、脚本子进程的 trace 参数），
+脚本子进程内记录的 span（含 task_sdk.span 自定义 span）随执行结果一起回传父进程。导出与时间线见 app.core.trace_store。
+"""
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+_local = threading.local()
+
+
+def new_id():
+    return os.urandom(8).hex()
+
+
+class Tracer:
+    """收集一条追踪中的 span，可在多个线程间共享；max_spans 限制记录条数（超出的计入 dropped）"""
+
+    def __init__(self, run_id=None, max_spans=None):
+        self.run_id = run_id
+        self.max_spans = max_spans
+        self.dropped = 0
+        self._count = 0
+        self._spans = []
+        self._lock = threading.Lock()
+
+    def _admit(self):
+        if self.max_spans and self._count >= self.max_spans:
+            self.dropped += 1
+            return False
+        self._count += 1
+        return True
+
+    def record(self, name, start, end, parent_id=None, attrs=None, span_id=None):
+        span_id = span_id or new_id()
+        with self._lock:
+            if self._admit():
+                self._spans.append({
+                    'span_id': span_id,
+                    'parent_id': parent_id,
+                    'name': name,
+                    'start': start,
+                    'duration': max(0.0, end - start),
+                    'attrs': attrs or {},
+                })
+        return span_id
+
+    def extend(self, spans):
+        """加入其他进程回传的 span"""
+        with self._lock:
+            for item in spans or ():
+                if self._admit():
+                    self._spans.append(item)
+
+    def drain(self):
+        """取出目前已结束的 span，供增量导出"""
+        with self._lock:
+            spans, self._spans = self._spans, []
+        return spans
+
+
+class _SpanHandle:
+    __slots__ = ('span_id', 'attrs')
+
+    def __init__(self, span_id, attrs):
+        self.span_id = span_id
+        self.attrs = attrs
+
+    def set(self, key, value):
+        self.attrs[key] = value
+
+
+class _NoopSpan:
+    span_id = None
+
+    def set(self, key, value):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+def current():
+    """(当前线程的 Tracer, 当前 span id)，没有激活时为 (None, None)"""
+    return getattr(_local, 'state', None) or (None, None)
+
+
+def attach(tracer, span_id=None):
+    """在当前线程激活 tracer，返回恢复用的令牌（交给 detach）"""
+    previous = getattr(_local, 'state', None)
+    _local.state = (tracer, span_id) if tracer is not None else None
+    return previous
+
+
+def detach(token):
+    _local.state = token
+
+
+@contextmanager
+def activate(tracer, span_id=None):
+    token = attach(tracer, span_id)
+    try:
+        yield
+    finally:
+        detach(token)
+
+
+@contextmanager
+def span(name, **attrs):
+    """记录 with 块的耗时为当前 span 的子 span；返回的句柄可用 set(key, value) 补充属性"""
+    tracer, parent = current()
+    if tracer is None:
+        yield _NOOP
+        return
+    handle = _SpanHandle(new_id(), attrs)
+    start = time.time()
+    _local.state = (tracer, handle.span_id)
+    try:
+        yield handle
+    except SystemExit as e:
+        handle.attrs['exit_code'] = e.code
+        raise
+    except BaseException as e:
+        handle.attrs['error'] = type(e).__name__
+        raise
+    finally:
+        _local.state = (tracer, parent)
+        tracer.record(name, start, time.time(), parent, handle.attrs, handle.span_id)
+
+
+def record(name, start, end, **attrs):
+    """补记一个已知起止时间的 span（挂在当前 span 下）"""
+    tracer, parent = current()
+    if tracer is not None:
+        tracer.record(name, start, end, parent, attrs)
+
+
+def extend(spans):
+    tracer, _ = current()
+    if tracer is not None and spans:
+        tracer.extend(spans)
+
+
+def bind_run(run_id):
+    """把当前追踪（如 API 请求）关联到运行，请求结束时随运行导出"""
+    tracer, _ = current()
+    if tracer is not None and tracer.run_id is None:
+        tracer.run_id = run_id
+
+
+def propagate():
+    """传给其他线程 / 进程的追踪上下文 {'parent': 当前 span id}，没有激活的追踪时返回 None"""
+    tracer, span_id = current()
+    if tracer is None or span_id is None:
+        return None
+    return {'parent': span_id}
+
+
+def run_in_span(tracer, parent_id, name, attrs, fn, *args, **kwargs):
+    """在当前（通常是线程池的）线程中激活 tracer，以 name 为 span 执行 fn；tracer 为 None 时直接执行"""
+    if tracer is None:
+        return fn(*args, **kwargs)
+    with activate(tracer, parent_id), span(name, **attrs):
+        return fn(*args, **kwargs)
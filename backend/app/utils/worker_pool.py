@@ -0,0 +1,264 @@
+"""预热工作进程池：预先 fork 的子进程已导入常用模块，可重复执行脚本以省去进程启动与导入开销。
+
+每个工作进程在任务之间会恢复 os.environ / cwd / sys.argv / task_ipc 与 rlimit，并终止脚本遗留的子进程，
+执行 N 个任务或常驻内存超过阈值后被回收替换。工作进程各自是一个进程组（可选放入独立 cgroup），
+超时回收时整组终止。
+"""
+import os
+import sys
+import time
+import signal
+import atexit
+import importlib
+import threading
+from multiprocessing import Process, Pipe
+from app.core.config import Config
+from app.utils import task_ipc
+from app.utils import metrics
+from app.utils import proc_limits
+from app.utils.logger import setup_logger
+from app.utils.script_runner import _execute, _collect, _finish, _report_usage, _report_spans, SPAWN_LATENCY
+
+logger = setup_logger(__name__)
+
+POOL_JOBS = metrics.counter('warm_pool_jobs_total', '预热进程池执行的任务数', labels=('outcome',))
+POOL_RECYCLED = metrics.counter('warm_pool_recycled_total', '预热进程池回收的工作进程数', labels=('reason',))
+
+
+def _pool_worker_main(conn, preload):
+    """工作进程主循环：预加载模块后逐个接收任务执行"""
+    proc_limits.new_process_group()
+    proc_limits.enter_cgroup()
+    for name in preload:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            print(f"预加载模块失败: {name}, {e}", file=sys.stderr)
+
+    base_env = dict(os.environ)
+    base_cwd = os.getcwd()
+    base_argv = list(sys.argv)
+    try:
+        import psutil
+        proc = psutil.Process(os.getpid())
+    except Exception:
+        proc = None
+
+    conn.send(('ready', None))
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if job is None:
+            return
+        script_path, params, env, cwd, context, forward_logs, profile, trace = job
+        conn.send(('started', None))
+        try:
+            result = _execute(script_path, params, env, cwd, conn, context, forward_logs, profile, trace)
+        finally:
+            # 恢复进程状态，避免任务之间相互污染
+            os.environ.clear()
+            os.environ.update(base_env)
+            try:
+                os.chdir(base_cwd)
+            except Exception:
+                pass
+            sys.argv = list(base_argv)
+            task_ipc.CONTEXT_CHANNEL = None
+            task_ipc.LOG_QUEUE = None
+            if proc_limits.kill_children():
+                print(f"脚本退出后仍有子进程残留，已终止: {script_path}", file=sys.stderr)
+        try:
+            result['rss'] = proc.memory_info().rss if proc is not None else 0
+        except Exception:
+            result['rss'] = 0
+        conn.send(('result', result))
+
+
+class _PoolWorker:
+    def __init__(self, preload):
+        self.conn, child_conn = Pipe()
+        # 非守护进程：脚本内部仍可以使用 multiprocessing 创建子进程
+        self.process = Process(target=_pool_worker_main, args=(child_conn, preload))
+        self.process.start()
+        proc_limits.new_process_group(self.process.pid)
+        child_conn.close()
+        self.ready = False
+        self.jobs = 0
+        self.rss = 0
+
+    def poll_ready(self):
+        """非阻塞地检查预加载是否完成"""
+        if not self.ready and self.process.is_alive():
+            try:
+                while self.conn.poll(0):
+                    kind, _ = self.conn.recv()
+                    if kind == 'ready':
+                        self.ready = True
+                        break
+            except (EOFError, OSError):
+                pass
+        return self.ready and self.process.is_alive()
+
+    def stop(self, kill=False):
+        try:
+            if kill:
+                # 连同正在执行的脚本派生的子进程一起终止
+                if not proc_limits.kill_group(self.process.pid, signal.SIGKILL):
+                    self.process.terminate()
+            else:
+                self.conn.send(None)
+        except Exception:
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join(1)
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+        return proc_limits.release_cgroup(self.process.pid)
+
+
+class WarmWorkerPool:
+    """预热工作进程池"""
+
+    def __init__(self, size=None, preload=None, max_jobs=None, max_rss_mb=None):
+        self.size = max(1, size or Config.WARM_POOL_SIZE)
+        self.preload = list(Config.WARM_POOL_PRELOAD if preload is None else preload)
+        self.max_jobs = max_jobs or Config.WARM_POOL_MAX_JOBS
+        self.max_rss = (max_rss_mb or Config.WARM_POOL_MAX_RSS_MB) * 1024 * 1024
+        self.lock = threading.Lock()
+        self.idle = [_PoolWorker(self.preload) for _ in range(self.size)]
+        self.busy = 0
+        self.fallbacks = 0
+        self._closed = False
+        # 工作进程为非守护进程，退出前必须显式关闭
+        atexit.register(self.shutdown)
+        logger.info(f"预热进程池启动: size={self.size}, preload={self.preload}")
+
+    def _acquire(self):
+        with self.lock:
+            if self._closed:
+                return None
+            for worker in list(self.idle):
+                if worker.poll_ready():
+                    self.idle.remove(worker)
+                    self.busy += 1
+                    return worker
+                if not worker.process.is_alive():
+                    self.idle.remove(worker)
+                    self.idle.append(_PoolWorker(self.preload))
+            self.fallbacks += 1
+            return None
+
+    def _release(self, worker, reason=None):
+        if reason is None:
+            if worker.jobs >= self.max_jobs:
+                reason = 'max_jobs'
+            elif self.max_rss and worker.rss > self.max_rss:
+                reason = 'max_rss'
+        if reason is not None:
+            POOL_RECYCLED.labels(reason=reason).inc()
+            worker.stop(kill=reason in ('timeout', 'crashed'))
+        with self.lock:
+            self.busy -= 1
+            if self._closed:
+                if reason is None:
+                    worker.stop()
+                return
+            self.idle.append(_PoolWorker(self.preload) if reason is not None else worker)
+
+    def run(self, script_path, params, env, cwd, timeout, context, log_sink, usage=None, profile=None, trace=None,
+            procs=None):
+        """在预热进程中执行脚本；没有空闲进程时返回 None 由调用方回退到 fork 模式"""
+        worker = self._acquire()
+        if worker is None:
+            return None
+
+        dispatched_at, dispatched_wall = time.monotonic(), time.time()
+        state = {}
+        timed_out = False
+        reason = None
+        sampled = None
+        if procs is not None:
+            # 被调用方终止时整个工作进程一起终止，按崩溃处理并补充新的工作进程
+            procs.add(worker.process.pid)
+        try:
+            worker.conn.send((script_path, params, env, cwd, context, log_sink is not None, profile, trace))
+            deadline = None if timeout is None else dispatched_at + timeout
+            timed_out = _collect(worker.conn, worker.process.sentinel, deadline, context, state, log_sink)
+            if timed_out:
+                reason = 'timeout'
+                sampled = proc_limits.sample_process(worker.process.pid)
+            elif 'result' not in state:
+                reason = 'crashed'
+        except Exception as e:
+            logger.error(f"预热进程执行失败: {script_path}, {e}")
+            reason = 'crashed'
+        finally:
+            if procs is not None:
+                procs.discard(worker.process.pid)
+            worker.jobs += 1
+            worker.rss = (state.get('result') or {}).get('rss', 0)
+            self._release(worker, reason)
+
+        if 'started_at' in state:
+            SPAWN_LATENCY.labels(mode='pool').observe(state['started_at'] - dispatched_at)
+        POOL_JOBS.labels(outcome=reason or 'ok').inc()
+        _report_usage(state, usage, sampled)
+        _report_spans(state, dispatched_at, dispatched_wall, 'pool')
+        # 被回收的工作进程已 join，可以读到退出信号（rlimit 超限等）
+        exit_message = proc_limits.describe_exit(worker.process.exitcode) if reason == 'crashed' else None
+        return _finish(state, timed_out, timeout, exit_message)
+
+    def stats(self):
+        with self.lock:
+            idle = len(self.idle)
+            ready = sum(1 for w in self.idle if w.poll_ready())
+            busy = self.busy
+            fallbacks = self.fallbacks
+        latency = {}
+        for labels, child in SPAWN_LATENCY.samples():
+            latency[labels.get('mode')] = child.summary()
+        return {
+            'size': self.size,
+            'idle': idle,
+            'ready': ready,
+            'busy': busy,
+            'fallbacks': fallbacks,
+            'preload': self.preload,
+            'max_jobs': self.max_jobs,
+            'max_rss_mb': self.max_rss // (1024 * 1024),
+            'dispatch_latency': latency,
+        }
+
+    def shutdown(self):
+        with self.lock:
+            self._closed = True
+            workers, self.idle = self.idle, []
+        for worker in workers:
+            worker.stop()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """进程内单例，首次使用时启动"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = WarmWorkerPool()
+        return _pool
+
+
+def get_pool_stats():
+    """返回进程池状态；未启用时只返回 fork 模式的派发延迟"""
+    if _pool is not None:
+        return _pool.stats()
+    latency = {labels.get('mode'): child.summary() for labels, child in SPAWN_LATENCY.samples()}
+    return {'enabled': Config.WARM_POOL_ENABLED, 'size': 0, 'dispatch_latency': latency}
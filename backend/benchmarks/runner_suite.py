@@ -0,0 +1,363 @@
+"""运行器基准套件：脚本派发延迟、日志吞吐、上下文操作、端到端运行与 HTTP 接口。
+
+在临时目录中生成合成脚本与 SQLite 数据库，完全离线运行：
+  spawn             run_script 执行空脚本的往返耗时（fork；--warm 时另测预热进程池）
+  log_throughput    脚本通过 task_sdk.log 输出大量日志行，runner 侧接收的行数 / 秒
+  context_*         上下文增量编码、序列化与还原（进程内），以及大上下文传入 / 回写脚本的往返
+  cpu_bound         CPU 密集脚本在子进程中执行与进程内直接执行的耗时
+  e2e_*             TaskService.run_task 提交到运行结束回调的耗时：单个空脚本、多步骤、日志密集、上下文密集、CPU 密集，
+                    以及并发提交时的运行吞吐
+  http_*            Flask test client 请求任务列表、运行列表、日志、步骤与上下文接口
+
+结果为每个场景的 p50/p95/p99 毫秒与吞吐，--json 输出 {'meta', 'results', 'regressions'}。
+--save-baseline 保存本次结果为基线，--baseline 与基线对比，有指标退化超过 --threshold 时退出码为 1。
+基线与机器相关，应在同一台机器、相同参数下对比。
+
+用法（在 backend 目录下）：
+  python -m benchmarks.runner_suite
+  python -m benchmarks.runner_suite --quick --only spawn,e2e --json
+  python -m benchmarks.runner_suite --save-baseline benchmarks/baseline.json
+  python -m benchmarks.runner_suite --baseline benchmarks/baseline.json --threshold 0.25
+  RUN_STORAGE=files python -m benchmarks.runner_suite --only e2e,http
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+from datetime import datetime
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from benchmarks.stats import summarize, load_baseline, compare  # noqa: E402
+
+SCENARIOS = ('spawn', 'log_throughput', 'context', 'cpu_bound', 'e2e', 'http')
+
+# 合成脚本：参数从上下文读取，便于同一脚本在不同负载下复用
+SCRIPTS = {
+    'bench_empty.py': 'pass\n',
+    'bench_log.py': (
+        'from app.utils import task_sdk\n'
+        'lines = int(task_sdk.get("bench_lines", 10000))\n'
+        'for i in range(lines):\n'
+        '    task_sdk.log(f"line {i} " + "x" * 80)\n'
+    ),
+    'bench_context.py': (
+        'from app.utils import task_sdk\n'
+        'ctx = task_sdk.get_context()\n'
+        'step = int(ctx.get("bench_step", 0)) + 1\n'
+        'keys = int(ctx.get("bench_keys", 200))\n'
+        'update = {"bench_step": step}\n'
+        'update.update({f"s{step}_{i}": "v" * 64 for i in range(keys)})\n'
+        'task_sdk.update_context(update)\n'
+    ),
+    'bench_cpu.py': (
+        'from app.utils import task_sdk\n'
+        'loops = int(task_sdk.get("bench_cpu", 2000000))\n'
+        'total = sum(i * i for i in range(loops))\n'
+    ),
+}
+
+
+def prepare_workspace(root, args):
+    """创建任务 / 日志目录与合成脚本，并在导入 app 之前设置好环境变量（Config 在导入时读取）"""
+    tasks_dir = os.path.join(root, 'tasks')
+    logs_dir = os.path.join(root, 'logs')
+    os.makedirs(tasks_dir, exist_ok=True)
+    os.makedirs(logs_dir, exist_ok=True)
+    for name, source in SCRIPTS.items():
+        with open(os.path.join(tasks_dir, name), 'w', encoding='utf-8') as f:
+            f.write(source)
+    os.environ.update({
+        'TASKS_DIR': tasks_dir,
+        'LOGS_DIR': logs_dir,
+        'TASK_DB_PATH': f"sqlite:///{os.path.join(root, 'bench.db')}",
+        'RUN_MODE': 'local',
+        'MAX_TASK_WORKERS': str(args.workers),
+        'MAX_PENDING_RUNS': str(max(args.concurrent_runs, 100)),
+        'SCHEDULER_ENABLED': '0',
+        'LOG_RETENTION_ENABLED': '0',
+        'RESULT_CACHE_ENABLED': '0',
+    })
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    return tasks_dir
+
+
+def timed(fn, iterations):
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def bench_spawn(tasks_dir, args, results):
+    from app.utils.script_runner import run_script
+    path = os.path.join(tasks_dir, 'bench_empty.py')
+    run_script(path, cwd=tasks_dir, context={}, use_pool=False)
+    samples = timed(lambda: run_script(path, cwd=tasks_dir, context={}, use_pool=False), args.iterations)
+    results['spawn'] = summarize(samples, sum(samples))
+    if args.warm:
+        from app.utils.worker_pool import get_pool
+        run_script(path, cwd=tasks_dir, context={}, use_pool=True)
+        samples = timed(lambda: run_script(path, cwd=tasks_dir, context={}, use_pool=True), args.iterations)
+        results['spawn_warm'] = summarize(samples, sum(samples))
+        get_pool().shutdown()
+
+
+def bench_log_throughput(tasks_dir, args, results):
+    from app.utils.script_runner import run_script
+    path = os.path.join(tasks_dir, 'bench_log.py')
+    received = []
+
+    def sink(batch):
+        received.append(len(batch.get('lines') or ()))
+
+    samples = timed(lambda: run_script(path, cwd=tasks_dir, context={'bench_lines': args.log_lines},
+                                       log_sink=sink, use_pool=False),
+                    args.repeats)
+    lines = sum(received)
+    results['log_throughput'] = summarize(samples, lines=lines, batches=len(received),
+                                          lines_per_sec=round(lines / sum(samples), 1))
+
+
+def bench_context(tasks_dir, args, results):
+    from app.core import context_history
+    from app.utils.script_runner import run_script
+    keys = args.context_keys
+    base = {f'k{i}': 'v' * 64 for i in range(keys)}
+    # 每个条目改动约 1% 的键，模拟多步骤运行中逐脚本的上下文变化
+    changed = max(1, keys // 100)
+    contexts = [base]
+    for step in range(args.steps):
+        after = dict(contexts[-1])
+        after.update({f'k{(step * changed + i) % keys}': f'step{step}' for i in range(changed)})
+        contexts.append(after)
+    entries = [context_history.make_entry(i, 'bench', contexts[i], contexts[i + 1]) for i in range(args.steps)]
+
+    samples = timed(lambda: context_history.make_entry(0, 'bench', contexts[0], contexts[1]), args.iterations)
+    results['context_delta'] = summarize(samples, sum(samples), keys=keys)
+    samples = timed(lambda: context_history.dumps(contexts[-1]), args.iterations)
+    results['context_dumps'] = summarize(samples, sum(samples), payload_bytes=len(context_history.dumps(contexts[-1])))
+    samples = timed(lambda: context_history.latest(base, entries), args.iterations)
+    results['context_materialize'] = summarize(samples, sum(samples), entries=len(entries))
+
+    path = os.path.join(tasks_dir, 'bench_context.py')
+    seed = dict(base, bench_keys=keys // 10)
+    samples = timed(lambda: run_script(path, cwd=tasks_dir, context=dict(seed), use_pool=False), args.repeats)
+    results['context_roundtrip'] = summarize(samples, keys=keys)
+
+
+def bench_cpu_bound(tasks_dir, args, results):
+    from app.utils.script_runner import run_script
+    path = os.path.join(tasks_dir, 'bench_cpu.py')
+    samples = timed(lambda: run_script(path, cwd=tasks_dir, context={'bench_cpu': args.cpu_loops}, use_pool=False),
+                    args.repeats)
+    inline = timed(lambda: sum(i * i for i in range(args.cpu_loops)), args.repeats)
+    results['cpu_bound'] = summarize(samples, inline_p50_ms=summarize(inline)['p50_ms'])
+
+
+class RunWaiter:
+    """通过 on_finish 回调等待运行结束，记录从提交到结束的耗时与状态"""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.finished = {}
+
+    def on_finish(self, run_id, status):
+        with self.cond:
+            self.finished[run_id] = (time.perf_counter(), status)
+            self.cond.notify_all()
+
+    def wait(self, run_ids, timeout):
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while not all(r in self.finished for r in run_ids):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"运行未在 {timeout}s 内结束: {[r for r in run_ids if r not in self.finished]}")
+                self.cond.wait(remaining)
+
+
+def submit(service, task_id, context, waiter):
+    from app.core.run_scheduler import QueueFullError
+    while True:
+        try:
+            started = time.perf_counter()
+            run_id, msg = service.run_task(task_id, context, on_finish=waiter.on_finish)
+            if run_id is None:
+                raise RuntimeError(msg)
+            return run_id, started
+        except QueueFullError:
+            time.sleep(0.01)
+
+
+def bench_e2e(service, args, results, state):
+    from app.core.db_writer import db_writer
+    waiter = RunWaiter()
+    workloads = {
+        'e2e_empty': (['bench_empty.py'], {}),
+        'e2e_many_steps': (['bench_empty.py'] * args.steps, {}),
+        'e2e_log_heavy': (['bench_log.py'] * 3, {'bench_lines': args.log_lines}),
+        'e2e_context_heavy': (['bench_context.py'] * args.steps, {'bench_keys': args.context_keys // args.steps}),
+        'e2e_cpu_bound': (['bench_cpu.py'] * 2, {'bench_cpu': args.cpu_loops}),
+    }
+    for name, (scripts, context) in workloads.items():
+        task_id = service.create_task(name, 'benchmark', scripts)
+        state.setdefault('tasks', {})[name] = task_id
+        samples, failed = [], 0
+        for _ in range(args.runs):
+            run_id, started = submit(service, task_id, context, waiter)
+            waiter.wait([run_id], args.timeout)
+            ended, status = waiter.finished[run_id]
+            samples.append(ended - started)
+            failed += status != 'success'
+            state.setdefault('runs', {})[name] = run_id
+        results[name] = summarize(samples, scripts=len(scripts), failed=failed)
+
+    # 并发提交：多个运行同时排队 / 执行时的吞吐
+    task_id = state['tasks']['e2e_empty']
+    started = time.perf_counter()
+    submitted = [submit(service, task_id, {}, waiter) for _ in range(args.concurrent_runs)]
+    waiter.wait([run_id for run_id, _ in submitted], args.timeout)
+    duration = time.perf_counter() - started
+    samples = [waiter.finished[run_id][0] - at for run_id, at in submitted]
+    failed = sum(waiter.finished[run_id][1] != 'success' for run_id, _ in submitted)
+    results['e2e_throughput'] = summarize(samples, runs=len(submitted), failed=failed,
+                                          runs_per_sec=round(len(submitted) / duration, 2))
+    db_writer.flush(args.timeout)
+
+
+def bench_http(app, service, args, results, state):
+    from app.utils.auth import generate_token
+    with app.app_context():
+        token = generate_token('benchmark')
+    client = app.test_client()
+    headers = {'Authorization': f'Bearer {token}'}
+    if not state.get('runs'):
+        # 未跑 e2e 场景时先准备一个日志密集和一个上下文密集的运行供读取
+        bench_e2e(service, argparse.Namespace(**dict(vars(args), runs=1, concurrent_runs=1)), {}, state)
+    task_id = state['tasks']['e2e_log_heavy']
+    log_run = state['runs']['e2e_log_heavy']
+    context_run = state['runs']['e2e_context_heavy']
+    endpoints = {
+        'http_list_tasks': '/api/tasks/db',
+        'http_list_runs': f'/api/tasks/db/{task_id}/runs',
+        'http_run_logs': f'/api/tasks/db/runs/{log_run}/logs?script=bench_log.py&tail=1000',
+        'http_run_steps': f'/api/tasks/db/runs/{context_run}/steps',
+        'http_run_contexts': f'/api/tasks/db/runs/{context_run}/contexts?position={args.steps - 1}',
+    }
+    for name, url in endpoints.items():
+        statuses = []
+
+        def request():
+            statuses.append(client.get(url, headers=headers).status_code)
+
+        samples = timed(request, args.requests)
+        results[name] = summarize(samples, sum(samples), errors=sum(s != 200 for s in statuses))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', default=','.join(SCENARIOS), help=f"要运行的场景组，逗号分隔：{','.join(SCENARIOS)}")
+    parser.add_argument('--quick', action='store_true', help='缩小各项规模，用于快速冒烟')
+    parser.add_argument('--iterations', type=int, default=50, help='spawn 与进程内上下文操作的次数')
+    parser.add_argument('--repeats', type=int, default=5, help='日志 / 上下文往返 / CPU 脚本的执行次数')
+    parser.add_argument('--runs', type=int, default=10, help='每种端到端负载的运行次数')
+    parser.add_argument('--concurrent-runs', type=int, default=50, help='并发吞吐场景提交的运行数')
+    parser.add_argument('--requests', type=int, default=200, help='每个 HTTP 接口的请求次数')
+    parser.add_argument('--steps', type=int, default=20, help='多步骤任务的脚本数')
+    parser.add_argument('--log-lines', type=int, default=20000)
+    parser.add_argument('--context-keys', type=int, default=2000)
+    parser.add_argument('--cpu-loops', type=int, default=2000000)
+    parser.add_argument('--workers', type=int, default=4, help='MAX_TASK_WORKERS')
+    parser.add_argument('--warm', action='store_true', help='spawn 场景另测预热进程池')
+    parser.add_argument('--timeout', type=float, default=300.0, help='等待单批运行结束的最长秒数')
+    parser.add_argument('--workdir', help='工作目录（默认临时目录，结束后删除）')
+    parser.add_argument('--json', action='store_true', help='以 JSON 输出结果')
+    parser.add_argument('--baseline', help='与该基线文件对比')
+    parser.add_argument('--save-baseline', help='把本次结果写入该文件作为基线')
+    parser.add_argument('--threshold', type=float, default=0.2, help='相对基线退化超过该比例视为回归')
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.iterations, args.repeats, args.runs, args.concurrent_runs, args.requests = 10, 2, 3, 10, 30
+        args.steps, args.log_lines, args.context_keys, args.cpu_loops = 5, 2000, 500, 200000
+    args.steps = max(args.steps, 1)
+    return args
+
+
+def print_table(results, regressions):
+    flagged = {(r['scenario'], r['metric']) for r in regressions}
+    for scenario, metrics in results.items():
+        cells = []
+        for metric, value in metrics.items():
+            mark = ' !' if (scenario, metric) in flagged else ''
+            cells.append(f"{metric}={value}{mark}")
+        print(f"{scenario:<22}" + '  '.join(cells))
+    for r in regressions:
+        print(f"REGRESSION {r['scenario']}.{r['metric']}: {r['baseline']} -> {r['current']} ({r['change']:+.1%})")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    selected = [s.strip() for s in args.only.split(',') if s.strip()]
+    unknown = [s for s in selected if s not in SCENARIOS]
+    if unknown:
+        raise SystemExit(f"未知的场景: {', '.join(unknown)}")
+
+    root = args.workdir or tempfile.mkdtemp(prefix='taskrun-bench-')
+    tasks_dir = prepare_workspace(root, args)
+    results, state = {}, {}
+    started_at = datetime.utcnow().isoformat()
+    try:
+        from app import create_app
+        app = create_app()
+        service = app.task_manager.task_service
+        if 'spawn' in selected:
+            bench_spawn(tasks_dir, args, results)
+        if 'log_throughput' in selected:
+            bench_log_throughput(tasks_dir, args, results)
+        if 'context' in selected:
+            bench_context(tasks_dir, args, results)
+        if 'cpu_bound' in selected:
+            bench_cpu_bound(tasks_dir, args, results)
+        if 'e2e' in selected:
+            bench_e2e(service, args, results, state)
+        if 'http' in selected:
+            bench_http(app, service, args, results, state)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(root, ignore_errors=True)
+
+    regressions = compare(results, load_baseline(args.baseline), args.threshold) if args.baseline else []
+    from app.core.config import Config
+    report = {
+        'meta': {
+            'started_at': started_at,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'run_storage': Config.RUN_STORAGE,
+            'args': {k: v for k, v in vars(args).items() if k not in ('json', 'baseline', 'save_baseline')},
+        },
+        'results': results,
+        'regressions': regressions,
+    }
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump({'meta': report['meta'], 'results': results}, f, indent=2, ensure_ascii=False)
+    if args.json:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+    else:
+        print_table(results, regressions)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,67 @@
+"""基准脚本共用的统计与基线对比。
+
+基线文件为某次 --json 输出的结果：{'results': {场景: {指标: 值}}}。
+指标按名称后缀判断方向：*_ms / *_seconds / *_bytes 越小越好，*_per_sec 越大越好，其余只记录不比较。
+"""
+import json
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def summarize(samples, duration=None, **extra):
+    """耗时样本（秒）汇总为 p50/p95/p99 毫秒；给出 duration 时附带每秒次数"""
+    def ms(seconds):
+        return round(seconds * 1000, 3)
+
+    result = {
+        'count': len(samples),
+        'p50_ms': ms(percentile(samples, 0.50)),
+        'p95_ms': ms(percentile(samples, 0.95)),
+        'p99_ms': ms(percentile(samples, 0.99)),
+    }
+    if duration:
+        result['ops_per_sec'] = round(len(samples) / duration, 2)
+    result.update(extra)
+    return result
+
+
+def direction(metric):
+    """1 表示越大越好，-1 表示越小越好，0 表示不比较"""
+    if metric.endswith('_per_sec'):
+        return 1
+    if metric.endswith(('_ms', '_seconds', '_bytes')):
+        return -1
+    return 0
+
+
+def load_baseline(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    return data.get('results', data)
+
+
+def compare(results, baseline, threshold=0.2, min_ms=1.0):
+    """与基线逐项对比，返回退化超过 threshold（相对值）的指标列表。
+
+    基线中两边都很小（< min_ms）的耗时指标不比较，避免计时抖动被当作退化。
+    """
+    regressions = []
+    for scenario, metrics in results.items():
+        base = baseline.get(scenario) or {}
+        for metric, value in metrics.items():
+            sign = direction(metric)
+            old = base.get(metric)
+            if not sign or not isinstance(value, (int, float)) or not isinstance(old, (int, float)) or old <= 0:
+                continue
+            if metric.endswith('_ms') and max(old, value) < min_ms:
+                continue
+            change = (value - old) / old
+            if change * sign < -threshold:
+                regressions.append({'scenario': scenario, 'metric': metric, 'baseline': old,
+                                    'current': value, 'change': round(change, 3)})
+    return regressions
@@ -0,0 +1,32 @@
+"""gunicorn 生产部署配置：gthread 多 worker 提供 API，运行与定时触发由唯一的 runner 进程负责（见 app/serve.py）。
+
+用法（在 backend 目录下）：
+  gunicorn -c gunicorn.conf.py wsgi:app
+"""
+import os
+from app import serve
+
+# worker 只入队、不执行运行，也不启动定时触发
+serve.prepare_environment()
+
+bind = os.getenv('WEB_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('WEB_WORKERS', '2'))
+# 实时日志流（SSE）与大日志读取会长时间占用一个线程，gthread 下只占用线程而不阻塞整个 worker
+worker_class = 'gthread'
+threads = int(os.getenv('WEB_THREADS', '16'))
+timeout = int(os.getenv('WEB_TIMEOUT', '60'))
+graceful_timeout = int(os.getenv('WEB_GRACEFUL_TIMEOUT', '30'))
+keepalive = 5
+# 不预加载应用：后台线程（指标采样、资源采样、心跳）需要在各 worker 进程内启动
+preload_app = False
+
+supervisor = serve.RunnerSupervisor()
+
+
+def on_starting(server):
+    supervisor.start()
+
+
+def on_exit(server):
+    # worker 已在 graceful_timeout 内停止，再排空 runner 中执行中的运行
+    supervisor.stop()
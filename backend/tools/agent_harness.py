@@ -0,0 +1,135 @@
+"""本地多 agent 测试：在临时目录中用一个 SQLite 数据库模拟 API 节点 + 多个 runner agent。
+
+1. 以 RUN_MODE=queue 提交 --runs 个运行（每个运行依次执行两个会打印日志、sleep 的脚本）
+2. 启动 --agents 个 `python -m app.agent` 子进程并发领取
+3. 可选 --kill-after N：agent 启动 N 秒后 SIGKILL 第一个 agent，验证其租约过期后运行被其他 agent 重新领取
+4. 等待全部运行结束，输出各 agent 执行的运行数、重试次数与耗时；有运行未成功时退出码为 1
+
+用法（在 backend 目录下）：
+  python -m tools.agent_harness --agents 3 --runs 12
+  python -m tools.agent_harness --agents 3 --runs 12 --kill-after 2
+"""
+import os
+import sys
+import time
+import signal
+import argparse
+import tempfile
+import subprocess
+from collections import Counter
+
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+SCRIPTS = {
+    'harness_step1.py': (
+        "import time\n"
+        "from app.utils import task_sdk\n"
+        "for i in range(5):\n"
+        "    task_sdk.log(f'step1 tick {i}')\n"
+        "    time.sleep({sleep} / 5)\n"
+        "task_sdk.update_context({'step1': 'done'})\n"
+    ),
+    'harness_step2.py': (
+        "import time\n"
+        "from app.utils import task_sdk\n"
+        "task_sdk.log('step2 start')\n"
+        "time.sleep({sleep})\n"
+        "task_sdk.log('step2 done')\n"
+    ),
+}
+
+
+def prepare_env(workdir, args):
+    tasks_dir = os.path.join(workdir, 'tasks')
+    os.makedirs(tasks_dir, exist_ok=True)
+    for name, template in SCRIPTS.items():
+        with open(os.path.join(tasks_dir, name), 'w', encoding='utf-8') as f:
+            f.write(template.replace('{sleep}', str(args.sleep)))
+    env = dict(os.environ)
+    env.update({
+        'TASK_DB_PATH': f"sqlite:///{os.path.join(workdir, 'harness.db')}",
+        'TASKS_DIR': tasks_dir,
+        'LOGS_DIR': os.path.join(workdir, 'logs'),
+        'RUN_MODE': 'queue',
+        'RUN_STORAGE': 'db',
+        'RUNNER_LEASE_SECONDS': str(args.lease),
+        'RUNNER_HEARTBEAT_INTERVAL': str(max(0.5, args.lease / 4)),
+        'RUNNER_POLL_INTERVAL': '0.2',
+        'RUNNER_LOG_SHIP_INTERVAL': '0.5',
+        'SCHEDULER_ENABLED': '0',
+        'MAX_PENDING_RUNS': str(max(args.runs, 100)),
+        'PYTHONPATH': BACKEND_DIR,
+    })
+    os.makedirs(env['LOGS_DIR'], exist_ok=True)
+    return env
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--agents', type=int, default=3)
+    parser.add_argument('--concurrency', type=int, default=2, help='每个 agent 同时执行的运行数')
+    parser.add_argument('--runs', type=int, default=12)
+    parser.add_argument('--sleep', type=float, default=0.5, help='每个脚本的执行时长（秒）')
+    parser.add_argument('--lease', type=float, default=3, help='租约时长（秒）')
+    parser.add_argument('--kill-after', type=float, default=None, help='agent 启动 N 秒后强制终止第一个 agent')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--workdir', help='默认使用临时目录')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='agent-harness-')
+    env = prepare_env(workdir, args)
+    # 本进程扮演 API 节点：环境变量需在导入 app 之前生效
+    os.environ.update(env)
+    sys.path.insert(0, BACKEND_DIR)
+    from app.models.db import SessionLocal, init_db
+    from app.models.task_models import TaskRun
+    from app.services.task_service import TaskService
+
+    init_db()
+    service = TaskService()
+    task_id = service.create_task('agent-harness', '多 agent 测试', list(SCRIPTS))
+    started = time.monotonic()
+    run_ids = [service.run_task(task_id, {'n': i})[0] for i in range(args.runs)]
+    print(f"工作目录 {workdir}，已提交 {len(run_ids)} 个运行")
+
+    agents = [subprocess.Popen([sys.executable, '-m', 'app.agent', '--name', f'agent-{i}',
+                                '--concurrency', str(args.concurrency)], cwd=BACKEND_DIR, env=env)
+              for i in range(args.agents)]
+    spawned = time.monotonic()
+    killed = False
+    rows = []
+    try:
+        while time.monotonic() - started < args.timeout:
+            if args.kill_after is not None and not killed and time.monotonic() - spawned >= args.kill_after:
+                agents[0].send_signal(signal.SIGKILL)
+                killed = True
+                print(f"已强制终止 agent-0，等待其租约（{args.lease}s）过期后重新领取")
+            session = SessionLocal()
+            try:
+                rows = session.query(TaskRun.id, TaskRun.status, TaskRun.claimed_by, TaskRun.attempts) \
+                    .filter(TaskRun.id.in_(run_ids)).all()
+            finally:
+                session.close()
+            if all(row.status not in ('queued', 'claimed', 'running') for row in rows):
+                break
+            time.sleep(0.5)
+    finally:
+        for proc in agents:
+            if proc.poll() is None:
+                proc.send_signal(signal.SIGTERM)
+        for proc in agents:
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    elapsed = time.monotonic() - started
+    statuses = Counter(row.status for row in rows)
+    print(f"耗时 {elapsed:.1f}s，状态: {dict(statuses)}")
+    print(f"各 agent 完成的运行数: {dict(Counter(row.claimed_by for row in rows))}")
+    print(f"尝试次数分布: {dict(Counter(row.attempts for row in rows))}")
+    return 0 if statuses.get('success', 0) == len(run_ids) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,193 @@
+"""把旧的运行目录（LOGS_DIR/run_<id>/*.log、contexts.jsonl 或 *.context.json、剖析结果、trace.jsonl）迁移到数据库存储。
+
+每个运行在一个事务中写入日志块、上下文、剖析结果与追踪 span 行，成功后可选删除原目录；
+数据库中已有该运行任一类数据（日志块、上下文、剖析结果、span）的目录会被跳过，因此可以重复执行。
+仍在排队 / 执行中的运行跳过，其日志由执行进程自己写入数据库，目录也不会被删除。
+
+用法（在 backend 目录下）：
+  python -m tools.migrate_run_storage --dry-run
+  python -m tools.migrate_run_storage --delete
+  python -m tools.migrate_run_storage --run 42 --run 43
+"""
+import os
+import re
+import sys
+import json
+import shutil
+import argparse
+import datetime
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from sqlalchemy import insert  # noqa: E402
+from app.core.config import Config  # noqa: E402
+from app.core import run_storage, context_history, trace_store, run_queue  # noqa: E402
+from app.core.log_hub import list_script_logs  # noqa: E402
+from app.models.db import SessionLocal, init_db  # noqa: E402
+from app.models.task_models import TaskRun, TaskRunLog, TaskRunContext, TaskRunProfile, TaskRunSpan  # noqa: E402
+from app.utils import profiling  # noqa: E402
+
+RUN_DIR_RE = re.compile(r'^run_(\d+)$')
+
+
+def find_run_dirs(logs_dir, only=None):
+    for name in sorted(os.listdir(logs_dir)):
+        m = RUN_DIR_RE.match(name)
+        path = os.path.join(logs_dir, name)
+        if m and os.path.isdir(path):
+            run_id = int(m.group(1))
+            if not only or run_id in only:
+                yield run_id, path
+
+
+def collect_rows(run_id, run_dir, codec):
+    """读取运行目录，返回 (日志块行, 上下文行)"""
+    log_rows = []
+    for script in list_script_logs(run_dir):
+        path = os.path.join(run_dir, f"{script}.log")
+        created_at = datetime.datetime.utcfromtimestamp(os.path.getmtime(path))
+        for row in run_storage.build_log_chunks(run_id, script, path, codec=codec):
+            row['created_at'] = created_at
+            log_rows.append(row)
+
+    entries = context_history.read_file(run_dir)
+    if entries is not None:
+        return log_rows, [{
+            'run_id': run_id,
+            'position': entry.get('position'),
+            'script_filename': entry.get('script'),
+            'context': entry.get('context'),
+            'delta': entry.get('delta'),
+            'created_at': datetime.datetime.fromisoformat(entry['created_at']) if entry.get('created_at') else None,
+        } for entry in entries]
+
+    # 旧版本每个脚本一个 .context.json 完整快照
+    ctx_files = [f for f in os.listdir(run_dir) if f.endswith('.context.json')]
+    # 文件名按脚本命名，没有执行顺序，用修改时间近似
+    ctx_files.sort(key=lambda f: os.path.getmtime(os.path.join(run_dir, f)))
+    ctx_rows = []
+    for position, fname in enumerate(ctx_files):
+        path = os.path.join(run_dir, fname)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                context = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"  跳过无法解析的上下文文件 {fname}: {e}")
+            continue
+        ctx_rows.append({
+            'run_id': run_id,
+            'position': position,
+            'script_filename': fname[:-len('.context.json')],
+            'context': context,
+            'created_at': datetime.datetime.utcfromtimestamp(os.path.getmtime(path)),
+        })
+    return log_rows, ctx_rows
+
+
+def collect_profiles(run_id, run_dir, codec):
+    """运行目录中的剖析结果行；文件名不含执行序号，position 留空"""
+    rows = []
+    for script in sorted(profiling.scripts_with_profiles(os.listdir(run_dir))):
+        prefix = os.path.join(run_dir, script)
+        row = run_storage.build_profile_row(run_id, None, script, prefix, codec=codec)
+        if row is not None:
+            row['created_at'] = datetime.datetime.utcfromtimestamp(
+                os.path.getmtime(prefix + profiling.COLLAPSED_SUFFIX))
+            rows.append(row)
+    return rows
+
+
+def collect_spans(run_id, run_dir):
+    """运行目录中 trace.jsonl 记录的追踪 span 行"""
+    try:
+        with open(os.path.join(run_dir, trace_store.TRACE_LOG), 'r', encoding='utf-8') as f:
+            spans = context_history.parse_lines(f)
+    except FileNotFoundError:
+        return []
+    return [{
+        'run_id': run_id,
+        'span_id': item['span_id'],
+        'parent_id': item.get('parent_id'),
+        'name': item['name'],
+        'start_time': item['start'],
+        'duration': item['duration'],
+        'attrs': item.get('attrs') or {},
+    } for item in spans]
+
+
+def already_migrated(session, run_id):
+    """数据库中已有该运行的任一类数据即视为已迁移"""
+    if session.query(TaskRunLog.id).filter(TaskRunLog.run_id == run_id,
+                                           TaskRunLog.byte_offset.isnot(None)).first() is not None:
+        return True
+    return any(session.query(model.id).filter(model.run_id == run_id).first() is not None
+               for model in (TaskRunContext, TaskRunProfile, TaskRunSpan))
+
+
+def migrate_run(run_id, run_dir, args):
+    session = SessionLocal()
+    try:
+        run = session.query(TaskRun.status).filter(TaskRun.id == run_id).first()
+        if run is None and not args.orphans:
+            return 'skip (无对应运行记录)'
+        if run is not None and run.status in run_queue.ACTIVE_STATUSES:
+            return 'skip (运行中)'
+        if already_migrated(session, run_id):
+            return 'skip (已迁移)'
+        log_rows, ctx_rows = collect_rows(run_id, run_dir, args.codec)
+        profile_rows = collect_profiles(run_id, run_dir, args.codec)
+        span_rows = collect_spans(run_id, run_dir)
+        raw = sum(r['raw_size'] for r in log_rows)
+        packed = sum(len(r['data']) for r in log_rows)
+        summary = (f"{len(log_rows)} 块 {raw} -> {packed} 字节, {len(ctx_rows)} 个上下文, "
+                   f"{len(profile_rows)} 个剖析结果, {len(span_rows)} 个 span")
+        if args.dry_run:
+            return f"dry-run: {summary}"
+        if log_rows:
+            session.execute(insert(TaskRunLog), log_rows)
+        if ctx_rows:
+            session.execute(insert(TaskRunContext), ctx_rows)
+        if profile_rows:
+            session.execute(insert(TaskRunProfile), profile_rows)
+        if span_rows:
+            session.execute(insert(TaskRunSpan), span_rows)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    if args.delete:
+        shutil.rmtree(run_dir, ignore_errors=True)
+        summary += ', 已删除目录'
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--logs-dir', default=Config.LOGS_DIR)
+    parser.add_argument('--run', type=int, action='append', help='只迁移指定运行，可重复')
+    parser.add_argument('--codec', default=run_storage.default_codec(), choices=('zstd', 'gzip', 'none'))
+    parser.add_argument('--delete', action='store_true', help='迁移成功后删除运行目录（仅限已结束或无运行记录的运行）')
+    parser.add_argument('--orphans', action='store_true', help='也迁移数据库中没有运行记录的目录')
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    if args.codec == 'zstd' and run_storage.zstandard is None:
+        parser.error('使用 zstd 需要安装 zstandard')
+    init_db()
+
+    done = failed = 0
+    for run_id, run_dir in find_run_dirs(args.logs_dir, set(args.run or ())):
+        try:
+            print(f"run_{run_id}: {migrate_run(run_id, run_dir, args)}")
+            done += 1
+        except Exception as e:
+            print(f"run_{run_id}: 失败 {e}")
+            failed += 1
+    print(f"完成: {done} 个目录, 失败 {failed} 个")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,5 @@
+#!/usr/bin/env python
+"""WSGI 入口，供 gunicorn 使用：gunicorn -c gunicorn.conf.py wsgi:app（见 app/serve.py）"""
+from app import create_app
+
+app = create_app()
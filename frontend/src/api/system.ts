@@ -13,8 +13,13 @@ export function fetchSystemProcesses() {
   return request.get({ url: '/api/system/processes' })
 }
 
+export function fetchSystemHistory(seconds?: number, limit?: number) {
+  return request.get({ url: '/api/system/history', params: { seconds, limit } })
+}
+
 export default {
   fetchSystemInfo,
   fetchSystemProcess,
-  fetchSystemProcesses
+  fetchSystemProcesses,
+  fetchSystemHistory
 }
@@ -17,12 +17,12 @@ export function fetchUpdateDbTask(taskId: string | number, data: any) {
   return request.put({ url: `/api/tasks/db/${taskId}`, data })
 }
 
-export function fetchExecuteDbTask(taskId: string | number, context: any) {
-  return request.post({ url: `/api/tasks/db/${taskId}/execute`, data: { context } })
+export function fetchExecuteDbTask(taskId: string | number, context: any, force = false) {
+  return request.post({ url: `/api/tasks/db/${taskId}/execute`, data: { context, force } })
 }
 
-export function fetchGetDbTaskRuns(taskId: string | number) {
-  return request.get({ url: `/api/tasks/db/${taskId}/runs` })
+export function fetchGetDbTaskRuns(taskId: string | number, params?: Record<string, any>) {
+  return request.get({ url: `/api/tasks/db/${taskId}/runs`, params })
 }
 export function fetchGetAllDbTaskRuns() {
   return request.get({ url: `/api/tasks/db/runs` })
@@ -35,6 +35,27 @@ export function fetchGetDbRunContexts(runId: string | number) {
   return request.get({ url: `/api/tasks/db/runs/${runId}/contexts` })
 }
 
+export function fetchResumeDbRun(runId: string | number) {
+  return request.post({ url: `/api/tasks/db/runs/${runId}/resume` })
+}
+
+// 定时触发
+export function fetchGetDbTaskSchedules(taskId: string | number) {
+  return request.get({ url: `/api/tasks/db/${taskId}/schedules` })
+}
+
+export function fetchCreateDbTaskSchedule(taskId: string | number, data: any) {
+  return request.post({ url: `/api/tasks/db/${taskId}/schedules`, data })
+}
+
+export function fetchUpdateDbSchedule(scheduleId: string | number, data: any) {
+  return request.put({ url: `/api/tasks/db/schedules/${scheduleId}`, data })
+}
+
+export function fetchDeleteDbSchedule(scheduleId: string | number) {
+  return request.del({ url: `/api/tasks/db/schedules/${scheduleId}` })
+}
+
 // 普通任务接口
 export function fetchListTasks() {
   return request.get({ url: '/api/tasks' })